@@ -171,3 +171,39 @@ if csrf_trusted:
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+
+# Per-course vector indexes of uploaded PDFs and URLs
+VECTOR_STORE_ROOT = os.getenv("VECTOR_STORE_ROOT", os.path.join(BASE_DIR, "vectorstores"))
+
+# Generation pipeline caches
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "100000"))
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "512"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+WEB_SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("WEB_SEARCH_CACHE_MAX_ENTRIES", "256"))
+WEB_SEARCH_CACHE_TTL = int(os.getenv("WEB_SEARCH_CACHE_TTL", "3600"))
+URL_CACHE_ROOT = os.getenv("URL_CACHE_ROOT", os.path.join(BASE_DIR, "url_cache"))
+URL_CACHE_MAX_BYTES = int(os.getenv("URL_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+
+# Precomputed chat context. The default cache is per process; point CACHE_BACKEND/CACHE_LOCATION
+# at a shared cache (e.g. django.core.cache.backends.redis.RedisCache) when running several processes.
+CACHES = {
+    "default": {
+        "BACKEND": os.getenv("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.getenv("CACHE_LOCATION", ""),
+    }
+}
+CHAT_CONTEXT_CACHE_TTL = int(os.getenv("CHAT_CONTEXT_CACHE_TTL", "3600"))
+# Course passages retrieved per chat question, and the token budget they are packed into
+CHAT_RETRIEVAL_K = int(os.getenv("CHAT_RETRIEVAL_K", "8"))
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "1200"))
+
+# Background generation jobs (run with `python manage.py run_generation_workers`)
+GENERATION_WORKERS = int(os.getenv("GENERATION_WORKERS", "2"))
+GENERATION_JOB_MAX_ATTEMPTS = int(os.getenv("GENERATION_JOB_MAX_ATTEMPTS", "3"))
+GENERATION_JOB_RETRY_DELAY = float(os.getenv("GENERATION_JOB_RETRY_DELAY", "30"))
+GENERATION_JOB_POLL_INTERVAL = float(os.getenv("GENERATION_JOB_POLL_INTERVAL", "2"))
+GENERATION_JOB_STALE_AFTER = float(os.getenv("GENERATION_JOB_STALE_AFTER", "900"))
+# How often a worker refreshes a running job's updated_at; well under GENERATION_JOB_STALE_AFTER
+GENERATION_JOB_HEARTBEAT = float(os.getenv("GENERATION_JOB_HEARTBEAT", "60"))
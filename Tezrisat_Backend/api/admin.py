@@ -1,5 +1,6 @@
 from django.contrib import admin
 from .models import (
+    GenerationJob,
     Microcourse,
     MicrocourseSection,
     GlossaryTerm,
@@ -30,3 +31,9 @@ class QuizQuestionAdmin(admin.ModelAdmin):
 class RecallNoteAdmin(admin.ModelAdmin):
     list_display = ("content", "timestamp", "section")
     list_filter = ("section",)
+
+@admin.register(GenerationJob)
+class GenerationJobAdmin(admin.ModelAdmin):
+    list_display = ("id", "kind", "status", "stage", "attempts", "created_at")
+    list_filter = ("status", "kind")
+    exclude = ("payload",)
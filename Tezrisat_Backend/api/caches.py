@@ -0,0 +1,317 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+from django.conf import settings
+from django.utils import timezone
+from langchain_core.stores import ByteStore
+
+from .metrics import Counters
+from .models import EmbeddingCacheEntry, LLMCacheEntry
+
+logger = logging.getLogger(__name__)
+
+
+class CacheStats(Counters):
+    """Hit/miss counters for one cache."""
+
+    def record(self, hits: int = 0, misses: int = 0) -> None:
+        self.increment("hits", hits)
+        self.increment("misses", misses)
+
+    def snapshot(self) -> Dict[str, float]:
+        counts = super().snapshot()
+        hits, misses = counts.get("hits", 0), counts.get("misses", 0)
+        total = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": (hits / total) if total else 0.0,
+        }
+
+
+embedding_cache_stats = CacheStats("embeddings")
+llm_cache_stats = CacheStats("llm_responses")
+web_search_cache_stats = CacheStats("web_search")
+
+
+class DatabaseByteStore(ByteStore):
+    """
+    Persistent, size-bounded key/value store for embedding vectors.
+
+    Used as the backing store of langchain's CacheBackedEmbeddings, which keys
+    entries by embedding model namespace plus a hash of the chunk text and only
+    sends unseen texts to the embedding API. Least recently used entries are
+    evicted once the table grows past ``max_entries``.
+    """
+
+    def __init__(self, max_entries: Optional[int] = None, stats: Optional[CacheStats] = None):
+        if max_entries is None:
+            max_entries = getattr(settings, "EMBEDDING_CACHE_MAX_ENTRIES", 100000)
+        self.max_entries = max_entries
+        self.stats = stats or embedding_cache_stats
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[bytes]]:
+        found = dict(
+            EmbeddingCacheEntry.objects.filter(key__in=keys).values_list("key", "value")
+        )
+        if found:
+            EmbeddingCacheEntry.objects.filter(key__in=found.keys()).update(last_used=timezone.now())
+        self.stats.record(hits=len(found), misses=len(keys) - len(found))
+        return [bytes(found[key]) if key in found else None for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, bytes]]) -> None:
+        pairs = dict(key_value_pairs)
+        if not pairs:
+            return
+        # Another worker may have embedded the same chunk concurrently; keep its row.
+        EmbeddingCacheEntry.objects.bulk_create(
+            [EmbeddingCacheEntry(key=key, value=value) for key, value in pairs.items()],
+            ignore_conflicts=True,
+        )
+        self._evict()
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        EmbeddingCacheEntry.objects.filter(key__in=keys).delete()
+
+    def yield_keys(self, prefix: Optional[str] = None) -> Iterator[str]:
+        queryset = EmbeddingCacheEntry.objects.all()
+        if prefix:
+            queryset = queryset.filter(key__startswith=prefix)
+        yield from queryset.values_list("key", flat=True).iterator()
+
+    def _evict(self) -> None:
+        overflow = EmbeddingCacheEntry.objects.count() - self.max_entries
+        if overflow <= 0:
+            return
+        stale_ids = list(
+            EmbeddingCacheEntry.objects.order_by("last_used", "id").values_list("id", flat=True)[:overflow]
+        )
+        EmbeddingCacheEntry.objects.filter(id__in=stale_ids).delete()
+        logger.info("Evicted %d embedding cache entries", len(stale_ids))
+
+
+class LLMResponseCache:
+    """
+    Two-tier cache of LLM completions.
+
+    Entries are keyed by model, sampling parameters and a hash of the prompt. An
+    in-process LRU answers repeats within a worker without touching the database;
+    the LLMCacheEntry table shares responses across workers and restarts. Entries
+    older than ``ttl`` seconds are treated as misses, and each tier is capped, the
+    database one evicting least recently used rows first.
+    """
+
+    def __init__(
+        self,
+        max_memory_entries: Optional[int] = None,
+        max_entries: Optional[int] = None,
+        ttl: Optional[float] = None,
+        stats: Optional[CacheStats] = None,
+    ):
+        if max_memory_entries is None:
+            max_memory_entries = getattr(settings, "LLM_CACHE_MEMORY_ENTRIES", 512)
+        if max_entries is None:
+            max_entries = getattr(settings, "LLM_CACHE_MAX_ENTRIES", 10000)
+        if ttl is None:
+            ttl = getattr(settings, "LLM_CACHE_TTL", 7 * 24 * 3600)
+        self.max_memory_entries = max_memory_entries
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = stats or llm_cache_stats
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    @staticmethod
+    def make_key(model: str, temperature: float, max_tokens: int, prompt: str) -> str:
+        payload = json.dumps([model, temperature, max_tokens, prompt])
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[1] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.stats.record(hits=1)
+                return entry[0]
+            self._memory.pop(key, None)
+
+        cutoff = timezone.now() - timedelta(seconds=self.ttl)
+        row = LLMCacheEntry.objects.filter(key=key, created_at__gte=cutoff).values_list("response", "created_at").first()
+        if row is None:
+            self.stats.record(misses=1)
+            return None
+        LLMCacheEntry.objects.filter(key=key).update(last_used=timezone.now())
+        self._remember(key, row[0], row[1].timestamp())
+        self.stats.record(hits=1)
+        return row[0]
+
+    def set(self, key: str, value: str) -> None:
+        self._remember(key, value, time.time())
+        LLMCacheEntry.objects.update_or_create(key=key, defaults={"response": value, "created_at": timezone.now()})
+        self._evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._memory.pop(key, None)
+        LLMCacheEntry.objects.filter(key=key).delete()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+        LLMCacheEntry.objects.all().delete()
+
+    def _remember(self, key: str, value: str, stored_at: float) -> None:
+        with self._lock:
+            self._memory[key] = (value, stored_at)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_memory_entries:
+                self._memory.popitem(last=False)
+
+    def _evict(self) -> None:
+        LLMCacheEntry.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=self.ttl)).delete()
+        overflow = LLMCacheEntry.objects.count() - self.max_entries
+        if overflow <= 0:
+            return
+        stale_ids = list(
+            LLMCacheEntry.objects.order_by("last_used", "id").values_list("id", flat=True)[:overflow]
+        )
+        LLMCacheEntry.objects.filter(id__in=stale_ids).delete()
+        logger.info("Evicted %d LLM cache entries", len(stale_ids))
+
+
+llm_response_cache = LLMResponseCache()
+
+
+class TTLCache:
+    """Thread-safe in-process LRU cache whose entries expire ``ttl`` seconds after being stored."""
+
+    def __init__(self, max_entries: int, ttl: float, stats: Optional[CacheStats] = None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = stats
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[object, float]]" = OrderedDict()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._clock() - entry[1] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            if self.stats is not None:
+                self.stats.record(hits=int(entry is not None), misses=int(entry is None))
+            return entry[0] if entry is not None else None
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self._entries[key] = (value, self._clock())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+web_search_cache = TTLCache(
+    max_entries=getattr(settings, "WEB_SEARCH_CACHE_MAX_ENTRIES", 256),
+    ttl=getattr(settings, "WEB_SEARCH_CACHE_TTL", 3600),
+    stats=web_search_cache_stats,
+)
+
+
+class UrlTextCache:
+    """
+    On-disk cache of the text extracted from web page sources.
+
+    One JSON file per URL holds the extracted text together with the page's
+    ETag, Last-Modified and a hash of its bytes, so callers can revalidate with
+    a conditional GET and skip extraction when nothing changed. File mtimes
+    track use; once the directory grows past ``max_bytes`` the least recently
+    used entries are removed.
+    """
+
+    def __init__(self, root: Optional[str] = None, max_bytes: Optional[int] = None):
+        if root is None:
+            root = getattr(settings, "URL_CACHE_ROOT", "url_cache")
+        if max_bytes is None:
+            max_bytes = getattr(settings, "URL_CACHE_MAX_BYTES", 100 * 1024 * 1024)
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.root, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[Dict[str, str]]:
+        path = self._path(url)
+        try:
+            with open(path, encoding="utf-8") as handle:
+                entry = json.load(handle)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def set(self, url: str, text: str, content_hash: str, etag: Optional[str] = None, last_modified: Optional[str] = None) -> None:
+        entry = {
+            "url": url,
+            "text": text,
+            "content_hash": content_hash,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+        os.makedirs(self.root, exist_ok=True)
+        path = self._path(url)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as handle:
+            json.dump(entry, handle)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def touch(self, url: str) -> None:
+        try:
+            os.utime(self._path(url))
+        except OSError:
+            pass
+
+    def _evict(self) -> None:
+        with self._lock:
+            try:
+                names = [name for name in os.listdir(self.root) if name.endswith(".json")]
+            except OSError:
+                return
+            entries = []
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(self.root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+            if evicted:
+                logger.info("Evicted %d URL text cache entries", evicted)
+
+
+url_text_cache = UrlTextCache()
@@ -0,0 +1,59 @@
+"""
+Precomputed per-course chat context.
+
+Chat prompts are grounded in the course's rolling summary and in passages
+retrieved from its sections, glossary and recall notes (see course_retrieval).
+The summary and the passage index are built once from the stored course
+document and kept in the Django cache, so a chat turn costs one primary-key
+lookup and one cache lookup however many sections the course has. The cache
+key carries the course version, which every write to the document bumps (see
+documents.update_course_document), so a write made by any process, such as a
+generation worker or another web worker with its own per-process cache, is
+seen on the next turn. Contexts of older versions expire after
+CHAT_CONTEXT_CACHE_TTL.
+"""
+from typing import Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .course_retrieval import CourseIndex, course_passages
+from .documents import get_course_document
+from .generate_microcourse import LLM_MODEL
+from .models import Microcourse
+from .services import get_course_summary
+
+
+def chat_context_cache_key(microcourse_id: int, version: int) -> str:
+    return f"chat-context:{microcourse_id}:{version}"
+
+
+def build_chat_context(microcourse: Microcourse) -> dict:
+    """The course-level chat prompt variables and the passage index questions are answered from."""
+    return {
+        "title": microcourse.title,
+        "topic": microcourse.topic,
+        "target_audience": microcourse.target_audience,
+        "summary": get_course_summary(microcourse),
+        "index": CourseIndex(course_passages(get_course_document(microcourse), LLM_MODEL)),
+    }
+
+
+def get_chat_context(microcourse_id) -> Optional[dict]:
+    """Cached chat context of the current version of a course, or None if the course does not exist."""
+    try:
+        version = Microcourse.objects.filter(id=microcourse_id).values_list("version", flat=True).first()
+    except (ValueError, TypeError):
+        return None
+    if version is None:
+        return None
+    context = cache.get(chat_context_cache_key(microcourse_id, version))
+    if context is not None:
+        return context
+    try:
+        microcourse = Microcourse.objects.get(id=microcourse_id)
+    except Microcourse.DoesNotExist:
+        return None
+    context = build_chat_context(microcourse)
+    cache.set(chat_context_cache_key(microcourse.id, microcourse.version), context, settings.CHAT_CONTEXT_CACHE_TTL)
+    return context
@@ -0,0 +1,118 @@
+"""
+Token-budgeted packing of retrieved source context into prompts.
+
+Retrieved chunks arrive ranked best-first. pack_context drops duplicates and
+the text neighbouring chunks share (the splitter overlaps them), then adds
+whole chunks in rank order while they fit the token budget, so the prompt
+never ends mid-sentence and one long low-ranked chunk cannot crowd out the
+shorter chunks after it. Tokens are counted with tiktoken; without it (or
+without its encoding files) they are estimated from the text length.
+"""
+import logging
+import math
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Iterable, List
+
+from .metrics import Counters
+
+CONTEXT_SEPARATOR = "\n\n"
+# Shared text shorter than this between two chunks is not treated as overlap.
+MIN_CHUNK_OVERLAP = 40
+# Rough characters-per-token ratio for English text, used when tiktoken is unavailable.
+CHARS_PER_TOKEN = 4
+context_packing_stats = Counters("context_packing")
+
+
+@dataclass
+class PackedContext:
+    text: str
+    tokens: int
+    chunks: int
+    skipped: int = 0  # whole chunks left out because they did not fit the budget
+    duplicates: int = 0  # chunks dropped because their text was already packed
+    indices: List[int] = field(default_factory=list)  # input positions of the packed chunks
+
+
+@lru_cache(maxsize=8)
+def _encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning(f"No tokenizer available for {model} ({e}); estimating token counts")
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    encoding = _encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _overlap_length(left: str, right: str) -> int:
+    """Length of the longest suffix of left that is also a prefix of right (0 below MIN_CHUNK_OVERLAP)."""
+    probe = right[:MIN_CHUNK_OVERLAP]
+    if len(probe) < MIN_CHUNK_OVERLAP:
+        return 0
+    index = left.find(probe, max(0, len(left) - len(right)))
+    while index != -1:
+        if right.startswith(left[index:]):
+            return len(left) - index
+        index = left.find(probe, index + 1)
+    return 0
+
+
+def _strip_overlap(chunk: str, packed: List[str]) -> str:
+    """Remove from chunk any text it shares with the start or end of an already packed chunk."""
+    for previous in packed:
+        if chunk in previous:
+            return ""
+        head = _overlap_length(previous, chunk)
+        if head:
+            chunk = chunk[head:]
+        tail = _overlap_length(chunk, previous)
+        if tail:
+            chunk = chunk[:-tail]
+    return chunk.strip()
+
+
+def pack_context(chunks: Iterable[str], token_budget: int, model: str) -> PackedContext:
+    """Pack ranked chunks, best first, into at most token_budget tokens."""
+    packed: List[str] = []
+    indices: List[int] = []
+    seen = set()
+    used = skipped = duplicates = 0
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR, model)
+    for index, chunk in enumerate(chunks):
+        normalized = " ".join(chunk.split())
+        if not normalized:
+            continue
+        if normalized in seen:
+            duplicates += 1
+            continue
+        seen.add(normalized)
+        text = _strip_overlap(chunk.strip(), packed)
+        if not text:
+            duplicates += 1
+            continue
+        cost = count_tokens(text, model) + (separator_tokens if packed else 0)
+        if used + cost > token_budget:
+            skipped += 1
+            continue
+        packed.append(text)
+        indices.append(index)
+        used += cost
+
+    context_packing_stats.increment("tokens_used", used)
+    context_packing_stats.increment("chunks_packed", len(packed))
+    context_packing_stats.increment("chunks_skipped", skipped)
+    context_packing_stats.increment("chunks_deduplicated", duplicates)
+    return PackedContext(CONTEXT_SEPARATOR.join(packed), used, len(packed), skipped, duplicates, indices)
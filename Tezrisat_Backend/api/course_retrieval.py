@@ -0,0 +1,143 @@
+"""
+Retrieval over a course's own content for grounding chat answers.
+
+The course is split into passages: section content in paragraph-aligned
+pieces, plus each section's glossary and recall notes. The passages are
+indexed with BM25. A question retrieves its best-matching passages, which are
+packed into a token budget, so the chat prompt stays the same size however
+many sections the course grows. The passages that made it into the prompt
+are reported as the answer's sources. BM25 needs no embedding calls, so the
+index is cheap to rebuild from the course document whenever the course
+changes (see chat_context).
+"""
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Tuple
+
+from .context_packing import count_tokens, pack_context
+
+# Passages are about this long, so a budget fits several sections' worth of them.
+PASSAGE_MAX_TOKENS = 200
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_WORD = re.compile(r"\w+")
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does for from how i in is it of on or that the this to what when where which"
+    " who why with you".split()
+)
+
+
+@dataclass(frozen=True)
+class Passage:
+    section_id: int
+    section_title: str
+    text: str
+
+
+@dataclass
+class RetrievedContext:
+    text: str
+    tokens: int
+    sources: List[Dict[str, object]]  # cited sections, best match first
+
+
+def _stem(word: str) -> str:
+    """Fold plurals so "loops" matches "loop"."""
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 3 and word.endswith("s") and not word.endswith("ss"):
+        return word[:-1]
+    return word
+
+
+def _terms(text: str) -> List[str]:
+    return [_stem(word) for word in _WORD.findall(text.lower()) if word not in _STOPWORDS]
+
+
+def split_passages(text: str, model: str, max_tokens: int = PASSAGE_MAX_TOKENS) -> List[str]:
+    """Split text into pieces of whole paragraphs (or sentences, for long ones) of at most max_tokens."""
+    units = []
+    for paragraph in _PARAGRAPH_BREAK.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        if count_tokens(paragraph, model) <= max_tokens:
+            units.append(paragraph)
+        else:
+            units.extend(sentence for sentence in _SENTENCE_END.split(paragraph) if sentence.strip())
+
+    pieces: List[str] = []
+    current: List[str] = []
+    used = 0
+    for unit in units:
+        cost = count_tokens(unit, model)
+        if current and used + cost > max_tokens:
+            pieces.append("\n".join(current))
+            current, used = [], 0
+        current.append(unit)
+        used += cost
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+
+def course_passages(document: dict, model: str) -> List[Passage]:
+    """Passages of a course document: section content, glossary and recall notes."""
+    passages = []
+    for section in document["sections"]:
+        texts = split_passages(section["content"] or "", model)
+        glossary = "\n".join(f"{term['term']}: {term['definition']}" for term in section["glossary_terms"])
+        texts += [f"Glossary:\n{piece}" for piece in split_passages(glossary, model)]
+        notes = "\n\n".join(note["content"] for note in section["recall_notes"])
+        texts += [f"Recall notes:\n{piece}" for piece in split_passages(notes, model)]
+        passages.extend(Passage(section["id"], section["section_title"], text) for text in texts)
+    return passages
+
+
+class CourseIndex:
+    """BM25 inverted index over a course's passages."""
+
+    def __init__(self, passages: List[Passage]):
+        self.passages = list(passages)
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths = []
+        for position, passage in enumerate(self.passages):
+            counts = Counter(_terms(f"{passage.section_title}\n{passage.text}"))
+            self._lengths.append(sum(counts.values()))
+            for term, frequency in counts.items():
+                self._postings.setdefault(term, []).append((position, frequency))
+        self._average_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 1.0
+
+    def __len__(self) -> int:
+        return len(self.passages)
+
+    def search(self, query: str, k: int) -> List[Tuple[Passage, float]]:
+        """The k best-matching passages for query, best first; passages sharing no terms are left out."""
+        scores: Dict[int, float] = {}
+        for term in set(_terms(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.passages) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for position, frequency in postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self._lengths[position] / self._average_length)
+                scores[position] = scores.get(position, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        return [(self.passages[position], score) for position, score in ranked]
+
+
+def retrieve_course_context(index: CourseIndex, question: str, k: int, token_budget: int, model: str) -> RetrievedContext:
+    """Pack the top-k passages for question into token_budget tokens, labelled with their section titles."""
+    hits = [passage for passage, _ in index.search(question or "", k)]
+    packed = pack_context((f"[{passage.section_title}]\n{passage.text}" for passage in hits), token_budget, model)
+    sources = []
+    for position in packed.indices:
+        passage = hits[position]
+        if all(source["section_id"] != passage.section_id for source in sources):
+            sources.append({"section_id": passage.section_id, "section_title": passage.section_title})
+    return RetrievedContext(packed.text, packed.tokens, sources)
@@ -0,0 +1,203 @@
+"""
+Materialized course documents.
+
+The course detail response is stored pre-rendered on Microcourse.document, so
+reading a course is a single row fetch instead of a join across the section,
+glossary, quiz and recall-note tables. Writes that go through services and
+views patch the stored document in place (one section or one related row at a
+time) inside the same transaction as the table write. render_course_document
+rebuilds a document from the tables; find_stale_course_documents compares the
+two to catch documents that drifted through writes made elsewhere (admin,
+shell, raw SQL), see the check_course_documents management command.
+"""
+import hashlib
+import json
+from typing import Callable, Iterable, List, Optional
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import F, Prefetch
+from django.utils import timezone
+
+from .models import GlossaryTerm, Microcourse, MicrocourseSection, QuizQuestion, RecallNote
+
+# Section fields of the course detail response; ?fields= selects a subset.
+SECTION_DETAIL_FIELDS = (
+    "id",
+    "section_title",
+    "content",
+    "glossary_terms",
+    "quiz_questions",
+    "recall_notes",
+    "code_examples",
+    "math_expressions",
+)
+# Related rows per section, prefetched with one query per relation.
+SECTION_DETAIL_RELATIONS = {
+    "glossary_terms": (GlossaryTerm, ("id", "term", "definition")),
+    "quiz_questions": (QuizQuestion, ("id", "question", "options", "correct_answer")),
+    "recall_notes": (RecallNote, ("id", "content", "timestamp")),
+}
+
+
+def _to_json(data):
+    """Round-trip through the encoder JsonResponse uses, so stored and freshly rendered documents compare equal."""
+    return json.loads(json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def section_detail_queryset(sections, fields: Iterable[str] = SECTION_DETAIL_FIELDS):
+    """Sections with only the requested columns and relations loaded, in a fixed number of queries."""
+    columns = [field for field in fields if field not in SECTION_DETAIL_RELATIONS]
+    sections = sections.only("id", *columns).order_by("id")
+    for relation in fields:
+        if relation in SECTION_DETAIL_RELATIONS:
+            model, related_fields = SECTION_DETAIL_RELATIONS[relation]
+            related = model.objects.only("section_id", *related_fields).order_by("id")
+            sections = sections.prefetch_related(Prefetch(relation, queryset=related))
+    return sections
+
+
+def render_related_row(relation: str, row) -> dict:
+    return _to_json({name: getattr(row, name) for name in SECTION_DETAIL_RELATIONS[relation][1]})
+
+
+def render_section(section: MicrocourseSection, related: Optional[dict] = None) -> dict:
+    """Render a section; related maps relation name -> rows, else they are read from the section."""
+    data = {}
+    for field in SECTION_DETAIL_FIELDS:
+        if field in SECTION_DETAIL_RELATIONS:
+            rows = related[field] if related is not None else getattr(section, field).all()
+            data[field] = [render_related_row(field, row) for row in rows]
+        else:
+            data[field] = getattr(section, field)
+    return _to_json(data)
+
+
+def course_document(microcourse: Microcourse, sections: List[dict]) -> dict:
+    return {
+        "id": microcourse.id,
+        "title": microcourse.title,
+        "topic": microcourse.topic,
+        "complexity": microcourse.complexity,
+        "target_audience": microcourse.target_audience,
+        "url": microcourse.url,
+        "pdf": microcourse.pdf.url if microcourse.pdf else None,
+        "sections": sections,
+    }
+
+
+def render_course_document(microcourse: Microcourse) -> dict:
+    """Render the full course detail document from the tables (four queries)."""
+    sections = section_detail_queryset(MicrocourseSection.objects.filter(microcourse_id=microcourse.pk))
+    return course_document(microcourse, [render_section(section) for section in sections])
+
+
+def rebuild_course_document(microcourse: Microcourse, bump_version: bool = False) -> dict:
+    """Store a freshly rendered document; bump_version when it replaces a stale one clients may have cached."""
+    document = render_course_document(microcourse)
+    fields = {"version": F("version") + 1} if bump_version else {}
+    Microcourse.objects.filter(pk=microcourse.pk).update(document=document, **fields)
+    microcourse.document = document
+    if bump_version:
+        microcourse.refresh_from_db(fields=["version"])
+    return document
+
+
+def get_course_document(microcourse: Microcourse) -> dict:
+    """The stored document, built on first read for courses that predate materialization."""
+    if microcourse.document is None:
+        return rebuild_course_document(microcourse)
+    return microcourse.document
+
+
+def project_document(document: dict, fields: List[str]) -> dict:
+    """The document with each section cut down to the given fields."""
+    if list(fields) == list(SECTION_DETAIL_FIELDS):
+        return document
+    projected = dict(document)
+    projected["sections"] = [
+        {field: section[field] for field in fields if field in section}
+        for section in document["sections"]
+    ]
+    return projected
+
+
+def course_etag(microcourse_id: int, version: int, fields: List[str]) -> str:
+    """Strong ETag of a course detail response: the course version plus, for ?fields= subsets, the projection."""
+    tag = f"{microcourse_id}.{version}"
+    if list(fields) != list(SECTION_DETAIL_FIELDS):
+        tag += "." + hashlib.sha1(",".join(fields).encode("utf-8")).hexdigest()[:12]
+    return f'"{tag}"'
+
+
+def update_course_document(microcourse_id: int, patch: Callable[[dict], None], **fields) -> None:
+    """Apply patch to the stored document under a row lock, bumping version and updated_at.
+
+    Courses without a document yet are rendered from the tables instead, which
+    already include the write being recorded. Extra fields are saved in the
+    same UPDATE.
+    """
+    fields.setdefault("updated_at", timezone.now())
+    with transaction.atomic():
+        microcourse = Microcourse.objects.select_for_update().defer("summary").get(pk=microcourse_id)
+        if microcourse.document is None:
+            document = render_course_document(microcourse)
+        else:
+            document = microcourse.document
+            patch(document)
+        Microcourse.objects.filter(pk=microcourse_id).update(
+            document=document,
+            version=F("version") + 1,
+            **fields,
+        )
+
+
+def _find_section(document: dict, section_id: int) -> Optional[dict]:
+    return next((section for section in document["sections"] if section["id"] == section_id), None)
+
+
+def add_section(section: MicrocourseSection, related: dict, **fields) -> None:
+    """Append a just-created section, rendered from its in-memory related rows."""
+    if any(row.pk is None for rows in related.values() for row in rows):
+        # The backend did not return ids from bulk_create; read the rows back.
+        section = section_detail_queryset(MicrocourseSection.objects.filter(pk=section.pk)).get()
+        related = None
+    rendered = render_section(section, related)
+
+    def patch(document):
+        document["sections"].append(rendered)
+
+    update_course_document(section.microcourse_id, patch, **fields)
+
+
+def add_related_row(section: MicrocourseSection, relation: str, row) -> None:
+    rendered = render_related_row(relation, row)
+
+    def patch(document):
+        section_document = _find_section(document, section.id)
+        if section_document is not None:
+            section_document[relation].append(rendered)
+
+    update_course_document(section.microcourse_id, patch)
+
+
+def remove_related_row(microcourse_id: int, relation: str, row_id: int) -> None:
+    def patch(document):
+        for section_document in document["sections"]:
+            section_document[relation] = [row for row in section_document[relation] if row["id"] != row_id]
+
+    update_course_document(microcourse_id, patch)
+
+
+def find_stale_course_documents(microcourses=None, rebuild: bool = False) -> List[int]:
+    """Ids of courses whose stored document differs from the tables, rebuilding them if asked."""
+    if microcourses is None:
+        microcourses = Microcourse.objects.order_by("id")
+    stale = []
+    for microcourse in microcourses.iterator(chunk_size=100):
+        if microcourse.document == render_course_document(microcourse):
+            continue
+        stale.append(microcourse.pk)
+        if rebuild:
+            rebuild_course_document(microcourse, bump_version=True)
+    return stale
@@ -1,19 +1,45 @@
 import os
+import hashlib
 import json
 import logging
+import multiprocessing
+import random
+import re
+import shutil
+import threading
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from concurrent.futures import wait as wait_futures
+from email.utils import parsedate_to_datetime
+from functools import wraps
 from uuid import uuid4
 from tqdm import tqdm
-from typing import Optional, Dict, Any, List, Union
+from typing import Optional, Callable, Dict, Any, Iterable, Iterator, List, Tuple, Union
 
-from langchain_community.cache import InMemoryCache
+import numpy as np
+import openai
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings
 from langchain_community.document_loaders import PyPDFLoader
 from langchain.schema import Document
 import trafilatura
 from langchain_text_splitters import CharacterTextSplitter, RecursiveCharacterTextSplitter
 from langchain_community.vectorstores import Chroma
+from langchain.embeddings import CacheBackedEmbeddings
 from dotenv import load_dotenv
+
+from .context_packing import count_tokens, pack_context
+from .llm_clients import get_chat_client
+from .metrics import Counters
+from .structured_output import (
+    CODE_EXAMPLES_SCHEMA,
+    MAIN_SECTION_SCHEMA,
+    MATH_EXPRESSIONS_SCHEMA,
+    llm_output_stats,
+    parse_structured_output,
+)
 try:
     from langchain_community.cache import BaseCache
 except ModuleNotFoundError:
@@ -30,11 +56,28 @@ os.environ["LANGCHAIN_API_KEY"] = os.getenv("LANGCHAIN_API_KEY", "")
 os.environ["WOLFRAM_ALPHA_APPID"] = os.getenv("WOLFRAM_ALPHA_APPID", "")
 os.environ["SERPAPI_API_KEY"] = os.getenv("SERPAPI_API_KEY", "")
 
-# Note: ChatOpenAI from langchain_openai handles caching internally
-
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+def with_db_connections(func: Callable) -> Callable:
+    """Wrap func for a pool thread that may use the ORM (caches, embedding store).
+
+    Pool threads outlive requests, so, as Django does around each request,
+    stale or broken connections are closed before and after every call.
+    """
+    @wraps(func)
+    def run(*args, **kwargs):
+        from django.db import close_old_connections
+
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    return run
+
+
 # ------------------------------
 # Fine-Tuning Context Extraction
 # ------------------------------
@@ -42,6 +85,332 @@ from typing import Optional, Union, List
 import os
 
 
+# Worker bounds for source ingestion. PDFs are parsed in child processes
+# (CPU-bound), at most INGEST_PDF_WORKERS at a time across the whole process;
+# URLs are fetched on threads (I/O-bound).
+INGEST_PDF_WORKERS = int(os.getenv("INGEST_PDF_WORKERS", "2"))
+INGEST_URL_WORKERS = int(os.getenv("INGEST_URL_WORKERS", "8"))
+INGEST_SOURCE_TIMEOUT = float(os.getenv("INGEST_SOURCE_TIMEOUT", "60"))
+# Memory bounds: pages and text bytes kept per source, total text bytes kept
+# per course, and how many chunks are embedded per batch. A source's pages are
+# held together once loaded, and at most a pool's worth of sources is loaded
+# ahead of the embedder, so ingestion holds roughly
+# (INGEST_PDF_WORKERS + INGEST_URL_WORKERS + 1) * INGEST_MAX_SOURCE_BYTES of
+# text however many sources a course has.
+INGEST_MAX_PAGES = int(os.getenv("INGEST_MAX_PAGES", "1000"))
+INGEST_MAX_SOURCE_BYTES = int(os.getenv("INGEST_MAX_SOURCE_BYTES", str(5 * 1024 * 1024)))
+INGEST_MAX_TOTAL_BYTES = int(os.getenv("INGEST_MAX_TOTAL_BYTES", str(20 * 1024 * 1024)))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+
+
+def _resolve_pdf_paths(pdf_path: Optional[Union[str, List[str]]]) -> List[str]:
+    """Map stored PDF filenames (media/pdfs/) to existing absolute paths."""
+    from django.conf import settings
+
+    if not pdf_path:
+        return []
+    # Get the base media path from Django settings
+    media_root = settings.MEDIA_ROOT if hasattr(settings, 'MEDIA_ROOT') else 'media'
+    filenames = pdf_path if isinstance(pdf_path, list) else [pdf_path]
+    paths = []
+    for filename in filenames:
+        if not (isinstance(filename, str) and filename):
+            continue
+        full_path = os.path.join(media_root, "pdfs", filename)
+        if os.path.isfile(full_path):
+            paths.append(full_path)
+        else:
+            logging.warning(f"PDF file not found: {full_path}")
+    return paths
+
+
+def _parse_website_urls(website_url: Union[str, List[str], None]) -> List[str]:
+    """Accept a single URL, a JSON-encoded list of URLs or a list."""
+    if not website_url:
+        return []
+    try:
+        if isinstance(website_url, str):
+            urls = json.loads(website_url) if website_url.startswith('[') else [website_url]
+        else:
+            urls = website_url if isinstance(website_url, list) else [website_url]
+    except Exception as e:
+        logging.error(f"Error processing website URLs: {e}")
+        return []
+    return [url for url in urls if url]
+
+
+def iter_pdf_pages(
+        full_path: str,
+        max_pages: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+) -> Iterator[Document]:
+    """Yield a PDF's pages one at a time, stopping at the page or text byte cap.
+
+    Pages are parsed lazily, so the generator itself only holds the current page.
+    """
+    max_pages = INGEST_MAX_PAGES if max_pages is None else max_pages
+    max_bytes = INGEST_MAX_SOURCE_BYTES if max_bytes is None else max_bytes
+    collected = 0
+    for page_number, page in enumerate(PyPDFLoader(full_path).lazy_load()):
+        if page_number >= max_pages:
+            logging.info(f"Stopped reading {full_path} at the {max_pages} page cap")
+            return
+        size = len(page.page_content.encode("utf-8"))
+        if collected + size > max_bytes:
+            logging.info(f"Stopped reading {full_path} at the {max_bytes} byte cap")
+            return
+        collected += size
+        yield page
+
+
+def _load_pdf_source(full_path: str) -> List[Document]:
+    # Module-level so it can be pickled into a worker process. Pages come back
+    # to the parent as one list, which the page and byte caps bound.
+    return list(iter_pdf_pages(full_path))
+
+
+_pdf_slots = threading.BoundedSemaphore(INGEST_PDF_WORKERS)
+_process_context = None
+_process_context_lock = threading.Lock()
+
+
+def _get_process_context():
+    """Return the multiprocessing context PDF parsers are started from.
+
+    Children come from a forkserver (or are spawned where there is none), so
+    they never inherit the web process's threads, locks or connections.
+    """
+    global _process_context
+    with _process_context_lock:
+        if _process_context is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _process_context = multiprocessing.get_context(start_method)
+        return _process_context
+
+
+def _process_main(sender, loader, source) -> None:
+    try:
+        result = (True, loader(source))
+    except Exception as e:
+        result = (False, f"{type(e).__name__}: {e}")
+    sender.send(result)
+    sender.close()
+
+
+def _run_in_process(loader, source, timeout: float):
+    """Run loader(source) in a child process of its own, killed after timeout seconds.
+
+    Each source gets its own child, so killing one that overruns its deadline
+    cannot take down another source's work. Waiting for one of the
+    INGEST_PDF_WORKERS slots counts against the same deadline.
+    """
+    deadline = time.perf_counter() + timeout
+    if not _pdf_slots.acquire(timeout=timeout):
+        raise TimeoutError("source deadline exceeded")
+    try:
+        context = _get_process_context()
+        receiver, sender = context.Pipe(duplex=False)
+        process = context.Process(target=_process_main, args=(sender, loader, source), daemon=True)
+        process.start()
+        sender.close()
+        try:
+            if not receiver.poll(max(0.0, deadline - time.perf_counter())):
+                raise TimeoutError("source deadline exceeded")
+            try:
+                ok, value = receiver.recv()
+            except EOFError:
+                raise RuntimeError(f"PDF parser exited with code {process.exitcode}") from None
+        finally:
+            if process.is_alive():
+                process.kill()
+            process.join()
+            receiver.close()
+    finally:
+        _pdf_slots.release()
+    if not ok:
+        raise RuntimeError(value)
+    return value
+
+
+# Website sources are revalidated against the on-disk URL text cache (see
+# URL_CACHE_ROOT in settings): unchanged pages answer 304 or hash to the same
+# bytes, and trafilatura extraction only runs for pages that actually changed.
+URL_FETCH_CONNECT_TIMEOUT = float(os.getenv("URL_FETCH_CONNECT_TIMEOUT", "5"))
+url_source_stats = Counters("url_sources")
+_source_session: Optional[requests.Session] = None
+_source_session_lock = threading.Lock()
+
+
+def _get_source_session() -> requests.Session:
+    global _source_session
+    with _source_session_lock:
+        if _source_session is None:
+            _source_session = _build_http_session(INGEST_URL_WORKERS)
+        return _source_session
+
+
+def fetch_url_text(url: str) -> str:
+    """Return the main text of a web page, revalidating the cached copy with a conditional GET."""
+    from .caches import url_text_cache
+
+    entry = url_text_cache.get(url)
+    headers = {"User-Agent": "Mozilla/5.0 (compatible; Tezrisat)"}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    response = _get_source_session().get(
+        url,
+        headers=headers,
+        timeout=(URL_FETCH_CONNECT_TIMEOUT, INGEST_SOURCE_TIMEOUT),
+    )
+    if response.status_code == 304 and entry is not None:
+        url_source_stats.increment("not_modified")
+        url_text_cache.touch(url)
+        return entry["text"]
+    response.raise_for_status()
+
+    content_hash = hashlib.sha256(response.content).hexdigest()
+    if entry is not None and entry.get("content_hash") == content_hash:
+        url_source_stats.increment("unchanged")
+        text = entry["text"]
+    else:
+        url_source_stats.increment("extracted")
+        text = trafilatura.extract(response.content) or ""
+    url_text_cache.set(
+        url,
+        text,
+        content_hash,
+        etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+    )
+    return text
+
+
+def _load_url_source(url: str) -> List[Document]:
+    extracted_text = fetch_url_text(url)
+    if not extracted_text:
+        return []
+    encoded = extracted_text.encode("utf-8")
+    if len(encoded) > INGEST_MAX_SOURCE_BYTES:
+        extracted_text = encoded[:INGEST_MAX_SOURCE_BYTES].decode("utf-8", errors="ignore")
+    return [Document(page_content=extracted_text, metadata={"source": url})]
+
+
+def _timed(loader, source: str):
+    started = time.perf_counter()
+    docs = loader(source)
+    return docs, time.perf_counter() - started
+
+
+def iter_finetuning_sources(
+        pdf_path: Optional[Union[str, List[str]]],
+        website_url: Union[str, List[str], None],
+        timeout: Optional[float] = None,
+) -> Iterator[Dict[str, Any]]:
+    """Load PDFs and URLs concurrently on bounded worker threads.
+
+    Yields one result per source, PDFs first and then URLs, each in input
+    order: {"source", "type", "docs", "error", "elapsed"}. A failing or
+    timed-out source only yields an error entry for itself. Only a pool's
+    worth of sources of each type is loaded ahead of the consumer; the next
+    one starts as a result is yielded, so memory does not grow with the
+    number of sources. Closing the generator early cancels sources that have
+    not started yet.
+
+    Each PDF is parsed in a child process of its own (see _run_in_process),
+    which is killed once its source has run for timeout seconds.
+    """
+    timeout = INGEST_SOURCE_TIMEOUT if timeout is None else timeout
+    pdf_paths = _resolve_pdf_paths(pdf_path)
+    urls = _parse_website_urls(website_url)
+    if not pdf_paths and not urls:
+        return
+
+    url_workers = max(1, min(INGEST_URL_WORKERS, len(urls)))
+    pdf_workers = min(INGEST_PDF_WORKERS, len(pdf_paths))
+    thread_pool = ThreadPoolExecutor(max_workers=url_workers + pdf_workers)
+    jobs = [("pdf", path) for path in pdf_paths] + [("url", url) for url in urls]
+    # Per source type: the next job to submit, one past its last job, and how many may be loaded ahead.
+    next_job = {"pdf": 0, "url": len(pdf_paths)}
+    end_job = {"pdf": len(pdf_paths), "url": len(jobs)}
+    ahead = {"pdf": pdf_workers, "url": url_workers}
+    submitted = {}  # job index -> (future, submitted at)
+
+    def submit_next(source_type: str) -> None:
+        index = next_job[source_type]
+        if index == end_job[source_type]:
+            return
+        next_job[source_type] += 1
+        source = jobs[index][1]
+        if source_type == "pdf":
+            future = thread_pool.submit(_timed, lambda path: _run_in_process(_load_pdf_source, path, timeout), source)
+        else:
+            future = thread_pool.submit(_timed, _load_url_source, source)
+        submitted[index] = (future, time.perf_counter())
+
+    try:
+        for source_type, count in ahead.items():
+            for _ in range(count):
+                submit_next(source_type)
+
+        for index, (source_type, source) in enumerate(jobs):
+            future, submitted_at = submitted.pop(index)
+            result = {"source": source, "type": source_type, "docs": [], "error": None, "elapsed": 0.0}
+            try:
+                docs, elapsed = future.result(timeout=max(0.0, submitted_at + timeout - time.perf_counter()))
+                result.update(docs=docs, elapsed=elapsed)
+                logging.info(f"Loaded {source_type} {source}: {len(docs)} documents in {elapsed:.2f}s")
+            except FuturesTimeoutError:
+                future.cancel()
+                result.update(error=f"Timed out after {timeout}s", elapsed=time.perf_counter() - submitted_at)
+                logging.error(f"Timed out loading {source_type} {source}")
+            except Exception as e:
+                result.update(error=str(e), elapsed=time.perf_counter() - submitted_at)
+                logging.error(f"Error loading {source_type} {source}: {e}")
+            submit_next(source_type)
+            yield result
+    finally:
+        thread_pool.shutdown(wait=False, cancel_futures=True)
+        for future, _ in submitted.values():
+            future.cancel()
+
+
+def load_finetuning_sources(
+        pdf_path: Optional[Union[str, List[str]]],
+        website_url: Union[str, List[str], None],
+        timeout: Optional[float] = None,
+) -> List[Dict[str, Any]]:
+    """List form of iter_finetuning_sources."""
+    return list(iter_finetuning_sources(pdf_path, website_url, timeout))
+
+
+def iter_finetuning_docs(
+        pdf_path: Optional[Union[str, List[str]]],
+        website_url: Union[str, List[str], None],
+        max_total_bytes: Optional[int] = None,
+) -> Iterator[Document]:
+    """Yield source documents in order, stopping once enough text has been collected."""
+    max_total_bytes = INGEST_MAX_TOTAL_BYTES if max_total_bytes is None else max_total_bytes
+    collected = 0
+    sources = iter_finetuning_sources(pdf_path, website_url)
+    try:
+        for result in sources:
+            # Pop pages off as they are consumed so embedded ones can be freed.
+            docs = result.pop("docs")
+            docs.reverse()
+            while docs:
+                doc = docs.pop()
+                collected += len(doc.page_content.encode("utf-8"))
+                yield doc
+                if collected >= max_total_bytes:
+                    logging.info(f"Collected {collected} bytes of source text; skipping remaining sources")
+                    return
+    finally:
+        sources.close()
+
+
 def load_finetuning_docs(
         pdf_path: Optional[Union[str, List[str]]],
         website_url: str
@@ -55,93 +424,121 @@ def load_finetuning_docs(
     Returns:
       A list of Document objects.
     """
-    from django.conf import settings
-    
-    docs = []
-    if pdf_path:
-        # Get the base media path from Django settings
-        media_root = settings.MEDIA_ROOT if hasattr(settings, 'MEDIA_ROOT') else 'media'
-        
-        if isinstance(pdf_path, list):
-            for filename in pdf_path:
-                # Construct full path to PDF file
-                if isinstance(filename, str) and filename:
-                    full_path = os.path.join(media_root, "pdfs", filename)
-                    if os.path.isfile(full_path):
-                        try:
-                            loader = PyPDFLoader(full_path)
-                            pdf_docs = loader.load()
-                            docs.extend(pdf_docs)
-                            logging.info(f"Loaded PDF: {full_path}")
-                        except Exception as e:
-                            logging.error(f"Error loading PDF {full_path}: {e}")
-                    else:
-                        logging.warning(f"PDF file not found: {full_path}")
-        else:
-            full_path = os.path.join(media_root, "pdfs", pdf_path)
-            if os.path.isfile(full_path):
-                try:
-                    loader = PyPDFLoader(full_path)
-                    pdf_docs = loader.load()
-                    docs.extend(pdf_docs)
-                    logging.info(f"Loaded PDF: {full_path}")
-                except Exception as e:
-                    logging.error(f"Error loading PDF {full_path}: {e}")
-            else:
-                logging.warning(f"PDF file not found: {full_path}")
-
-    if website_url:
-        try:
-            # Parse website_url which might be JSON
-            if isinstance(website_url, str):
-                urls = json.loads(website_url) if website_url.startswith('[') else [website_url]
-            else:
-                urls = website_url if isinstance(website_url, list) else [website_url]
-            
-            for url in urls:
-                if url:
-                    try:
-                        logging.info(f"Fetching content from: {url}")
-                        downloaded = trafilatura.fetch_url(url)
-                        if downloaded:
-                            extracted_text = trafilatura.extract(downloaded)
-                            if extracted_text:
-                                docs.append(Document(page_content=extracted_text, metadata={"source": url}))
-                    except Exception as e:
-                        logging.error(f"Error fetching content from {url}: {e}")
-        except Exception as e:
-            logging.error(f"Error processing website URLs: {e}")
-    
-    return docs
+    return list(iter_finetuning_docs(pdf_path, website_url))
 
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.callbacks.manager import CallbackManager
-def call_llm(prompt: str, openai_api_key: str) -> str:
-    """Call OpenAI LLM with the provided prompt and return the text output."""
-    try:
-        llm = ChatOpenAI(
-            model="gpt-3.5-turbo",
-            temperature=0.7,
-            max_tokens=1024,
+LLM_MODEL = "gpt-3.5-turbo"
+LLM_TEMPERATURE = 0.7
+LLM_MAX_TOKENS = 1024
+# Ask the provider for a syntactically valid JSON object (OpenAI JSON mode) on
+# calls whose output is parsed against a schema. Disable for models without it.
+LLM_JSON_MODE = os.getenv("LLM_JSON_MODE", "true").lower() in ("1", "true", "yes")
+
+
+def get_llm(openai_api_key: str, json_mode: bool = False, loop=None) -> ChatOpenAI:
+    """Return the shared ChatOpenAI client for this key, so its connection pool is reused across calls.
+
+    The SDK's own retries are off, so they do not multiply the attempts made by
+    retry_generate and aretry_generate around the section generators.
+    """
+    model_kwargs = {"response_format": {"type": "json_object"}} if json_mode else {}
+    return get_chat_client(
+        (openai_api_key, LLM_MODEL, LLM_TEMPERATURE, LLM_MAX_TOKENS, json_mode),
+        lambda: ChatOpenAI(
+            model=LLM_MODEL,
+            temperature=LLM_TEMPERATURE,
+            max_tokens=LLM_MAX_TOKENS,
             api_key=openai_api_key,
-        )
+            model_kwargs=model_kwargs,
+            max_retries=0,
+        ),
+        loop=loop,
+    )
+
+
+def _llm_response_cache():
+    """Return the shared LLM response cache, or None when LLM_CACHE_ENABLED is off."""
+    from django.conf import settings
+    from .caches import llm_response_cache
+
+    return llm_response_cache if getattr(settings, "LLM_CACHE_ENABLED", True) else None
+
+
+def _llm_cache_key(prompt: str, json_mode: bool = False) -> str:
+    from .caches import LLMResponseCache
+
+    model = f"{LLM_MODEL}:json" if json_mode else LLM_MODEL
+    return LLMResponseCache.make_key(model, LLM_TEMPERATURE, LLM_MAX_TOKENS, prompt)
+
+
+def forget_llm_response(prompt: str) -> None:
+    """Drop cached responses, e.g. because one failed to parse and is about to be regenerated."""
+    cache = _llm_response_cache()
+    if cache is not None:
+        cache.delete(_llm_cache_key(prompt))
+        cache.delete(_llm_cache_key(prompt, json_mode=True))
+
+
+def call_llm(prompt: str, openai_api_key: str, use_cache: bool = True, json_mode: bool = False) -> str:
+    """Call OpenAI LLM with the provided prompt and return the text output.
+
+    Responses are served from and stored in the LLM response cache unless use_cache is False.
+    With json_mode the provider is asked for a JSON object (the prompt must mention JSON).
+    """
+    cache = _llm_response_cache() if use_cache else None
+    if cache is not None:
+        cached = cache.get(_llm_cache_key(prompt, json_mode))
+        if cached is not None:
+            return cached
+    try:
+        llm = get_llm(openai_api_key, json_mode)
         response = llm.invoke(prompt)
         output = response.content if hasattr(response, 'content') else str(response)
-        return output
     except Exception as e:
         logging.error(f"Error calling LLM: {e}")
         raise
+    if cache is not None:
+        cache.set(_llm_cache_key(prompt, json_mode), output)
+    return output
 
 
-def document_relevancy_check(topic: str, text: str, openai_api_key: str, max_length: int = 1000) -> Dict[str, Any]:
+def stream_llm(prompt: str, openai_api_key: str, use_cache: bool = True, json_mode: bool = False) -> Iterator[str]:
+    """Like call_llm, but yield the text output chunk by chunk as the model produces it.
+
+    A cached response is yielded as a single chunk.
+    """
+    cache = _llm_response_cache() if use_cache else None
+    if cache is not None:
+        cached = cache.get(_llm_cache_key(prompt, json_mode))
+        if cached is not None:
+            yield cached
+            return
+    chunks = []
+    try:
+        llm = get_llm(openai_api_key, json_mode)
+        for chunk in llm.stream(prompt):
+            text = chunk.content if hasattr(chunk, 'content') else str(chunk)
+            chunks.append(text)
+            yield text
+    except Exception as e:
+        logging.error(f"Error calling LLM: {e}")
+        raise
+    if cache is not None:
+        cache.set(_llm_cache_key(prompt, json_mode), "".join(chunks))
+
+
+def _relevancy_prompt(topic: str, text: str, max_length: int = 1000) -> str:
     # Truncate the text to avoid huge prompts
     truncated_text = text if len(text) <= max_length else text[:max_length] + "..."
-    prompt = f"""Is the following text relevant to "{topic}"?
+    return f"""Is the following text relevant to "{topic}"?
     Text: '''{truncated_text}'''
     Answer as JSON: {{"relevant": "yes" or "no", "score": number between 0 and 1, "reason": "brief explanation"}}
     """
-    output = call_llm(prompt, openai_api_key)
+
+
+def _parse_relevancy_output(output: str) -> Dict[str, Any]:
     try:
         return json.loads(output)
     except Exception as e:
@@ -149,108 +546,434 @@ def document_relevancy_check(topic: str, text: str, openai_api_key: str, max_len
         return {"relevant": "no", "score": 0, "reason": "Parsing error"}
 
 
-def filter_relevant_docs(topic: str, docs: List[Document], openai_api_key: str, threshold: float = 0.5, max_length: int = 1000) -> List[Document]:
+def document_relevancy_check(topic: str, text: str, openai_api_key: str, max_length: int = 1000) -> Dict[str, Any]:
+    output = call_llm(_relevancy_prompt(topic, text, max_length), openai_api_key)
+    return _parse_relevancy_output(output)
+
+
+def batch_document_relevancy_check(topic: str, texts: List[str], openai_api_key: str, max_length: int = 1000) -> List[Dict[str, Any]]:
+    """Score several texts for relevancy in a single LLM call.
+
+    Returns one {"relevant", "score", "reason"} dict per text, in input order.
+    Raises ValueError if the response cannot be parsed.
+    """
+    if not texts:
+        return []
+    output = call_llm(_batch_relevancy_prompt(topic, texts, max_length), openai_api_key)
+    return _parse_batch_relevancy_output(output, len(texts))
+
+
+def _batch_relevancy_prompt(topic: str, texts: List[str], max_length: int = 1000) -> str:
+    blocks = []
+    for index, text in enumerate(texts):
+        truncated_text = text if len(text) <= max_length else text[:max_length] + "..."
+        blocks.append(f"Text {index}: '''{truncated_text}'''")
+    joined_blocks = "\n    ".join(blocks)
+    return f"""For each of the following texts, decide whether it is relevant to "{topic}".
+    {joined_blocks}
+    Answer as a JSON array with exactly one object per text, in order:
+    [{{"index": text number, "relevant": "yes" or "no", "score": number between 0 and 1, "reason": "brief explanation"}}]
+    Do not include any additional commentary.
+    """
+
+
+def _parse_batch_relevancy_output(output: str, count: int) -> List[Dict[str, Any]]:
+    start = output.find('[')
+    end = output.rfind(']')
+    if start == -1 or end <= start:
+        raise ValueError(f"Batch relevancy output is not a JSON array: {output}")
+    data = json.loads(output[start:end + 1])
+    by_index = {}
+    for position, item in enumerate(data):
+        if isinstance(item, dict):
+            by_index[int(item.get("index", position))] = {
+                "relevant": item.get("relevant", "no"),
+                "score": item.get("score", 0),
+                "reason": item.get("reason", ""),
+            }
+    return [
+        by_index.get(index, {"relevant": "no", "score": 0, "reason": "Missing from batch response"})
+        for index in range(count)
+    ]
+
+
+# How filter_relevant_docs scores candidates: "batch" (one LLM call for all
+# chunks), "concurrent" (one call per chunk, in parallel) or "sequential".
+RELEVANCY_MODE = os.getenv("RELEVANCY_MODE", "batch")
+RELEVANCY_MAX_CONCURRENCY = int(os.getenv("RELEVANCY_MAX_CONCURRENCY", "4"))
+
+
+def score_documents_relevancy(
+        topic: str,
+        docs: List[Document],
+        openai_api_key: str,
+        max_length: int = 1000,
+        mode: Optional[str] = None,
+        max_concurrency: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Return a {"relevant", "score", "reason"} result per document, in input order."""
+    mode = mode or RELEVANCY_MODE
+    max_concurrency = max_concurrency or RELEVANCY_MAX_CONCURRENCY
+    if not docs:
+        return []
+    texts = [doc.page_content for doc in docs]
+    if mode == "batch":
+        try:
+            return batch_document_relevancy_check(topic, texts, openai_api_key, max_length)
+        except Exception as e:
+            logging.error(f"Batch relevancy check failed, scoring documents individually: {e}")
+            mode = "concurrent"
+    if mode == "concurrent" and len(texts) > 1:
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(texts))) as executor:
+            # The checks read and write the LLM response cache.
+            return list(executor.map(
+                with_db_connections(lambda text: document_relevancy_check(topic, text, openai_api_key, max_length)),
+                texts,
+            ))
+    return [document_relevancy_check(topic, text, openai_api_key, max_length) for text in texts]
+
+
+# Chunks whose embedding similarity to the topic is at or above the accept
+# threshold are kept, and those below the reject threshold dropped, without
+# asking the LLM. Only the band in between goes to document_relevancy_check.
+RELEVANCY_ACCEPT_SIMILARITY = float(os.getenv("RELEVANCY_ACCEPT_SIMILARITY", "0.85"))
+RELEVANCY_REJECT_SIMILARITY = float(os.getenv("RELEVANCY_REJECT_SIMILARITY", "0.75"))
+
+relevancy_prefilter_stats = Counters("relevancy_prefilter")
+
+
+def distances_to_similarities(distances: Iterable[float]) -> np.ndarray:
+    """Convert Chroma's squared L2 distances to cosine similarities.
+
+    OpenAI embeddings are unit length, so ||a - b||^2 = 2 - 2 cos(a, b).
+    """
+    return 1.0 - np.asarray(list(distances), dtype=float) / 2.0
+
+
+def prefilter_by_similarity(
+        docs_and_scores: List[Tuple[Document, float]],
+        accept_threshold: Optional[float] = None,
+        reject_threshold: Optional[float] = None,
+) -> Tuple[List[Document], List[Document]]:
+    """Split retrieved chunks into (accepted, ambiguous) by embedding similarity.
+
+    Clearly irrelevant chunks are dropped. Counters record how many chunks were
+    decided locally and how many per-chunk LLM checks that saved.
+    """
+    accept_threshold = RELEVANCY_ACCEPT_SIMILARITY if accept_threshold is None else accept_threshold
+    reject_threshold = RELEVANCY_REJECT_SIMILARITY if reject_threshold is None else reject_threshold
+    if not docs_and_scores:
+        return [], []
+    docs = [doc for doc, _ in docs_and_scores]
+    similarities = distances_to_similarities(score for _, score in docs_and_scores)
+    accepted_mask = similarities >= accept_threshold
+    ambiguous_mask = ~accepted_mask & (similarities >= reject_threshold)
+    accepted = [docs[i] for i in np.flatnonzero(accepted_mask)]
+    ambiguous = [docs[i] for i in np.flatnonzero(ambiguous_mask)]
+
+    decided_locally = len(docs) - len(ambiguous)
+    relevancy_prefilter_stats.increment("accepted", len(accepted))
+    relevancy_prefilter_stats.increment("rejected", decided_locally - len(accepted))
+    relevancy_prefilter_stats.increment("sent_to_llm", len(ambiguous))
+    relevancy_prefilter_stats.increment("llm_calls_avoided", decided_locally)
+    return accepted, ambiguous
+
+
+def filter_relevant_docs(
+        topic: str,
+        docs: List[Document],
+        openai_api_key: str,
+        threshold: float = 0.5,
+        max_length: int = 1000,
+        mode: Optional[str] = None,
+        max_concurrency: Optional[int] = None,
+) -> List[Document]:
+    results = score_documents_relevancy(topic, docs, openai_api_key, max_length, mode, max_concurrency)
+    return _select_relevant_docs(docs, results, threshold)
+
+
+def _select_relevant_docs(docs: List[Document], results: List[Dict[str, Any]], threshold: float) -> List[Document]:
     relevant_docs = []
-    for doc in docs:
-        logging.info("Processing doc for relevancy check.")
-        result = document_relevancy_check(topic, doc.page_content, openai_api_key, max_length)
+    for doc, result in zip(docs, results):
         logging.info("Result from relevancy check: " + str(result))
-        if result.get("relevant", "no").lower() == "yes" and float(result.get("score", 0)) >= threshold:
+        if str(result.get("relevant", "no")).lower() == "yes" and float(result.get("score", 0)) >= threshold:
             relevant_docs.append(doc)
         else:
             logging.info(f"Filtered out doc: Score={result.get('score', 0)} Reason: {result.get('reason', '')}")
     return relevant_docs
 
 
-def get_finetuning_context(topic: str, pdf_path: Optional[Union[str, List[str]]], website_url: str, openai_api_key: str) -> str:
-    docs = load_finetuning_docs(pdf_path, website_url)
-    if not docs:
-        return ""
+def get_embeddings(openai_api_key: str) -> CacheBackedEmbeddings:
+    """Return OpenAI embeddings wrapped in the persistent embedding cache.
+
+    Cache keys combine the embedding model name with a hash of the text, so only
+    chunks that were never embedded with this model go over the wire.
+    """
+    from .caches import DatabaseByteStore
+
+    underlying = OpenAIEmbeddings(api_key=openai_api_key)
+    return CacheBackedEmbeddings.from_bytes_store(
+        underlying,
+        DatabaseByteStore(),
+        namespace=underlying.model,
+        query_embedding_cache=True,
+    )
+
+
+def _course_index_path(index_id: str) -> str:
+    from django.conf import settings
+
+    root = getattr(settings, "VECTOR_STORE_ROOT", "vectorstores")
+    return os.path.join(root, index_id)
+
+
+def _course_collection_name(index_id: str) -> str:
+    return f"microcourse_{index_id}"
+
+
+def _index_documents(
+        docs: Iterable[Document],
+        collection_name: str,
+        openai_api_key: str,
+        persist_directory: Optional[str] = None,
+) -> Tuple[Optional[Chroma], int]:
+    """Split and embed documents into a Chroma collection in fixed-size batches.
+
+    Documents are consumed lazily and embedded EMBEDDING_BATCH_SIZE chunks at
+    a time; how much source text is loaded ahead of them is bounded by
+    iter_finetuning_sources. Returns (None, 0) if no chunks were produced.
+    """
     splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=100)
-    docs_chunks = splitter.split_documents(docs)
-    embeddings = OpenAIEmbeddings(api_key=openai_api_key)
-    vectorstore = Chroma.from_documents(docs_chunks, collection_name="microcourse", embedding=embeddings, persist_directory=".")
+    vectorstore = None
+    chunk_count = 0
+    batch = []
+
+    def flush(chunks: List[Document]) -> None:
+        nonlocal vectorstore, chunk_count
+        if vectorstore is None:
+            vectorstore = Chroma(
+                collection_name=collection_name,
+                embedding_function=get_embeddings(openai_api_key),
+                persist_directory=persist_directory,
+            )
+        vectorstore.add_documents(chunks)
+        chunk_count += len(chunks)
+
+    for doc in docs:
+        batch.extend(splitter.split_documents([doc]))
+        while len(batch) >= EMBEDDING_BATCH_SIZE:
+            flush(batch[:EMBEDDING_BATCH_SIZE])
+            batch = batch[EMBEDDING_BATCH_SIZE:]
+    if batch:
+        flush(batch)
+    return vectorstore, chunk_count
+
+
+def build_course_vectorstore(index_id: str, pdf_path: Optional[Union[str, List[str]]], website_url: str, openai_api_key: str) -> Optional[Chroma]:
+    """Load, split and embed a course's source documents into its own persisted index.
+
+    Called once when the microcourse is created; later sections and the chat
+    endpoint reopen the index with load_course_vectorstore instead of
+    re-ingesting the sources.
+
+    Returns None when the course has no usable PDFs or URLs.
+    """
+    vectorstore, chunk_count = _index_documents(
+        iter_finetuning_docs(pdf_path, website_url),
+        _course_collection_name(index_id),
+        openai_api_key,
+        persist_directory=_course_index_path(index_id),
+    )
+    if vectorstore is not None:
+        logging.info(f"Built course index {index_id} with {chunk_count} chunks")
+    return vectorstore
+
+
+def load_course_vectorstore(index_id: str, openai_api_key: str) -> Optional[Chroma]:
+    """Reopen a course index built by build_course_vectorstore, or None if it does not exist."""
+    if not index_id or not os.path.isdir(_course_index_path(index_id)):
+        return None
+    return Chroma(
+        collection_name=_course_collection_name(index_id),
+        embedding_function=get_embeddings(openai_api_key),
+        persist_directory=_course_index_path(index_id),
+    )
+
+
+def delete_course_vectorstore(index_id: str) -> None:
+    if index_id:
+        shutil.rmtree(_course_index_path(index_id), ignore_errors=True)
+
+
+# Token budget for the retrieved source context packed into each generation prompt.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+
+def pack_context_docs(docs: List[Document], token_budget: Optional[int] = None) -> str:
+    """Join ranked docs into prompt context, keeping whole chunks within the token budget."""
+    token_budget = CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    packed = pack_context((doc.page_content for doc in docs), token_budget, LLM_MODEL)
+    logging.info(
+        f"Packed {packed.chunks} context chunks into {packed.tokens}/{token_budget} tokens "
+        f"({packed.skipped} over budget, {packed.duplicates} duplicates)"
+    )
+    return packed.text
+
+
+def get_finetuning_context(
+        topic: str,
+        pdf_path: Optional[Union[str, List[str]]],
+        website_url: str,
+        openai_api_key: str,
+        vectorstore: Optional[Chroma] = None,
+        token_budget: Optional[int] = None,
+) -> str:
+    """Retrieve relevant source context for a topic, packed into token_budget tokens.
+
+    When a course index is passed in it is queried directly; otherwise the
+    sources are ingested into a throwaway in-memory index. Chunks accepted on
+    similarity alone rank first, followed by those the LLM judged relevant.
+    """
+    from .caches import embedding_cache_stats
+
+    if vectorstore is None:
+        vectorstore, _ = _index_documents(
+            iter_finetuning_docs(pdf_path, website_url),
+            _course_collection_name(uuid4().hex),
+            openai_api_key,
+        )
+        if vectorstore is None:
+            return ""
     try:
-        retrieved_docs = vectorstore.similarity_search(topic, k=5)
+        docs_and_scores = vectorstore.similarity_search_with_score(topic, k=5)
+        accepted_docs, ambiguous_docs = prefilter_by_similarity(docs_and_scores)
     except AttributeError:
-        retrieved_docs = vectorstore.get_relevant_documents(topic)
-    filtered_docs = filter_relevant_docs(topic, retrieved_docs, openai_api_key, threshold=0.5)
+        accepted_docs, ambiguous_docs = [], vectorstore.get_relevant_documents(topic)
+    logging.info(f"Embedding cache stats: {embedding_cache_stats.snapshot()}")
+    filtered_docs = accepted_docs + filter_relevant_docs(topic, ambiguous_docs, openai_api_key, threshold=0.5)
+    logging.info(f"Relevancy pre-filter stats: {relevancy_prefilter_stats.snapshot()}")
     if not filtered_docs:
         return ""
-    context = "\n\n".join([doc.page_content for doc in filtered_docs])
-    return context
+    return pack_context_docs(filtered_docs, token_budget)
 
 
 # ------------------------------
 # Generation Retry Mechanism
 # ------------------------------
 def _generate_main_section(prompt: str, openai_api_key: str):
-    output = call_llm(prompt, openai_api_key)
-    try:
-        data = json.loads(output)
-        data["token_usage"] = 0
-        return data, None
-    except Exception as e:
-        return None, f"Error parsing main section JSON. Raw output:\n{output}\nException: {e}"
+    return _parse_main_section(call_llm(prompt, openai_api_key, json_mode=LLM_JSON_MODE))
+
 
+def _parse_main_section(output: str):
+    data, error = parse_structured_output(output, MAIN_SECTION_SCHEMA)
+    if data is not None:
+        data["token_usage"] = 0
+    return data, error
 
 
 def _generate_code_examples(prompt: str, openai_api_key: str):
-    output = call_llm(prompt, openai_api_key)
-    try:
-        data = json.loads(output)
-        if not isinstance(data, list):
-            raise ValueError("Output is not a JSON array")
-        return data, None
-    except Exception as e:
-        # Try to extract JSON array substring from output
-        start = output.find('[')
-        end = output.rfind(']')
-        if start != -1 and end != -1 and end > start:
-            substring = output[start:end + 1]
-            try:
-                data = json.loads(substring)
-                if not isinstance(data, list):
-                    raise ValueError("Extracted output is not a JSON array")
-                return data, None
-            except Exception as e2:
-                return None, f"Error parsing code examples JSON after extraction. Substring:\n{substring}\nOriginal output:\n{output}\nException: {e2}"
-        return None, f"Error parsing code examples JSON. Raw output:\n{output}\nException: {e}"
+    return _parse_code_examples(call_llm(prompt, openai_api_key, json_mode=LLM_JSON_MODE))
+
+
+def _parse_code_examples(output: str):
+    return parse_structured_output(output, CODE_EXAMPLES_SCHEMA)
 
 
 def _generate_math_expressions(prompt: str, openai_api_key: str):
-    output = call_llm(prompt, openai_api_key)
+    return _parse_math_expressions(call_llm(prompt, openai_api_key, json_mode=LLM_JSON_MODE))
+
+
+def _parse_math_expressions(output: str):
+    return parse_structured_output(output, MATH_EXPRESSIONS_SCHEMA)
+
+
+# Retry policy for LLM calls. Rate limits and transient network/server errors
+# back off exponentially with jitter (honouring Retry-After); unparseable output
+# is first repaired locally and only regenerated when repair fails.
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "30"))
+
+
+def classify_llm_error(error: Exception) -> str:
+    """Return "rate_limit", "transient" or "fatal" for an exception raised by an LLM call."""
+    if isinstance(error, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(error, (openai.APIConnectionError, openai.InternalServerError)):
+        return "transient"
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, TimeoutError, ConnectionError)):
+        return "transient"
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429:
+        return "rate_limit"
+    if status_code is not None and status_code >= 500:
+        return "transient"
+    return "fatal"
+
+
+def _retry_after_seconds(error: Exception) -> Optional[float]:
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
     try:
-        data = json.loads(output)
-        if not isinstance(data, list):
-            raise ValueError("Output is not a JSON array")
-        return data, None
-    except Exception as e:
-        # Attempt to extract a JSON array substring from the output
-        start = output.find('[')
-        end = output.rfind(']')
-        if start != -1 and end != -1 and end > start:
-            substring = output[start:end+1]
-            try:
-                data = json.loads(substring)
-                if not isinstance(data, list):
-                    raise ValueError("Extracted output is not a JSON array")
-                return data, None
-            except Exception as e2:
-                return None, f"Error parsing math expressions JSON after extraction. Substring:\n{substring}\nOriginal output:\n{output}\nException: {e2}"
-        return None, f"Error parsing math expressions JSON. Raw output:\n{output}\nException: {e}"
-
-
-def retry_generate(generate_func, prompt: str, openai_api_key: str, max_retries: int = 3, delay: int = 1):
-    attempts = 0
-    while attempts < max_retries:
-        data, error = generate_func(prompt, openai_api_key)
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def llm_retry_delay(error: Exception, attempt: int, base_delay: Optional[float] = None) -> float:
+    """Seconds to wait before retrying after error on the given (0-based) attempt."""
+    base_delay = LLM_RETRY_BASE_DELAY if base_delay is None else base_delay
+    delay = min(LLM_RETRY_MAX_DELAY, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+    retry_after = _retry_after_seconds(error)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, LLM_RETRY_MAX_DELAY))
+    return delay
+
+
+def llm_retry_wait(error: Exception, attempt: int, max_retries: int, base_delay: Optional[float] = None) -> float:
+    """Seconds to back off after a failed LLM call, or re-raise error if it should not be retried.
+
+    Fatal errors, and any error on the last of max_retries attempts, are
+    counted as "<kind>_failed" and raised; the rest are counted as "<kind>_retry".
+    """
+    kind = classify_llm_error(error)
+    if kind == "fatal" or attempt == max_retries - 1:
+        llm_output_stats.increment(f"{kind}_failed")
+        raise error
+    wait = llm_retry_delay(error, attempt, base_delay)
+    llm_output_stats.increment(f"{kind}_retry")
+    logging.warning(f"LLM call failed ({kind}): {error} - Retrying in {wait:.1f}s ({attempt + 1}/{max_retries})")
+    return wait
+
+
+def retry_generate(generate_func, prompt: str, openai_api_key: str, max_retries: int = 3, delay: Optional[float] = None):
+    """Call generate_func until it returns parseable data, retrying LLM errors by kind.
+
+    Rate limits and transient errors are retried after llm_retry_delay; other
+    exceptions, and the last one once attempts run out, propagate. Output that
+    could not be parsed (even after repair) is regenerated straight away.
+    """
+    for attempt in range(max_retries):
+        try:
+            data, error = generate_func(prompt, openai_api_key)
+        except Exception as e:
+            time.sleep(llm_retry_wait(e, attempt, max_retries, delay))
+            continue
         if error is None:
             return data, None
-        else:
-            logging.error(f"Error encountered: {error} - Retrying ({attempts + 1}/{max_retries})")
-            attempts += 1
-            time.sleep(delay)
+        logging.error(f"Error encountered: {error} - Retrying ({attempt + 1}/{max_retries})")
+        llm_output_stats.increment("parse_retry")
+        # Don't let the unusable response be served again from the cache.
+        forget_llm_response(prompt)
+    llm_output_stats.increment("parse_failed")
     return None, f"Failed after {max_retries} attempts."
 
 
@@ -258,13 +981,20 @@ def retry_generate(generate_func, prompt: str, openai_api_key: str, max_retries:
 # Hallucination Detection
 # ------------------------------
 def hallucination_detection(response: str, context: str, openai_api_key: str) -> Dict[str, Any]:
-    prompt = f"""
+    output = call_llm(_hallucination_prompt(response, context), openai_api_key)
+    return _parse_hallucination_output(output)
+
+
+def _hallucination_prompt(response: str, context: str) -> str:
+    return f"""
     Based on the following context: '''{context}''', and the given response: '''{response}''', determine if any parts of the response are hallucinated (i.e., not supported by the context). 
     Answer in JSON with the following format:
     {{"hallucination_detected": "yes" or "no", "details": "brief explanation if any, or empty string if none"}}
     Do not include any additional commentary.
     """
-    output = call_llm(prompt, openai_api_key)
+
+
+def _parse_hallucination_output(output: str) -> Dict[str, Any]:
     try:
         data = json.loads(output)
         return data
@@ -276,159 +1006,141 @@ def hallucination_detection(response: str, context: str, openai_api_key: str) ->
 # ------------------------------
 # Microcourse Generation Functions
 # ------------------------------
-def generate_introduction_section(topic: str, finetune_context: str, openai_api_key: str) -> Dict[str, Any]:
-    extra_context = (
-        f"\n\nAdditional fine-tuning context extracted from provided documents:\n{finetune_context}\n\n"
-        if finetune_context else ""
-    )
-    prompt_main = f"""
-    You are an expert educator creating a microcourse on the topic: {topic}.
-    {extra_context}Please generate only one section, which is the Introduction.
-    Include the following fields:
-    - "section_title": a title for the section.
-    - "content": the main text of the introduction.
-    - "recall_notes": a list of key recall notes.
-    - "vocabulary": an object mapping key terms to their definitions.
-    - "quiz": an object containing:
-         - "question": a quiz question related to the section content.
-         - "options": an object with four answer options labeled "A", "B", "C", and "D".
-         - "correct_answer": the letter representing the correct answer.
-         - "generate_code": True if code examples are relevant for this section, False otherwise.
-         - "generate_math": True if math expressions are relevant for this section, False otherwise.
-    Do NOT include any code examples or math expressions.
-    IMPORTANT: Your output MUST be valid, complete JSON with no additional commentary.
-    Output ONLY the JSON object exactly in the following format:
-
-    {{
-      "section_title": "Introduction",
-      "content": "Your introduction text here.",
-      "recall_notes": ["recall note 1", "recall note 2", "..."],
-      "vocabulary": {{
-          "word1": "definition1",
-          "word2": "definition2",
-          "..."
-      }},
-      "quiz": {{
-          "question": "Your quiz question here.",
-          "options": {{
-              "A": "Option A",
-              "B": "Option B",
-              "C": "Option C",
-              "D": "Option D"
-          }},
-          "correct_answer": "A"
-      }},
-      "generate_code": True,
-      "generate_math": True
-    }}
-
-    Ensure the JSON starts with {{ and ends with }}.
-    """
-    main_section, error_main = retry_generate(
-        _generate_main_section,
-        prompt_main,
+def generate_code_examples_section(topic: str, openai_api_key: str) -> List[Dict[str, str]]:
+    code_examples, error_code = retry_generate(
+        _generate_code_examples,
+        _code_examples_prompt(topic),
         openai_api_key,
     )
-    if error_main:
-        raise Exception(error_main)
-    return main_section
+    if error_code:
+        raise Exception(error_code)
+    return code_examples
 
 
-def generate_code_examples_section(topic: str, openai_api_key: str) -> List[Dict[str, str]]:
-    prompt_code = f"""
+def _code_examples_prompt(topic: str) -> str:
+    return f"""
     You are an expert educator creating a microcourse on the topic: {topic}.
     Based on the section generated above, please provide code examples that illustrate key concepts.
-    Output ONLY a JSON array of code examples. Each code example should be a JSON object with:
+    Output ONLY a JSON object of the form {{"code_examples": [...]}}, where each code example is a JSON object with:
     - "description": a brief explanation.
     - "code": the code snippet.
     IMPORTANT: Represent newline characters as the escape sequence \\n.
-    If no code examples are relevant, output an empty array: [].
+    If no code examples are relevant, output an empty array: {{"code_examples": []}}.
     Do not include any additional commentary.
     """
-    code_examples, error_code = retry_generate(
-        _generate_code_examples,
-        prompt_code,
-        openai_api_key,
-    )
-    if error_code:
-        raise Exception(error_code)
-    return code_examples
 
 
-def _generate_math_expressions_refined(prompt: str, openai_api_key: str):
-    """Refined function to parse JSON arrays for math expressions, or return an empty array if none."""
-    output = call_llm(prompt, openai_api_key)
-    try:
-        data = json.loads(output)
-        if not isinstance(data, list):
-            raise ValueError("Output is not a JSON array")
-        return data, None
-    except Exception as e:
-        start = output.find('[')
-        end = output.rfind(']')
-        if start != -1 and end != -1 and end > start:
-            substring = output[start:end+1]
-            try:
-                data = json.loads(substring)
-                if not isinstance(data, list):
-                    raise ValueError("Extracted output is not a JSON array")
-                return data, None
-            except Exception as e2:
-                return None, f"Error parsing math expressions JSON after extraction.\nSubstring:\n{substring}\nException: {e2}"
-        return None, f"Error parsing math expressions JSON. Output:\n{output}\nException: {e}"
-
 def generate_math_expressions_section(topic: str, content: str, openai_api_key: str) -> List[Dict[str, str]]:
     """
     Produces math expressions relevant to the topic and main content.
     If math expressions are not relevant, returns an empty array (i.e. []).
     Each expression is an object with "description" and "expression" (LaTeX).
     """
+    math_expressions, error = retry_generate(
+        _generate_math_expressions,
+        _math_expressions_prompt(topic, content),
+        openai_api_key,
+    )
+    if error:
+        raise Exception(error)
+    return math_expressions
+
+
+def _math_expressions_prompt(topic: str, content: str) -> str:
     # This prompt instructs the LLM to check if math expressions make sense.
-    # If they are irrelevant, produce an empty JSON array: []
-    refined_prompt = f"""
+    # If they are irrelevant, produce an empty list: {"math_expressions": []}
+    return f"""
     You are an expert educator focusing on correctness. 
     Topic: "{topic}"
     Content: "{content}"
     
     Only provide math expressions if they are truly relevant to the above topic AND content. 
-    If not relevant, output an empty array: []
+    If not relevant, output an empty array: {{"math_expressions": []}}
     
-    Format: A JSON array of objects, each with:
+    Format: A JSON object {{"math_expressions": [...]}} whose array holds objects, each with:
     - "description": a brief explanation
     - "expression": a short LaTeX expression
     
     No commentary or extra text, just valid JSON. Example:
-    [
-      {{
-        "description": "Brief explanation",
-        "expression": "$x^2 + y^2 = z^2$"
-      }}
-    ]
+    {{
+      "math_expressions": [
+        {{
+          "description": "Brief explanation",
+          "expression": "$x^2 + y^2 = z^2$"
+        }}
+      ]
+    }}
         """
-    math_expressions, error = retry_generate(
-        _generate_math_expressions_refined,
-        refined_prompt,
-        openai_api_key,
-    )
-    if error:
-        raise Exception(error)
-    return math_expressions
 
 
-import requests
+SERPAPI_SEARCH_URL = "https://serpapi.com/search"
+# Connect/read timeouts (seconds) for SerpAPI requests. Results are cached per
+# query (see WEB_SEARCH_CACHE_TTL in settings) so later sections reuse them.
+WEB_SEARCH_CONNECT_TIMEOUT = float(os.getenv("WEB_SEARCH_CONNECT_TIMEOUT", "3"))
+WEB_SEARCH_READ_TIMEOUT = float(os.getenv("WEB_SEARCH_READ_TIMEOUT", "10"))
+_web_search_session: Optional[requests.Session] = None
+_web_search_session_lock = threading.Lock()
+
+
+def _build_http_session(pool_maxsize: int) -> requests.Session:
+    session = requests.Session()
+    retry = Retry(total=2, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=["GET"])
+    adapter = HTTPAdapter(pool_maxsize=pool_maxsize, max_retries=retry)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _get_web_search_session() -> requests.Session:
+    """Return the process-wide session, so SerpAPI connections are kept alive between searches."""
+    global _web_search_session
+    with _web_search_session_lock:
+        if _web_search_session is None:
+            _web_search_session = _build_http_session(INGEST_URL_WORKERS)
+        return _web_search_session
+
+
+def _web_search_cache_key(query: str) -> str:
+    params = _web_search_params(query, "")
+    params.pop("api_key")
+    return json.dumps(params, sort_keys=True)
 
 
 def perform_web_search(query: str, api_key: str) -> str:
+    """Return SerpAPI result snippets for query, or "" if there is no key or the search fails."""
     if not api_key:
         return ""
-    params = {
+    from .caches import web_search_cache
+
+    cache_key = _web_search_cache_key(query)
+    cached = web_search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    try:
+        response = _get_web_search_session().get(
+            SERPAPI_SEARCH_URL,
+            params=_web_search_params(query, api_key),
+            timeout=(WEB_SEARCH_CONNECT_TIMEOUT, WEB_SEARCH_READ_TIMEOUT),
+        )
+        response.raise_for_status()
+        snippets = _extract_snippets(response.json())
+    except (requests.RequestException, ValueError) as e:
+        logging.error(f"Web search failed for {query!r}: {e}")
+        return ""
+    web_search_cache.set(cache_key, snippets)
+    return snippets
+
+
+def _web_search_params(query: str, api_key: str) -> Dict[str, str]:
+    return {
         "engine": "google",
         "q": query,
         "api_key": api_key,
         "num": "5",
     }
-    response = requests.get("https://serpapi.com/search", params=params)
-    data = response.json()
+
+
+def _extract_snippets(data: Dict[str, Any]) -> str:
     snippets = [
         result.get("snippet", "")
         for result in data.get("organic_results", [])
@@ -438,34 +1150,73 @@ def perform_web_search(query: str, api_key: str) -> str:
 
 
 
-def generate_microcourse_section(
-    topic: str,
-    pdf_path: list = None,
-    website_url: str = "",
-    is_next_section: bool = False,
-    previous_section: Optional[Dict[str, Any]] = None,
-    openai_api_key: str = "",
-    serpapi_api_key: str = "",
-    wolfram_alpha_appid: str = "",
-) -> Dict[str, Any]:
-    # Use locally processed finetuning context
-    state = {}
-    state["finetune_context"] = get_finetuning_context(
-        topic,
-        pdf_path,
-        website_url,
-        openai_api_key,
-    )
-    # TODO - Solve maximum context length problem
-    MAX_CONTEXT_LENGTH = 500  # Reduced limit to avoid excessive tokens
-    if len(state["finetune_context"]) > MAX_CONTEXT_LENGTH:
-        state["finetune_context"] = state["finetune_context"][:MAX_CONTEXT_LENGTH] + "..."
-    finetune_context = state.get("finetune_context", "")
+# Next-section prompts carry a rolling course summary (Microcourse.summary) instead
+# of the whole previous section, so prompt size stays flat as a course grows.
+# Each section adds one extractive line; to stay under the ceiling the oldest
+# lines are first cut back to their titles and then dropped.
+COURSE_SUMMARY_MAX_TOKENS = int(os.getenv("COURSE_SUMMARY_MAX_TOKENS", "600"))
+SECTION_SUMMARY_MAX_TOKENS = int(os.getenv("SECTION_SUMMARY_MAX_TOKENS", "80"))
+_SUMMARY_GIST_SEPARATOR = " — "
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
 
-    serpapi_key = serpapi_api_key or os.getenv("SERPAPI_API_KEY", "")
-    if wolfram_alpha_appid:
-        os.environ["WOLFRAM_ALPHA_APPID"] = wolfram_alpha_appid
-    web_context = perform_web_search(topic, serpapi_key)
+
+def summarize_section(section: Dict[str, Any], max_tokens: Optional[int] = None) -> str:
+    """Return a one-line extractive summary of a section: title, leading sentences and key terms."""
+    max_tokens = SECTION_SUMMARY_MAX_TOKENS if max_tokens is None else max_tokens
+    title = " ".join(str(section.get("section_title") or "Untitled section").split())
+    vocabulary = section.get("vocabulary") or {}
+    if isinstance(vocabulary, str):
+        # Combined sections carry their structured fields as JSON strings.
+        try:
+            vocabulary = json.loads(vocabulary)
+        except ValueError:
+            vocabulary = {}
+    terms = ", ".join(list(vocabulary)[:5]) if isinstance(vocabulary, dict) else ""
+    suffix = f" (key terms: {terms})" if terms else ""
+
+    budget = max_tokens - count_tokens(f"- {title}{_SUMMARY_GIST_SEPARATOR}{suffix}", LLM_MODEL)
+    gist = ""
+    content = " ".join(str(section.get("content") or "").split())
+    for sentence in _SENTENCE_END.split(content):
+        candidate = f"{gist} {sentence}".strip()
+        if count_tokens(candidate, LLM_MODEL) > budget:
+            break
+        gist = candidate
+    if not gist and content:
+        # The first sentence alone is over budget; keep as many of its words as fit.
+        words = content.split()
+        while words and count_tokens(" ".join(words) + "...", LLM_MODEL) > budget:
+            words = words[:len(words) * 3 // 4]
+        gist = " ".join(words) + "..." if words else ""
+    return f"- {title}{_SUMMARY_GIST_SEPARATOR}{gist}{suffix}" if gist else f"- {title}{suffix}"
+
+
+def extend_course_summary(summary: str, section: Dict[str, Any], max_tokens: Optional[int] = None) -> str:
+    """Append a section's summary line to a course summary, keeping it within max_tokens."""
+    max_tokens = COURSE_SUMMARY_MAX_TOKENS if max_tokens is None else max_tokens
+    lines = [line for line in summary.splitlines() if line.strip()]
+    lines.append(summarize_section(section))
+
+    def too_long() -> bool:
+        return count_tokens("\n".join(lines), LLM_MODEL) > max_tokens
+
+    for index in range(len(lines) - 1):
+        if not too_long():
+            break
+        lines[index] = lines[index].split(_SUMMARY_GIST_SEPARATOR, 1)[0]
+    while len(lines) > 1 and too_long():
+        lines.pop(0)
+    return "\n".join(lines)
+
+
+def _main_section_prompt(
+    topic: str,
+    finetune_context: str,
+    web_context: str,
+    is_next_section: bool,
+    previous_section: Optional[Union[Dict[str, Any], str]],
+    course_summary: str = "",
+) -> str:
     extra_context = f"\n\nAdditional fine-tuning context extracted from provided documents:\n{finetune_context}\n\n" if finetune_context else ""
     if web_context:
         extra_context += f"Up-to-date information from web search:\n{web_context}\n\n"
@@ -483,8 +1234,8 @@ def generate_microcourse_section(
              - "question": a quiz question.
              - "options": an object with keys "A", "B", "C", "D".
              - "correct_answer": the letter representing the correct answer.
-             - "generate_code": true if code examples are relevant for this section, false otherwise.
-             - "generate_math": true if math expressions are relevant for this section, false otherwise.
+        - "generate_code": true if code examples are relevant for this section, false otherwise.
+        - "generate_math": true if math expressions are relevant for this section, false otherwise.
         Do NOT include code examples or math expressions.
         IMPORTANT: Output ONLY the JSON object exactly in the following format:
         
@@ -507,21 +1258,28 @@ def generate_microcourse_section(
               }},
               "correct_answer": "A"
           }},
-          "generate_code": True,
-          "generate_math": True
+          "generate_code": true,
+          "generate_math": true
         }}
         
         Ensure the JSON starts with {{ and ends with }}.
         """
     else:
-        if previous_section is None:
-            raise ValueError("For next sections, previous_section must be provided.")
+        latest_title = previous_section.get("section_title") if isinstance(previous_section, dict) else None
+        if isinstance(previous_section, str):
+            # The frontend sends the previous section's content as plain text.
+            previous_section = {"section_title": "Previous section", "content": previous_section}
+        if not course_summary:
+            if previous_section is None:
+                raise ValueError("For next sections, previous_section or course_summary must be provided.")
+            course_summary = summarize_section(previous_section)
+        latest = f'The most recent section is "{latest_title}".\n        ' if latest_title else ""
         prompt_main = f"""
         You are an expert educator developing a microcourse on the topic: {topic}.
-        Previously, you generated the following section:
-        {json.dumps(previous_section, indent=2)}
+        Sections generated so far, oldest first:
+        {course_summary}
         
-        {extra_context}Now, please generate the next section that logically continues from the previous one.
+        {latest}{extra_context}Now, please generate the next section that logically continues the course without repeating earlier sections.
         Include the following fields:
         - "section_title": the new section's title.
         - "content": the main text.
@@ -531,8 +1289,8 @@ def generate_microcourse_section(
              - "question": a quiz question.
              - "options": an object with keys "A", "B", "C", "D".
              - "correct_answer": the letter representing the correct answer.
-             - "generate_code": true if code examples are relevant for this section, false otherwise.
-         - "generate_math": true if math expressions are relevant for this section, false otherwise.
+        - "generate_code": true if code examples are relevant for this section, false otherwise.
+        - "generate_math": true if math expressions are relevant for this section, false otherwise.
         Do NOT include code examples or math expressions.
         IMPORTANT: Output ONLY the JSON object exactly in the following format:
         
@@ -555,38 +1313,252 @@ def generate_microcourse_section(
               }},
               "correct_answer": "A"
           }},
-          "generate_code": True,
-          "generate_math": True
+          "generate_code": true,
+          "generate_math": true
         }}
         
         Ensure the JSON starts with {{ and ends with }}.
         """
-    main_section, error_main = retry_generate(_generate_main_section, prompt_main, openai_api_key)
-    if error_main:
-        raise Exception(error_main)
+    return prompt_main
 
-    if main_section.get("generate_code"):
-        code_examples = generate_code_examples_section(topic, openai_api_key)
-    else:
-        code_examples = []
 
+# The code, math and hallucination stages only depend on the main section, so
+# they run side by side on a shared executor. Each stage has its own timeout;
+# one that exceeds it falls back to its empty default instead of holding up the
+# section, and is counted in section_stage_stats as "<stage>_timeout".
+SECTION_STAGE_WORKERS = int(os.getenv("SECTION_STAGE_WORKERS", "8"))
+SECTION_STAGE_TIMEOUT = float(os.getenv("SECTION_STAGE_TIMEOUT", "90"))
+_section_stage_executor = ThreadPoolExecutor(max_workers=SECTION_STAGE_WORKERS, thread_name_prefix="section-stage")
+section_stage_stats = Counters("section_stages")
+
+
+def run_enrichment_stages(
+    topic: str,
+    main_section: Dict[str, Any],
+    finetune_context: str,
+    openai_api_key: str,
+    timeout: Optional[float] = None,
+) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], Dict[str, Any]]:
+    """Run the code example, math and hallucination stages concurrently.
+
+    Returns (code_examples, math_expressions, hallucination_result). Results are
+    merged by stage name, so completion order never affects the output; a
+    stage that timed out keeps its empty default. Exceptions raised by a stage
+    propagate as before.
+    """
+    results = {"code_examples": [], "math_expressions": [], "hallucination": {}}
+    for name, result in iter_enrichment_stages(topic, main_section, finetune_context, openai_api_key, timeout):
+        if name in results:
+            results[name] = result
+    return results["code_examples"], results["math_expressions"], results["hallucination"]
+
+
+def iter_enrichment_stages(
+    topic: str,
+    main_section: Dict[str, Any],
+    finetune_context: str,
+    openai_api_key: str,
+    timeout: Optional[float] = None,
+) -> Iterator[Tuple[str, Any]]:
+    """Run the enrichment stages concurrently, yielding (stage name, result) as each one finishes.
+
+    Each stage gets timeout seconds to be picked up by the shared executor and
+    timeout seconds to run. A stage that runs out of time yields
+    ("stage_timeout", {"stage", "timeout"}) instead of a result. Its thread
+    cannot be interrupted, so it stays busy until the stage's LLM call returns.
+    """
+    timeout = SECTION_STAGE_TIMEOUT if timeout is None else timeout
+    content = main_section.get("content", "")
+    stages = {}
+    if main_section.get("generate_code"):
+        stages["code_examples"] = (generate_code_examples_section, topic, openai_api_key)
     if main_section.get("generate_math"):
-        math_expressions = generate_math_expressions_section(
-            topic,
-            main_section.get("content", ""),
-            openai_api_key,
-        )
-    else:
-        math_expressions = []
+        stages["math_expressions"] = (generate_math_expressions_section, topic, content, openai_api_key)
+    stages["hallucination"] = (hallucination_detection, content, finetune_context, openai_api_key)
+
+    submitted_at = time.monotonic()
+    started: Dict[str, float] = {}
+
+    # Stages read and write the LLM response cache from pool threads.
+    @with_db_connections
+    def run(name: str, func, *args):
+        started[name] = time.monotonic()
+        return func(*args)
+
+    names = {_section_stage_executor.submit(run, name, *stage): name for name, stage in stages.items()}
+
+    def deadline(future) -> float:
+        return started.get(names[future], submitted_at) + timeout
+
+    pending = set(names)
+    try:
+        while pending:
+            done, _ = wait_futures(
+                pending,
+                timeout=max(0.0, min(deadline(future) for future in pending) - time.monotonic()),
+                return_when=FIRST_COMPLETED,
+            )
+            for future in done:
+                pending.discard(future)
+                yield names[future], future.result()
+            now = time.monotonic()
+            for future in [future for future in pending if deadline(future) <= now]:
+                pending.discard(future)
+                future.cancel()
+                section_stage_stats.increment(f"{names[future]}_timeout")
+                logging.warning(f"Section stage {names[future]} timed out after {timeout}s; using empty result")
+                yield "stage_timeout", {"stage": names[future], "timeout": timeout}
+    finally:
+        for future in names:
+            future.cancel()
+
+
+def generate_microcourse_section(
+    topic: str,
+    pdf_path: list = None,
+    website_url: str = "",
+    is_next_section: bool = False,
+    previous_section: Optional[Dict[str, Any]] = None,
+    openai_api_key: str = "",
+    serpapi_api_key: str = "",
+    wolfram_alpha_appid: str = "",
+    vectorstore: Optional[Chroma] = None,
+    on_stage: Optional[Callable[[str], None]] = None,
+    course_summary: str = "",
+) -> Dict[str, Any]:
+    """Generate one section. on_stage, if given, is called with each stage name as it starts.
 
-    hall_result = hallucination_detection(
-        main_section.get("content", ""),
+    Next sections are prompted with course_summary (the course's rolling summary)
+    when given, else with a summary of previous_section.
+    """
+    def report(stage: str) -> None:
+        if on_stage is not None:
+            on_stage(stage)
+
+    # Use locally processed finetuning context
+    report("retrieval")
+    finetune_context = get_finetuning_context(
+        topic,
+        pdf_path,
+        website_url,
+        openai_api_key,
+        vectorstore=vectorstore,
+    )
+
+    serpapi_key = serpapi_api_key or os.getenv("SERPAPI_API_KEY", "")
+    if wolfram_alpha_appid:
+        os.environ["WOLFRAM_ALPHA_APPID"] = wolfram_alpha_appid
+    report("web_search")
+    web_context = perform_web_search(topic, serpapi_key)
+    report("main_section")
+    prompt_main = _main_section_prompt(
+        topic, finetune_context, web_context, is_next_section, previous_section, course_summary
+    )
+    main_section, error_main = retry_generate(_generate_main_section, prompt_main, openai_api_key)
+    if error_main:
+        raise Exception(error_main)
+
+    report("enrichment")
+    code_examples, math_expressions, hall_result = run_enrichment_stages(
+        topic,
+        main_section,
         finetune_context,
         openai_api_key,
     )
     if hall_result.get("hallucination_detected", "").lower() == "yes":
         logging.warning("Hallucination detected: " + hall_result.get("details", ""))
 
+    from .caches import llm_cache_stats
+
+    logging.info(f"LLM response cache stats: {llm_cache_stats.snapshot()}")
+    logging.info(f"LLM output stats: {llm_output_stats.snapshot()}")
+    return _combine_section(main_section, code_examples, math_expressions)
+
+
+def iter_microcourse_section_events(
+    topic: str,
+    pdf_path: list = None,
+    website_url: str = "",
+    is_next_section: bool = False,
+    previous_section: Optional[Dict[str, Any]] = None,
+    openai_api_key: str = "",
+    serpapi_api_key: str = "",
+    wolfram_alpha_appid: str = "",
+    vectorstore: Optional[Chroma] = None,
+    max_retries: int = 3,
+    course_summary: str = "",
+) -> Iterator[Tuple[str, Any]]:
+    """Streaming form of generate_microcourse_section, yielding (event, data) pairs.
+
+    Events, in order: "retrieval"; "token" for each chunk of the main section
+    as the model writes it ("retry" means the call failed or the streamed text
+    was unusable, and it will be regenerated after the same backoff as
+    retry_generate); "main_section"; "code_examples", "math_expressions"
+    and "hallucination" as each stage finishes ("stage_timeout" for a stage
+    that ran out of time); and finally "section" with the same combined
+    section generate_microcourse_section returns.
+    """
+    finetune_context = get_finetuning_context(
+        topic,
+        pdf_path,
+        website_url,
+        openai_api_key,
+        vectorstore=vectorstore,
+    )
+    yield "retrieval", {
+        "context_length": len(finetune_context),
+        "context_tokens": count_tokens(finetune_context, LLM_MODEL),
+    }
+
+    serpapi_key = serpapi_api_key or os.getenv("SERPAPI_API_KEY", "")
+    if wolfram_alpha_appid:
+        os.environ["WOLFRAM_ALPHA_APPID"] = wolfram_alpha_appid
+    web_context = perform_web_search(topic, serpapi_key)
+    prompt_main = _main_section_prompt(
+        topic, finetune_context, web_context, is_next_section, previous_section, course_summary
+    )
+
+    # Same retry policy as retry_generate, with a "retry" event before each new attempt.
+    main_section = None
+    for attempt in range(max_retries):
+        chunks = []
+        try:
+            for chunk in stream_llm(prompt_main, openai_api_key, json_mode=LLM_JSON_MODE):
+                chunks.append(chunk)
+                yield "token", {"text": chunk}
+        except Exception as e:
+            wait = llm_retry_wait(e, attempt, max_retries)
+            yield "retry", {"attempt": attempt + 1, "reason": classify_llm_error(e), "delay": round(wait, 1)}
+            time.sleep(wait)
+            continue
+        main_section, error_main = _parse_main_section("".join(chunks))
+        if error_main is None:
+            break
+        logging.error(f"Error encountered: {error_main} - Retrying ({attempt + 1}/{max_retries})")
+        llm_output_stats.increment("parse_retry")
+        forget_llm_response(prompt_main)
+        yield "retry", {"attempt": attempt + 1, "reason": "parse"}
+    if main_section is None:
+        llm_output_stats.increment("parse_failed")
+        raise Exception(f"Failed after {max_retries} attempts.")
+    yield "main_section", main_section
+
+    results = {"code_examples": [], "math_expressions": [], "hallucination": {}}
+    for name, result in iter_enrichment_stages(topic, main_section, finetune_context, openai_api_key):
+        if name in results:
+            results[name] = result
+        yield name, result
+    if results["hallucination"].get("hallucination_detected", "").lower() == "yes":
+        logging.warning("Hallucination detected: " + results["hallucination"].get("details", ""))
+
+    yield "section", _combine_section(main_section, results["code_examples"], results["math_expressions"])
+
+
+def _combine_section(
+    main_section: Dict[str, Any],
+    code_examples: List[Dict[str, str]],
+    math_expressions: List[Dict[str, str]],
+) -> Dict[str, Any]:
     combined_section = main_section.copy()
     combined_section["code_examples"] = code_examples
     combined_section["math_expressions"] = math_expressions
@@ -0,0 +1,295 @@
+"""
+asyncio-native variant of the section generation pipeline.
+
+Prompts, parsers and tuning knobs are shared with generate_microcourse; this
+module swaps the blocking LLM and HTTP calls for awaitables (ChatOpenAI.ainvoke,
+httpx.AsyncClient) so a single ASGI worker can keep many generations in flight.
+Source ingestion and vector-store queries stay synchronous and run on worker
+threads, so concurrent requests do not queue on the one thread-sensitive sync
+thread; they also use the database-backed embedding cache, so those threads
+close stale connections around each call (see with_db_connections).
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple, Union
+from uuid import uuid4
+
+import httpx
+from asgiref.sync import sync_to_async
+from langchain.schema import Document
+from langchain_community.vectorstores import Chroma
+
+from . import generate_microcourse
+from .llm_clients import get_chat_client
+from .generate_microcourse import (
+    SERPAPI_SEARCH_URL,
+    _batch_relevancy_prompt,
+    _code_examples_prompt,
+    _combine_section,
+    _course_collection_name,
+    _extract_snippets,
+    _hallucination_prompt,
+    _index_documents,
+    _llm_cache_key,
+    _llm_response_cache,
+    _main_section_prompt,
+    _math_expressions_prompt,
+    _parse_batch_relevancy_output,
+    _parse_code_examples,
+    _parse_hallucination_output,
+    _parse_main_section,
+    _parse_math_expressions,
+    _parse_relevancy_output,
+    _relevancy_prompt,
+    _select_relevant_docs,
+    _web_search_cache_key,
+    _web_search_params,
+    forget_llm_response,
+    iter_finetuning_docs,
+    pack_context_docs,
+    llm_retry_wait,
+    prefilter_by_similarity,
+    with_db_connections,
+)
+
+
+async def acall_llm(prompt: str, openai_api_key: str, use_cache: bool = True, json_mode: bool = False) -> str:
+    """Async counterpart of call_llm, sharing its response cache."""
+    cache = _llm_response_cache() if use_cache else None
+    if cache is not None:
+        cached = await sync_to_async(cache.get)(_llm_cache_key(prompt, json_mode))
+        if cached is not None:
+            return cached
+    try:
+        llm = generate_microcourse.get_llm(openai_api_key, json_mode, loop=asyncio.get_running_loop())
+        response = await llm.ainvoke(prompt)
+        output = response.content if hasattr(response, 'content') else str(response)
+    except Exception as e:
+        logging.error(f"Error calling LLM: {e}")
+        raise
+    if cache is not None:
+        await sync_to_async(cache.set)(_llm_cache_key(prompt, json_mode), output)
+    return output
+
+
+async def aretry_generate(parse_func, prompt: str, openai_api_key: str, max_retries: int = 3, delay: Optional[float] = None):
+    """Async counterpart of retry_generate; parse_func validates raw output into (data, error).
+
+    The structured stages all parse against a schema, so the call is made in JSON mode.
+    """
+    stats = generate_microcourse.llm_output_stats
+    for attempt in range(max_retries):
+        try:
+            output = await acall_llm(prompt, openai_api_key, json_mode=generate_microcourse.LLM_JSON_MODE)
+        except Exception as e:
+            await asyncio.sleep(llm_retry_wait(e, attempt, max_retries, delay))
+            continue
+        data, error = parse_func(output)
+        if error is None:
+            return data, None
+        logging.error(f"Error encountered: {error} - Retrying ({attempt + 1}/{max_retries})")
+        stats.increment("parse_retry")
+        await sync_to_async(forget_llm_response)(prompt)
+    stats.increment("parse_failed")
+    return None, f"Failed after {max_retries} attempts."
+
+
+# ------------------------------
+# Retrieval
+# ------------------------------
+async def adocument_relevancy_check(topic: str, text: str, openai_api_key: str, max_length: int = 1000) -> Dict[str, Any]:
+    output = await acall_llm(_relevancy_prompt(topic, text, max_length), openai_api_key)
+    return _parse_relevancy_output(output)
+
+
+async def ascore_documents_relevancy(
+        topic: str,
+        docs: List[Document],
+        openai_api_key: str,
+        max_length: int = 1000,
+        mode: Optional[str] = None,
+        max_concurrency: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Async counterpart of score_documents_relevancy, with the same modes."""
+    mode = mode or generate_microcourse.RELEVANCY_MODE
+    max_concurrency = max_concurrency or generate_microcourse.RELEVANCY_MAX_CONCURRENCY
+    if not docs:
+        return []
+    texts = [doc.page_content for doc in docs]
+    if mode == "batch":
+        try:
+            output = await acall_llm(_batch_relevancy_prompt(topic, texts, max_length), openai_api_key)
+            return _parse_batch_relevancy_output(output, len(texts))
+        except Exception as e:
+            logging.error(f"Batch relevancy check failed, scoring documents individually: {e}")
+            mode = "concurrent"
+    semaphore = asyncio.Semaphore(max_concurrency if mode == "concurrent" else 1)
+
+    async def check(text: str) -> Dict[str, Any]:
+        async with semaphore:
+            return await adocument_relevancy_check(topic, text, openai_api_key, max_length)
+
+    return list(await asyncio.gather(*(check(text) for text in texts)))
+
+
+async def aget_finetuning_context(
+        topic: str,
+        pdf_path: Optional[Union[str, List[str]]],
+        website_url: str,
+        openai_api_key: str,
+        vectorstore: Optional[Chroma] = None,
+        token_budget: Optional[int] = None,
+) -> str:
+    """Async counterpart of get_finetuning_context."""
+    if vectorstore is None:
+        vectorstore, _ = await sync_to_async(
+            with_db_connections(lambda: _index_documents(
+                iter_finetuning_docs(pdf_path, website_url),
+                _course_collection_name(uuid4().hex),
+                openai_api_key,
+            )),
+            thread_sensitive=False,
+        )()
+        if vectorstore is None:
+            return ""
+    docs_and_scores = await sync_to_async(
+        with_db_connections(vectorstore.similarity_search_with_score),
+        thread_sensitive=False,
+    )(topic, k=5)
+    accepted_docs, ambiguous_docs = prefilter_by_similarity(docs_and_scores)
+    results = await ascore_documents_relevancy(topic, ambiguous_docs, openai_api_key)
+    filtered_docs = accepted_docs + _select_relevant_docs(ambiguous_docs, results, threshold=0.5)
+    if not filtered_docs:
+        return ""
+    return pack_context_docs(filtered_docs, token_budget)
+
+
+def _web_search_client() -> httpx.AsyncClient:
+    timeout = httpx.Timeout(
+        generate_microcourse.WEB_SEARCH_READ_TIMEOUT,
+        connect=generate_microcourse.WEB_SEARCH_CONNECT_TIMEOUT,
+    )
+    return httpx.AsyncClient(timeout=timeout)
+
+
+async def aperform_web_search(query: str, api_key: str) -> str:
+    """Async counterpart of perform_web_search, sharing its snippet cache."""
+    if not api_key:
+        return ""
+    from .caches import web_search_cache
+
+    cache_key = _web_search_cache_key(query)
+    cached = web_search_cache.get(cache_key)
+    if cached is not None:
+        return cached
+    # One client per event loop, so SerpAPI connections are kept alive between searches.
+    client = get_chat_client(("web-search",), _web_search_client, loop=asyncio.get_running_loop())
+    try:
+        response = await client.get(SERPAPI_SEARCH_URL, params=_web_search_params(query, api_key))
+        response.raise_for_status()
+        snippets = _extract_snippets(response.json())
+    except (httpx.HTTPError, ValueError) as e:
+        logging.error(f"Web search failed for {query!r}: {e}")
+        return ""
+    web_search_cache.set(cache_key, snippets)
+    return snippets
+
+
+# ------------------------------
+# Generation stages
+# ------------------------------
+async def ahallucination_detection(response: str, context: str, openai_api_key: str) -> Dict[str, Any]:
+    output = await acall_llm(_hallucination_prompt(response, context), openai_api_key)
+    return _parse_hallucination_output(output)
+
+
+async def agenerate_code_examples_section(topic: str, openai_api_key: str) -> List[Dict[str, str]]:
+    code_examples, error = await aretry_generate(_parse_code_examples, _code_examples_prompt(topic), openai_api_key)
+    if error:
+        raise Exception(error)
+    return code_examples
+
+
+async def agenerate_math_expressions_section(topic: str, content: str, openai_api_key: str) -> List[Dict[str, str]]:
+    math_expressions, error = await aretry_generate(
+        _parse_math_expressions,
+        _math_expressions_prompt(topic, content),
+        openai_api_key,
+    )
+    if error:
+        raise Exception(error)
+    return math_expressions
+
+
+async def arun_enrichment_stages(
+    topic: str,
+    main_section: Dict[str, Any],
+    finetune_context: str,
+    openai_api_key: str,
+    timeout: Optional[float] = None,
+) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], Dict[str, Any]]:
+    """Async counterpart of run_enrichment_stages.
+
+    Stages are coroutines, so each one starts at once and is cancelled when it
+    runs out of time.
+    """
+    timeout = generate_microcourse.SECTION_STAGE_TIMEOUT if timeout is None else timeout
+    content = main_section.get("content", "")
+    results = {"code_examples": [], "math_expressions": [], "hallucination": {}}
+    stages = {}
+    if main_section.get("generate_code"):
+        stages["code_examples"] = agenerate_code_examples_section(topic, openai_api_key)
+    if main_section.get("generate_math"):
+        stages["math_expressions"] = agenerate_math_expressions_section(topic, content, openai_api_key)
+    stages["hallucination"] = ahallucination_detection(content, finetune_context, openai_api_key)
+
+    async def run(name, coroutine):
+        try:
+            results[name] = await asyncio.wait_for(coroutine, timeout)
+        except asyncio.TimeoutError:
+            generate_microcourse.section_stage_stats.increment(f"{name}_timeout")
+            logging.warning(f"Section stage {name} timed out after {timeout}s; using empty result")
+
+    await asyncio.gather(*(run(name, coroutine) for name, coroutine in stages.items()))
+    return results["code_examples"], results["math_expressions"], results["hallucination"]
+
+
+async def agenerate_microcourse_section(
+    topic: str,
+    pdf_path: list = None,
+    website_url: str = "",
+    is_next_section: bool = False,
+    previous_section: Optional[Dict[str, Any]] = None,
+    openai_api_key: str = "",
+    serpapi_api_key: str = "",
+    wolfram_alpha_appid: str = "",
+    vectorstore: Optional[Chroma] = None,
+    course_summary: str = "",
+) -> Dict[str, Any]:
+    """Async counterpart of generate_microcourse_section, returning the same combined section."""
+    serpapi_key = serpapi_api_key or os.getenv("SERPAPI_API_KEY", "")
+    if wolfram_alpha_appid:
+        os.environ["WOLFRAM_ALPHA_APPID"] = wolfram_alpha_appid
+    # Retrieval and web search are independent, so they overlap.
+    finetune_context, web_context = await asyncio.gather(
+        aget_finetuning_context(topic, pdf_path, website_url, openai_api_key, vectorstore=vectorstore),
+        aperform_web_search(topic, serpapi_key),
+    )
+    prompt_main = _main_section_prompt(
+        topic, finetune_context, web_context, is_next_section, previous_section, course_summary
+    )
+    main_section, error_main = await aretry_generate(_parse_main_section, prompt_main, openai_api_key)
+    if error_main:
+        raise Exception(error_main)
+
+    code_examples, math_expressions, hall_result = await arun_enrichment_stages(
+        topic,
+        main_section,
+        finetune_context,
+        openai_api_key,
+    )
+    if hall_result.get("hallucination_detected", "").lower() == "yes":
+        logging.warning("Hallucination detected: " + hall_result.get("details", ""))
+
+    return _combine_section(main_section, code_examples, math_expressions)
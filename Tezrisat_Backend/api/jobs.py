@@ -0,0 +1,292 @@
+"""
+Database-backed queue for course and section generation.
+
+Views enqueue a GenerationJob and return 202 straight away. Worker processes
+started with ``python manage.py run_generation_workers`` claim queued jobs, run
+the generation pipeline and persist the result, recording the current stage on
+the job row as they go. Claiming is a conditional UPDATE, so any number of
+workers can poll the same table without a broker.
+
+A running job belongs to the worker and attempt that claimed it. The worker
+refreshes the row's updated_at while it works (see GENERATION_JOB_HEARTBEAT);
+a job that goes quiet for GENERATION_JOB_STALE_AFTER seconds is handed to
+another worker, and every later write of the first worker is conditional on
+still owning the job, so a requeued job is never persisted twice.
+"""
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import timedelta
+from typing import Dict, Optional
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .generate_microcourse import (
+    build_course_vectorstore,
+    delete_course_vectorstore,
+    generate_microcourse_section,
+    load_course_vectorstore,
+)
+from .models import GenerationJob, Microcourse
+from .services import create_microcourse, create_section, get_course_summary
+from .utils import decrypt_api_key, encrypt_api_key
+
+logger = logging.getLogger(__name__)
+
+
+def enqueue_job(kind: str, payload: dict, keys: Dict[str, Optional[str]], microcourse: Optional[Microcourse] = None) -> GenerationJob:
+    """Queue a generation job. Keys are encrypted before they are written to the database."""
+    payload = dict(payload)
+    payload["keys"] = {name: encrypt_api_key(value) for name, value in keys.items() if value}
+    return GenerationJob.objects.create(
+        kind=kind,
+        payload=payload,
+        microcourse=microcourse,
+        max_attempts=settings.GENERATION_JOB_MAX_ATTEMPTS,
+        available_at=timezone.now(),
+    )
+
+
+def claim_job(worker_id: str) -> Optional[GenerationJob]:
+    """Atomically move the oldest runnable job to running and return it, or None if there is none."""
+    runnable = GenerationJob.objects.filter(status=GenerationJob.STATUS_QUEUED, attempts__lt=F("max_attempts"))
+    candidates = runnable.filter(
+        available_at__lte=timezone.now(),
+    ).order_by("available_at", "id").values_list("id", flat=True)[:10]
+    for job_id in candidates:
+        job = runnable.filter(id=job_id)
+        claimed = job.update(
+            status=GenerationJob.STATUS_RUNNING,
+            stage="starting",
+            worker=worker_id,
+            attempts=F("attempts") + 1,
+            updated_at=timezone.now(),
+        )
+        if claimed:
+            return GenerationJob.objects.get(id=job_id)
+    return None
+
+
+def requeue_stale_jobs() -> int:
+    """Return running jobs whose worker stopped reporting progress to the queue.
+
+    A stale job that has used up its attempts is marked failed instead, so a
+    job that keeps killing its worker (out of memory, segfault) is not claimed
+    forever.
+    """
+    now = timezone.now()
+    stale = GenerationJob.objects.filter(
+        status=GenerationJob.STATUS_RUNNING,
+        updated_at__lt=now - timedelta(seconds=settings.GENERATION_JOB_STALE_AFTER),
+    )
+    for job in stale.filter(attempts__gte=F("max_attempts")).only("id", "payload"):
+        job.payload.pop("keys", None)
+        stale.filter(id=job.id).update(
+            status=GenerationJob.STATUS_FAILED,
+            stage="failed",
+            error="The worker stopped responding.",
+            payload=job.payload,
+            updated_at=now,
+        )
+    return stale.filter(attempts__lt=F("max_attempts")).update(
+        status=GenerationJob.STATUS_QUEUED, stage="queued", worker="", available_at=now,
+    )
+
+
+class JobLost(Exception):
+    """The job was requeued or finished elsewhere while this worker was running it."""
+
+
+def _owned(job: GenerationJob):
+    """The job's row, as long as it is still running under this worker's claim."""
+    return GenerationJob.objects.filter(
+        id=job.id,
+        status=GenerationJob.STATUS_RUNNING,
+        worker=job.worker,
+        attempts=job.attempts,
+    )
+
+
+def _set_stage(job: GenerationJob, stage: str) -> None:
+    job.stage = stage
+    if not _owned(job).update(stage=stage, updated_at=timezone.now()):
+        raise JobLost(f"Generation job {job.id} is no longer owned by {job.worker}")
+
+
+@contextmanager
+def _heartbeat(job: GenerationJob):
+    """Refresh the job's updated_at in the background, so long stages are not taken for a dead worker."""
+    stop = threading.Event()
+
+    def beat():
+        try:
+            while not stop.wait(settings.GENERATION_JOB_HEARTBEAT):
+                if not _owned(job).update(updated_at=timezone.now()):
+                    return
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=beat, name=f"job-{job.id}-heartbeat", daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+@contextmanager
+def _persisting(job: GenerationJob):
+    """Run the block that saves the job's result, and mark the job succeeded, in one transaction.
+
+    The job row is locked first; if this worker no longer owns the job the
+    block is skipped and JobLost raised, so a requeued job is saved once.
+    """
+    _set_stage(job, "persisting")
+    with transaction.atomic():
+        if not _owned(job).select_for_update().exists():
+            raise JobLost(f"Generation job {job.id} is no longer owned by {job.worker}")
+        yield
+        _finish(job, GenerationJob.STATUS_SUCCEEDED, "done")
+
+
+def _job_keys(job: GenerationJob) -> Dict[str, str]:
+    return {name: decrypt_api_key(token) for name, token in job.payload.get("keys", {}).items()}
+
+
+def _finish(job: GenerationJob, status: str, stage: str, error: str = "") -> None:
+    job.payload.pop("keys", None)
+    finished = _owned(job).update(
+        status=status,
+        stage=stage,
+        error=error,
+        payload=job.payload,
+        microcourse=job.microcourse,
+        section=job.section,
+        updated_at=timezone.now(),
+    )
+    if not finished:
+        raise JobLost(f"Generation job {job.id} is no longer owned by {job.worker}")
+    job.status, job.stage, job.error = status, stage, error
+
+
+def _run_course_job(job: GenerationJob, keys: Dict[str, str]) -> None:
+    payload = job.payload
+    vector_index = uuid4().hex
+    _set_stage(job, "indexing")
+    try:
+        # A partly built index is removed too, so a failed job leaves nothing under VECTOR_STORE_ROOT.
+        vectorstore = build_course_vectorstore(vector_index, payload.get("pdf_paths"), payload.get("urls"), keys.get("openai", ""))
+        section_data = generate_microcourse_section(
+            payload.get("topic"),
+            pdf_path=payload.get("pdf_paths"),
+            website_url=payload.get("urls"),
+            is_next_section=False,
+            openai_api_key=keys.get("openai", ""),
+            serpapi_api_key=keys.get("serpapi", ""),
+            wolfram_alpha_appid=keys.get("wolfram", ""),
+            vectorstore=vectorstore,
+            on_stage=lambda stage: _set_stage(job, stage),
+        )
+
+        pdf_paths = payload.get("pdf_paths") or []
+        with _persisting(job):
+            job.microcourse, job.section = create_microcourse(
+                section_data,
+                title=payload.get("title"),
+                topic=payload.get("topic"),
+                complexity=payload.get("complexity"),
+                target_audience=payload.get("target_audience"),
+                url=payload.get("urls"),
+                pdf=pdf_paths[0] if pdf_paths else None,
+                user=None,
+                vector_index=vector_index if vectorstore is not None else "",
+            )
+    except Exception:
+        delete_course_vectorstore(vector_index)
+        raise
+
+
+def _run_section_job(job: GenerationJob, keys: Dict[str, str]) -> None:
+    microcourse = job.microcourse
+    _set_stage(job, "indexing")
+    vectorstore = load_course_vectorstore(microcourse.vector_index, keys.get("openai", ""))
+    section_data = generate_microcourse_section(
+        microcourse.topic,
+        is_next_section=True,
+        previous_section=job.payload.get("previous_section"),
+        openai_api_key=keys.get("openai", ""),
+        serpapi_api_key=keys.get("serpapi", ""),
+        wolfram_alpha_appid=keys.get("wolfram", ""),
+        vectorstore=vectorstore,
+        on_stage=lambda stage: _set_stage(job, stage),
+        course_summary=get_course_summary(microcourse),
+    )
+    with _persisting(job):
+        job.section = create_section(microcourse, section_data)
+
+
+JOB_HANDLERS = {
+    GenerationJob.KIND_COURSE: _run_course_job,
+    GenerationJob.KIND_SECTION: _run_section_job,
+}
+
+
+def run_job(job: GenerationJob) -> None:
+    """Run a claimed job, then mark it succeeded, schedule a retry or mark it failed.
+
+    A job this worker lost to another one is left alone.
+    """
+    try:
+        with _heartbeat(job):
+            JOB_HANDLERS[job.kind](job, _job_keys(job))
+    except JobLost as e:
+        logger.warning("%s; dropping this attempt", e)
+        return
+    except Exception as e:
+        logger.error("Generation job %s failed on attempt %s/%s: %s", job.id, job.attempts, job.max_attempts, e)
+        try:
+            if job.attempts < job.max_attempts:
+                delay = settings.GENERATION_JOB_RETRY_DELAY * 2 ** (job.attempts - 1)
+                retried = _owned(job).update(
+                    status=GenerationJob.STATUS_QUEUED,
+                    stage="queued",
+                    error=str(e),
+                    available_at=timezone.now() + timedelta(seconds=delay),
+                    updated_at=timezone.now(),
+                )
+                if not retried:
+                    raise JobLost(f"Generation job {job.id} is no longer owned by {job.worker}")
+            else:
+                _finish(job, GenerationJob.STATUS_FAILED, "failed", str(e))
+        except JobLost as lost:
+            logger.warning("%s; dropping this attempt", lost)
+        return
+    logger.info("Generation job %s succeeded", job.id)
+
+
+def run_worker(worker_id: Optional[str] = None, poll_interval: Optional[float] = None, stop_when_idle: bool = False) -> int:
+    """Claim and run jobs until interrupted (or until the queue is empty with stop_when_idle).
+
+    Returns the number of jobs processed.
+    """
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    poll_interval = settings.GENERATION_JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+    processed = 0
+    while True:
+        requeue_stale_jobs()
+        job = claim_job(worker_id)
+        if job is None:
+            if stop_when_idle:
+                return processed
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        processed += 1
@@ -0,0 +1,110 @@
+"""
+Local recovery of JSON from LLM output.
+
+Models often wrap their answer in prose or code fences, emit Python literals
+(True/None), leave trailing commas or stop mid-value when they hit the token
+limit. repair_json fixes those cases locally so a malformed answer does not
+cost another LLM round trip; only output with no recoverable JSON raises.
+"""
+import json
+import re
+from typing import Any, List, Optional, Tuple
+
+_FENCE = re.compile(r"```(?:json)?\s*(.*?)```", re.DOTALL)
+_CLOSERS = {"{": "}", "[": "]"}
+_PYTHON_LITERALS = (("True", "true"), ("False", "false"), ("None", "null"))
+
+
+def _strip_trailing_comma(chars: List[str]) -> None:
+    while chars and chars[-1].isspace():
+        chars.pop()
+    if chars and chars[-1] == ",":
+        chars.pop()
+
+
+def _scan(text: str, start: int) -> Tuple[str, List[str], bool, List[Tuple[int, List[str]]]]:
+    """Copy the JSON value starting at text[start], normalising it on the way.
+
+    Returns (copied text, closers still open, whether a string is still open,
+    cut points after each comma as (length, open closers)).
+    """
+    out: List[str] = []
+    stack: List[str] = []
+    cut_points: List[Tuple[int, List[str]]] = []
+    in_string = escape = False
+    i = start
+    while i < len(text):
+        ch = text[i]
+        i += 1
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            elif ch == "\n":
+                ch = "\\n"
+            out.append(ch)
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(_CLOSERS[ch])
+        elif ch in "}]":
+            if not stack or stack[-1] != ch:
+                break
+            _strip_trailing_comma(out)
+            stack.pop()
+            out.append(ch)
+            if not stack:
+                break
+            continue
+        elif ch == ",":
+            cut_points.append((len(out), list(stack)))
+        elif ch.isalpha() and not (out and (out[-1].isalnum() or out[-1] == "_")):
+            for literal, replacement in _PYTHON_LITERALS:
+                end = i - 1 + len(literal)
+                if text.startswith(literal, i - 1) and not (end < len(text) and (text[end].isalnum() or text[end] == "_")):
+                    out.append(replacement)
+                    i += len(literal) - 1
+                    break
+            else:
+                out.append(ch)
+            continue
+        out.append(ch)
+    return "".join(out), stack, in_string, cut_points
+
+
+def repair_json(text: str, expect: Optional[type] = None) -> Any:
+    """Return the first JSON value in text (of type expect, if given), repairing it if needed.
+
+    Raises ValueError when no usable value can be recovered.
+    """
+    fenced = _FENCE.search(text)
+    if fenced:
+        text = fenced.group(1)
+    openers = "{[" if expect is None else ("{" if expect is dict else "[")
+    start = next((index for index, ch in enumerate(text) if ch in openers), -1)
+    if start == -1:
+        raise ValueError("No JSON value found in output")
+
+    copied, stack, in_string, cut_points = _scan(text, start)
+    if not stack:
+        candidates = [copied]
+    else:
+        # Truncated output: close what is open, else fall back to the last complete element.
+        closed = list(copied + ('"' if in_string else ""))
+        _strip_trailing_comma(closed)
+        candidates = ["".join(closed) + "".join(reversed(stack))]
+        for length, open_closers in reversed(cut_points):
+            candidates.append(copied[:length] + "".join(reversed(open_closers)))
+
+    for candidate in candidates:
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            continue
+        if expect is None or isinstance(value, expect):
+            return value
+    raise ValueError("Could not recover JSON from output")
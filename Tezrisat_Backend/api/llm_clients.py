@@ -0,0 +1,108 @@
+"""
+Registry of reusable LLM clients.
+
+Each ChatOpenAI instance owns an HTTP connection pool, so constructing one per
+call pays a fresh TCP/TLS handshake every time. Clients are kept here keyed by
+API key and model parameters and handed back to later calls and requests.
+The registry is bounded: idle clients expire after LLM_CLIENT_IDLE_TIMEOUT
+seconds and the least recently used one is dropped once LLM_CLIENT_POOL_SIZE
+clients are held. Async clients are bound to the event loop that first used
+them, so they live in a separate registry per loop, dropped with the loop.
+"""
+import hashlib
+import os
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+LLM_CLIENT_POOL_SIZE = int(os.getenv("LLM_CLIENT_POOL_SIZE", "32"))
+LLM_CLIENT_IDLE_TIMEOUT = float(os.getenv("LLM_CLIENT_IDLE_TIMEOUT", "600"))
+
+
+class ClientRegistry:
+    """Thread-safe, size- and idle-bounded map from client parameters to client instances."""
+
+    def __init__(
+        self,
+        max_size: int = LLM_CLIENT_POOL_SIZE,
+        idle_timeout: float = LLM_CLIENT_IDLE_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._clients: "OrderedDict[str, Tuple[Any, float]]" = OrderedDict()
+
+    @staticmethod
+    def _fingerprint(key: Tuple[Hashable, ...]) -> str:
+        # Keys contain API keys; keep only a digest of them.
+        return hashlib.sha256(repr(key).encode("utf-8")).hexdigest()
+
+    def get(self, key: Tuple[Hashable, ...], factory: Callable[[], Any]) -> Any:
+        """Return the client registered under key, creating it with factory if needed."""
+        fingerprint = self._fingerprint(key)
+        now = self._clock()
+        with self._lock:
+            self._evict_idle(now)
+            entry = self._clients.get(fingerprint)
+            if entry is not None:
+                self._clients[fingerprint] = (entry[0], now)
+                self._clients.move_to_end(fingerprint)
+                return entry[0]
+        client = factory()
+        with self._lock:
+            entry = self._clients.get(fingerprint)
+            if entry is not None:
+                # Another thread registered the same client meanwhile; share theirs.
+                return entry[0]
+            self._clients[fingerprint] = (client, now)
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+        return client
+
+    def clear(self) -> None:
+        with self._lock:
+            self._clients.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._clients)
+
+    def _evict_idle(self, now: float) -> None:
+        expired = [fp for fp, (_, last_used) in self._clients.items() if now - last_used > self.idle_timeout]
+        for fingerprint in expired:
+            del self._clients[fingerprint]
+
+
+chat_client_registry = ClientRegistry()
+# Event loop -> registry of the clients bound to it. Keyed by the loop object
+# (not its id, which a later loop can reuse) and kept apart from the shared
+# registry, so short-lived loops from asyncio.run/async_to_sync cannot evict
+# the synchronous clients.
+_loop_registries: "weakref.WeakKeyDictionary[Any, ClientRegistry]" = weakref.WeakKeyDictionary()
+_loop_registries_lock = threading.Lock()
+
+
+def _loop_registry(loop: Any) -> ClientRegistry:
+    with _loop_registries_lock:
+        for closed in [other for other in _loop_registries.keys() if other.is_closed()]:
+            del _loop_registries[closed]
+        registry = _loop_registries.get(loop)
+        if registry is None:
+            registry = _loop_registries[loop] = ClientRegistry()
+        return registry
+
+
+def get_chat_client(key: Tuple[Hashable, ...], factory: Callable[[], Any], loop: Optional[Any] = None) -> Any:
+    """Return a shared chat client for key.
+
+    Async clients are bound to the event loop that first used them, so callers on
+    an event loop pass it as ``loop`` to get a client of their own; those are
+    released when the loop closes or is garbage collected.
+    """
+    if loop is None:
+        return chat_client_registry.get(key, factory)
+    return _loop_registry(loop).get(key, factory)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from api.documents import find_stale_course_documents
+
+
+class Command(BaseCommand):
+    help = "Compare stored course documents with the section tables and rebuild the stale ones."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run",
+            action="store_true",
+            help="Only report stale documents instead of rebuilding them.",
+        )
+
+    def handle(self, *args, **options):
+        rebuild = not options["dry_run"]
+        stale = find_stale_course_documents(rebuild=rebuild)
+        if not stale:
+            self.stdout.write("All course documents are up to date")
+            return
+        action = "Rebuilt" if rebuild else "Found"
+        self.stdout.write(f"{action} {len(stale)} stale course document(s): {', '.join(map(str, stale))}")
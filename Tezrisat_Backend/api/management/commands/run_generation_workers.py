@@ -0,0 +1,58 @@
+import multiprocessing
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def _worker_process(stop_when_idle: bool) -> None:
+    # Under the spawn and forkserver start methods (the default outside Linux, where it
+    # is fork) the child starts from a fresh interpreter and must load Django itself.
+    import django
+    django.setup()
+    from api.jobs import run_worker
+    run_worker(stop_when_idle=stop_when_idle)
+
+
+class Command(BaseCommand):
+    help = "Run worker processes that execute queued course and section generation jobs."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers",
+            type=int,
+            default=settings.GENERATION_WORKERS,
+            help="Number of worker processes (default: GENERATION_WORKERS).",
+        )
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Exit once the queue is empty instead of polling for new jobs.",
+        )
+
+    def handle(self, *args, **options):
+        workers = max(1, options["workers"])
+        stop_when_idle = options["once"]
+        self.stdout.write(f"Starting {workers} generation worker(s)")
+        if workers == 1:
+            from api.jobs import run_worker
+            processed = run_worker(stop_when_idle=stop_when_idle)
+            self.stdout.write(f"Processed {processed} job(s)")
+            return
+
+        # Forked children must not share the parent's database connections.
+        connections.close_all()
+        processes = [
+            multiprocessing.Process(target=_worker_process, args=(stop_when_idle,), name=f"generation-worker-{index}")
+            for index in range(workers)
+        ]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        except KeyboardInterrupt:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.join()
@@ -0,0 +1,23 @@
+import threading
+from typing import Dict
+
+
+class Counters:
+    """Thread-safe named counters for one pipeline stage or cache."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._values: Dict[str, int] = {}
+
+    def increment(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def reset(self) -> None:
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._values)
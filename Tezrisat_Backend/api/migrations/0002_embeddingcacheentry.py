@@ -0,0 +1,22 @@
+# Generated by Django 4.2.16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EmbeddingCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True)),
+                ('value', models.BinaryField()),
+                ('last_used', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_embeddingcacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='microcourse',
+            name='vector_index',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
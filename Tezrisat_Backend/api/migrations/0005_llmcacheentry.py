@@ -0,0 +1,24 @@
+# Generated by Django 4.2.16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_generationjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LLMCacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('response', models.TextField()),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('last_used', models.DateTimeField(auto_now=True, db_index=True)),
+            ],
+        ),
+    ]
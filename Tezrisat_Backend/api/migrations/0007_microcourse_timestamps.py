@@ -0,0 +1,24 @@
+# Generated by Django 4.2.16
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_microcourse_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='microcourse',
+            name='created_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='microcourse',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_microcourse_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='microcourse',
+            name='document',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
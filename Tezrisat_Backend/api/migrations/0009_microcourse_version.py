@@ -0,0 +1,18 @@
+# Generated by Django 4.2.16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_microcourse_document'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='microcourse',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.contrib.auth.models import User
 from django.db import models
+from django.utils import timezone
 
 
 class Microcourse(models.Model):
@@ -11,6 +12,17 @@ class Microcourse(models.Model):
     url = models.URLField(max_length=500, blank=True, null=True)
     pdf = models.FileField(upload_to='pdfs/', null=True, blank=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="microcourses", null=True, blank=True)
+    # Directory name of the course's source-document vector index under VECTOR_STORE_ROOT
+    vector_index = models.CharField(max_length=64, blank=True, default="")
+    # Rolling one-line-per-section summary used to prompt next sections (see services.create_section)
+    summary = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # Also bumped when a section, glossary term or recall note changes (see documents.update_course_document)
+    updated_at = models.DateTimeField(auto_now=True)
+    # Pre-rendered course detail response, patched on every write (see documents.py)
+    document = models.JSONField(null=True, blank=True)
+    # Bumped together with document on every write; the course detail ETag is derived from it
+    version = models.PositiveIntegerField(default=1)
 
     def __str__(self):
         return self.title
@@ -51,3 +63,60 @@ class RecallNote(models.Model):
 
     def __str__(self):
         return f"Note for {self.section.section_title} at {self.timestamp}"
+
+class EmbeddingCacheEntry(models.Model):
+    # Key is "<embedding model><hash of chunk text>", value is the JSON-encoded vector.
+    key = models.CharField(max_length=255, unique=True)
+    value = models.BinaryField()
+    last_used = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return self.key
+
+class LLMCacheEntry(models.Model):
+    # Key is a SHA-256 of the model, sampling parameters and prompt.
+    key = models.CharField(max_length=64, unique=True)
+    response = models.TextField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+    last_used = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return self.key
+
+class GenerationJob(models.Model):
+    KIND_COURSE = "course"
+    KIND_SECTION = "section"
+    KIND_CHOICES = [
+        (KIND_COURSE, "Course"),
+        (KIND_SECTION, "Section"),
+    ]
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_SUCCEEDED = "succeeded"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_SUCCEEDED, "Succeeded"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED, db_index=True)
+    # Last pipeline stage reported by the worker, e.g. "retrieval" or "enrichment"
+    stage = models.CharField(max_length=50, default="queued")
+    # Generation inputs; API keys are stored encrypted and cleared once the job finishes
+    payload = models.JSONField(default=dict)
+    attempts = models.PositiveIntegerField(default=0)
+    max_attempts = models.PositiveIntegerField(default=3)
+    error = models.TextField(blank=True, default="")
+    worker = models.CharField(max_length=100, blank=True, default="")
+    microcourse = models.ForeignKey(Microcourse, on_delete=models.CASCADE, related_name="generation_jobs", null=True, blank=True)
+    section = models.ForeignKey(MicrocourseSection, on_delete=models.SET_NULL, related_name="+", null=True, blank=True)
+    available_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.kind} job {self.id} ({self.status})"
@@ -0,0 +1,11 @@
+from rest_framework.pagination import CursorPagination
+
+
+class MicrocourseCursorPagination(CursorPagination):
+    """Newest courses first. Cursors stay stable as courses are added, and no COUNT query is needed."""
+
+    # id breaks ties between courses created in the same instant, so the order is total.
+    ordering = ("-created_at", "-id")
+    page_size = 20
+    page_size_query_param = "page_size"
+    max_page_size = 100
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from api.models import (
+    GenerationJob,
     Microcourse,
     MicrocourseSection,
     GlossaryTerm,
@@ -67,3 +68,37 @@ class MicrocourseSerializer(serializers.ModelSerializer):
         ]
         extra_kwargs = {"user": {"read_only": True}}
 
+
+class MicrocourseSummarySerializer(serializers.ModelSerializer):
+    """List representation: no sections, just their count (annotated as section_count)."""
+    section_count = serializers.IntegerField(read_only=True)
+
+    class Meta:
+        model = Microcourse
+        fields = [
+            "id",
+            "title",
+            "topic",
+            "complexity",
+            "section_count",
+            "created_at",
+            "updated_at",
+        ]
+
+
+class GenerationJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = GenerationJob
+        fields = [
+            "id",
+            "kind",
+            "status",
+            "stage",
+            "attempts",
+            "max_attempts",
+            "error",
+            "microcourse",
+            "section",
+            "created_at",
+            "updated_at",
+        ]
@@ -0,0 +1,98 @@
+import json
+from typing import Tuple
+
+from django.db import transaction
+from django.utils import timezone
+
+from .documents import add_section, course_document
+from .generate_microcourse import extend_course_summary
+from .models import (
+    Microcourse,
+    MicrocourseSection,
+    GlossaryTerm,
+    QuizQuestion,
+    RecallNote,
+)
+
+
+def get_course_summary(microcourse: Microcourse) -> str:
+    """Return the course's rolling summary, building it from stored sections for older courses."""
+    if microcourse.summary:
+        return microcourse.summary
+    summary = ""
+    for section in microcourse.sections.order_by("id").prefetch_related("glossary_terms"):
+        summary = extend_course_summary(summary, {
+            "section_title": section.section_title,
+            "content": section.content,
+            "vocabulary": {term.term: term.definition for term in section.glossary_terms.all()},
+        })
+    if summary:
+        Microcourse.objects.filter(pk=microcourse.pk).update(summary=summary)
+        microcourse.summary = summary
+    return summary
+
+
+def _json_field(section_data: dict, field: str, default):
+    """Decode one of the JSON-string fields of a combined section."""
+    value = section_data.get(field)
+    if not value:
+        return default
+    decoded = json.loads(value)
+    return default if decoded is None else decoded
+
+
+def create_section(microcourse: Microcourse, section_data: dict) -> MicrocourseSection:
+    """Persist a generated section with its glossary terms, quiz and recall notes.
+
+    Everything is written in one transaction with bulk inserts, so a failure
+    leaves no partial section and the query count does not grow with the
+    number of glossary terms or recall notes. The course's rolling summary is
+    extended with the new section and the section is appended to the stored
+    course document. The summary is read under a lock on the course row, so
+    sections added concurrently each extend the other's summary instead of
+    overwriting it.
+    """
+    glossary = _json_field(section_data, "vocabulary", {})
+    quiz = _json_field(section_data, "quiz", {})
+    recall_notes = _json_field(section_data, "recall_notes", [])
+
+    with transaction.atomic():
+        locked = Microcourse.objects.select_for_update().only("id", "summary").get(pk=microcourse.pk)
+        summary = get_course_summary(locked)
+        section = MicrocourseSection.objects.create(
+            microcourse=microcourse,
+            section_title=section_data.get("section_title"),
+            content=section_data.get("content"),
+            code_examples=section_data.get("code_examples"),
+            math_expressions=section_data.get("math_expressions"),
+        )
+        related = {
+            "glossary_terms": GlossaryTerm.objects.bulk_create(
+                GlossaryTerm(section=section, term=term, definition=definition)
+                for term, definition in glossary.items()
+            ),
+            "quiz_questions": [],
+            "recall_notes": RecallNote.objects.bulk_create(
+                RecallNote(section=section, content=note) for note in recall_notes
+            ),
+        }
+        if quiz:
+            related["quiz_questions"].append(QuizQuestion.objects.create(
+                section=section,
+                question=quiz.get("question"),
+                options=quiz.get("options"),
+                correct_answer=quiz.get("correct_answer"),
+            ))
+        microcourse.summary = extend_course_summary(summary, section_data)
+        microcourse.updated_at = timezone.now()
+        add_section(section, related, summary=microcourse.summary, updated_at=microcourse.updated_at)
+    return section
+
+
+def create_microcourse(section_data: dict, **fields) -> Tuple[Microcourse, MicrocourseSection]:
+    """Create a microcourse together with its first section, atomically."""
+    with transaction.atomic():
+        microcourse = Microcourse.objects.create(**fields)
+        # Start from an empty document so the first section is appended rather than rendered from the tables.
+        Microcourse.objects.filter(pk=microcourse.pk).update(document=course_document(microcourse, []))
+        return microcourse, create_section(microcourse, section_data)
@@ -0,0 +1,172 @@
+"""
+Schema-driven parsing of structured LLM output.
+
+Every generation stage that expects JSON declares its shape here, and
+parse_structured_output turns raw model text into validated data in a single
+pass: strict json.loads, then local repair (see json_repair), then validation
+against the schema. Optional fields that are missing or mistyped fall back to
+their defaults and list items that do not fit are dropped, so one malformed
+code example does not cost a regeneration of the whole list. Only output with
+no usable data is reported as an error for the caller to retry.
+"""
+import copy
+import json
+from dataclasses import dataclass, field
+from typing import Any, Dict, Optional, Tuple, Union
+
+from .json_repair import repair_json
+from .metrics import Counters
+
+# parsed / repaired: how output was read; items_dropped and invalid count what
+# validation had to discard.
+llm_output_stats = Counters("llm_outputs")
+
+_BOOLEAN_STRINGS = {"true": True, "yes": True, "false": False, "no": False}
+
+
+@dataclass(frozen=True)
+class ObjectSchema:
+    """A JSON object: field name -> expected type (or nested ObjectSchema)."""
+
+    name: str
+    fields: Dict[str, Any]
+    required: Tuple[str, ...] = ()
+    defaults: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass(frozen=True)
+class ListSchema:
+    """A JSON array of items. In JSON mode the model may only return objects,
+    so the array is also accepted wrapped as {key: [...]}."""
+
+    name: str
+    key: str
+    item: ObjectSchema
+
+
+Schema = Union[ObjectSchema, ListSchema]
+
+
+class StructuredOutputError(ValueError):
+    pass
+
+
+QUIZ_SCHEMA = ObjectSchema(
+    name="quiz",
+    fields={"question": str, "options": dict, "correct_answer": str},
+    required=("question", "options", "correct_answer"),
+)
+
+MAIN_SECTION_SCHEMA = ObjectSchema(
+    name="main section",
+    fields={
+        "section_title": str,
+        "content": str,
+        "recall_notes": list,
+        "vocabulary": dict,
+        "quiz": QUIZ_SCHEMA,
+        "generate_code": bool,
+        "generate_math": bool,
+    },
+    required=("section_title", "content"),
+    defaults={
+        "recall_notes": [],
+        "vocabulary": {},
+        "quiz": {},
+        "generate_code": False,
+        "generate_math": False,
+    },
+)
+
+CODE_EXAMPLES_SCHEMA = ListSchema(
+    name="code examples",
+    key="code_examples",
+    item=ObjectSchema(name="code example", fields={"description": str, "code": str}, required=("description", "code")),
+)
+
+MATH_EXPRESSIONS_SCHEMA = ListSchema(
+    name="math expressions",
+    key="math_expressions",
+    item=ObjectSchema(
+        name="math expression",
+        fields={"description": str, "expression": str},
+        required=("description", "expression"),
+    ),
+)
+
+
+def load_llm_json(output: str, expect: Optional[type] = None) -> Any:
+    """json.loads the output, falling back to local repair before anyone asks the LLM again."""
+    try:
+        data = json.loads(output)
+        if expect is None or isinstance(data, expect):
+            llm_output_stats.increment("parsed")
+            return data
+    except ValueError:
+        pass
+    data = repair_json(output, expect=expect)
+    llm_output_stats.increment("repaired")
+    return data
+
+
+def _coerce(value: Any, expected: Any) -> Any:
+    """Return value as the expected type, or raise StructuredOutputError."""
+    if isinstance(expected, ObjectSchema):
+        return validate_object(value, expected)
+    if expected is bool and isinstance(value, str) and value.strip().lower() in _BOOLEAN_STRINGS:
+        return _BOOLEAN_STRINGS[value.strip().lower()]
+    if expected is str and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if not isinstance(value, expected):
+        raise StructuredOutputError(f"expected {expected.__name__}, got {type(value).__name__}")
+    return value
+
+
+def validate_object(value: Any, schema: ObjectSchema) -> Dict[str, Any]:
+    if not isinstance(value, dict):
+        raise StructuredOutputError(f"{schema.name}: expected an object, got {type(value).__name__}")
+    data = dict(value)
+    for key, expected in schema.fields.items():
+        try:
+            if key not in data:
+                raise StructuredOutputError("missing")
+            data[key] = _coerce(data[key], expected)
+        except StructuredOutputError as e:
+            if key in schema.required:
+                raise StructuredOutputError(f'{schema.name}: field "{key}" {e}')
+            if key in schema.defaults:
+                data[key] = copy.deepcopy(schema.defaults[key])
+            else:
+                data.pop(key, None)
+    return data
+
+
+def validate_list(value: Any, schema: ListSchema) -> list:
+    if isinstance(value, dict) and isinstance(value.get(schema.key), list):
+        value = value[schema.key]
+    if not isinstance(value, list):
+        raise StructuredOutputError(f"{schema.name}: expected an array or an object with \"{schema.key}\"")
+    items = []
+    for item in value:
+        try:
+            items.append(validate_object(item, schema.item))
+        except StructuredOutputError:
+            llm_output_stats.increment("items_dropped")
+    if value and not items:
+        raise StructuredOutputError(f"{schema.name}: none of the {len(value)} items is a valid {schema.item.name}")
+    return items
+
+
+def parse_structured_output(output: str, schema: Schema) -> Tuple[Optional[Any], Optional[str]]:
+    """Parse and validate output against schema, returning (data, None) or (None, error)."""
+    try:
+        if isinstance(schema, ListSchema):
+            try:
+                loaded = load_llm_json(output)
+            except ValueError:
+                loaded = load_llm_json(output, list)
+            return validate_list(loaded, schema), None
+        return validate_object(load_llm_json(output, dict), schema), None
+    except Exception as e:
+        llm_output_stats.increment("invalid")
+        return None, f"Error parsing {schema.name} JSON. Raw output:\n{output}\nException: {e}"
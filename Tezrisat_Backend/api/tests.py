@@ -1,24 +1,114 @@
+import asyncio
 import json
-from unittest.mock import patch, MagicMock
-
-from django.test import TestCase
+import os
+import tempfile
+import threading
+import time
+from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import AsyncMock, patch, MagicMock
+
+import httpx
+import openai
+import requests
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
 from rest_framework.test import APITestCase
 
-from .models import Microcourse, MicrocourseSection, GlossaryTerm, QuizQuestion, RecallNote
+from langchain.embeddings import CacheBackedEmbeddings
+from langchain_core.embeddings import Embeddings
+
+from .generate_microcourse_async import agenerate_microcourse_section, aperform_web_search, arun_enrichment_stages
+from .caches import (
+    CacheStats,
+    DatabaseByteStore,
+    LLMResponseCache,
+    TTLCache,
+    UrlTextCache,
+    llm_cache_stats,
+    llm_response_cache,
+    web_search_cache,
+)
+from .documents import find_stale_course_documents, rebuild_course_document, render_course_document
+from .chat_context import get_chat_context
+from .context_packing import context_packing_stats, count_tokens, pack_context
+from .course_retrieval import CourseIndex, course_passages, retrieve_course_context, split_passages
+from .jobs import _heartbeat, claim_job, enqueue_job, requeue_stale_jobs, run_job, run_worker
+from .json_repair import repair_json
+from . import llm_clients
+from .llm_clients import ClientRegistry, chat_client_registry, get_chat_client
+from .services import create_microcourse, create_section, get_course_summary
+from .views import CHAT_PROMPT_TEMPLATE, _build_chat_inputs
+from .structured_output import CODE_EXAMPLES_SCHEMA, MAIN_SECTION_SCHEMA, parse_structured_output
+from .models import (
+    Microcourse,
+    MicrocourseSection,
+    GlossaryTerm,
+    QuizQuestion,
+    RecallNote,
+    EmbeddingCacheEntry,
+    GenerationJob,
+    LLMCacheEntry,
+)
 from .generate_microcourse import (
+    COURSE_SUMMARY_MAX_TOKENS,
+    build_course_vectorstore,
+    delete_course_vectorstore,
+    load_course_vectorstore,
+    load_finetuning_sources,
+    iter_finetuning_sources,
+    iter_finetuning_docs,
+    fetch_url_text,
+    iter_microcourse_section_events,
+    iter_pdf_pages,
+    _index_documents,
+    _run_in_process,
+    _timed,
+    with_db_connections,
+    run_enrichment_stages,
+    iter_enrichment_stages,
+    section_stage_stats,
     call_llm,
     document_relevancy_check,
+    filter_relevant_docs,
+    get_finetuning_context,
+    prefilter_by_similarity,
+    relevancy_prefilter_stats,
+    score_documents_relevancy,
     hallucination_detection,
     _generate_main_section,
     _generate_code_examples,
     _generate_math_expressions,
-    _generate_math_expressions_refined,
+    _code_examples_prompt,
+    extend_course_summary,
+    summarize_section,
+    _llm_cache_key,
+    _main_section_prompt,
+    classify_llm_error,
+    llm_output_stats,
+    llm_retry_delay,
+    retry_generate,
+    perform_web_search,
+    WEB_SEARCH_CONNECT_TIMEOUT,
+    WEB_SEARCH_READ_TIMEOUT,
 )
 
 
 class CallLlmReturnTypeTests(TestCase):
     """Verify call_llm returns a plain str, not a tuple."""
 
+    def setUp(self):
+        llm_response_cache.clear()
+        chat_client_registry.clear()
+        self.addCleanup(chat_client_registry.clear)
+
     @patch("api.generate_microcourse.ChatOpenAI")
     def test_call_llm_returns_str(self, mock_chat_cls):
         mock_response = MagicMock()
@@ -40,6 +130,727 @@ class CallLlmReturnTypeTests(TestCase):
         self.assertIsInstance(result, str)
 
 
+class LLMResponseCacheTests(TestCase):
+    def setUp(self):
+        llm_response_cache.clear()
+        chat_client_registry.clear()
+        self.addCleanup(chat_client_registry.clear)
+        llm_cache_stats.reset()
+
+    def _mock_chat(self, mock_chat_cls, content):
+        mock_response = MagicMock()
+        mock_response.content = content
+        mock_chat_cls.return_value.invoke.return_value = mock_response
+
+    @patch("api.generate_microcourse.ChatOpenAI")
+    def test_repeated_prompt_is_served_from_cache(self, mock_chat_cls):
+        self._mock_chat(mock_chat_cls, "answer")
+        self.assertEqual(call_llm("same prompt", "fake-key"), "answer")
+        self.assertEqual(call_llm("same prompt", "fake-key"), "answer")
+        self.assertEqual(mock_chat_cls.return_value.invoke.call_count, 1)
+        self.assertEqual(llm_cache_stats.snapshot()["hits"], 1)
+
+        # A cold process still finds the response in the database tier.
+        with self.assertNumQueries(2):
+            self.assertEqual(LLMResponseCache().get(_llm_cache_key("same prompt")), "answer")
+
+    @patch("api.generate_microcourse.ChatOpenAI")
+    def test_opt_out_bypasses_cache(self, mock_chat_cls):
+        self._mock_chat(mock_chat_cls, "answer")
+        call_llm("prompt", "fake-key", use_cache=False)
+        call_llm("prompt", "fake-key", use_cache=False)
+        self.assertEqual(mock_chat_cls.return_value.invoke.call_count, 2)
+        self.assertEqual(LLMCacheEntry.objects.count(), 0)
+
+    @patch("api.generate_microcourse.time.sleep")
+    @patch("api.generate_microcourse.ChatOpenAI")
+    def test_unparseable_response_is_not_served_on_retry(self, mock_chat_cls, _mock_sleep):
+        good_json = '{"section_title": "Intro", "content": "Hi"}'
+        bad, good = MagicMock(content="not json"), MagicMock(content=good_json)
+        mock_chat_cls.return_value.invoke.side_effect = [bad, good]
+        data, error = retry_generate(_generate_main_section, "prompt", "fake-key")
+        self.assertIsNone(error)
+        self.assertEqual(data["section_title"], "Intro")
+        self.assertEqual(LLMCacheEntry.objects.get().response, good_json)
+
+    def test_expired_and_overflowing_entries_are_evicted(self):
+        cache = LLMResponseCache(max_memory_entries=1, max_entries=2, ttl=60)
+        for key in ("a", "b", "c"):
+            cache.set(key, key.upper())
+        self.assertEqual(set(LLMCacheEntry.objects.values_list("key", flat=True)), {"b", "c"})
+        self.assertEqual(len(cache._memory), 1)
+
+        LLMCacheEntry.objects.filter(key="b").update(created_at=timezone.now() - timedelta(seconds=120))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), "C")
+
+    @override_settings(LLM_CACHE_ENABLED=False)
+    @patch("api.generate_microcourse.ChatOpenAI")
+    def test_cache_can_be_disabled(self, mock_chat_cls):
+        self._mock_chat(mock_chat_cls, "answer")
+        call_llm("prompt", "fake-key")
+        call_llm("prompt", "fake-key")
+        self.assertEqual(mock_chat_cls.return_value.invoke.call_count, 2)
+
+
+class ChatClientRegistryTests(TestCase):
+    def test_clients_are_reused_per_key(self):
+        registry = ClientRegistry(max_size=4, idle_timeout=60)
+        first = registry.get(("key", "model", 0.7), object)
+        self.assertIs(registry.get(("key", "model", 0.7), object), first)
+        self.assertIsNot(registry.get(("key", "model", 0.2), object), first)
+        self.assertIsNot(registry.get(("other-key", "model", 0.7), object), first)
+
+    def test_least_recently_used_and_idle_clients_are_evicted(self):
+        now = [0.0]
+        registry = ClientRegistry(max_size=2, idle_timeout=10, clock=lambda: now[0])
+        a = registry.get(("a",), object)
+        registry.get(("b",), object)
+        registry.get(("a",), object)
+        registry.get(("c",), object)
+        self.assertEqual(len(registry), 2)
+        self.assertIs(registry.get(("a",), object), a)
+
+        now[0] = 11.0
+        self.assertIsNot(registry.get(("a",), object), a)
+        self.assertEqual(len(registry), 1)
+
+    def test_loop_bound_clients_are_per_loop_and_kept_out_of_the_shared_registry(self):
+        chat_client_registry.clear()
+        self.addCleanup(chat_client_registry.clear)
+        shared = get_chat_client(("key",), object)
+        first_loop = asyncio.new_event_loop()
+        first = get_chat_client(("key",), object, loop=first_loop)
+        self.assertIs(get_chat_client(("key",), object, loop=first_loop), first)
+        self.assertIsNot(first, shared)
+        self.assertEqual(len(chat_client_registry), 1)
+
+        first_loop.close()
+        second_loop = asyncio.new_event_loop()
+        self.addCleanup(second_loop.close)
+        self.assertIsNot(get_chat_client(("key",), object, loop=second_loop), first)
+        self.assertNotIn(first_loop, llm_clients._loop_registries)
+        self.assertIs(get_chat_client(("key",), object), shared)
+
+    @patch("api.generate_microcourse.ChatOpenAI")
+    def test_call_llm_reuses_client(self, mock_chat_cls):
+        chat_client_registry.clear()
+        self.addCleanup(chat_client_registry.clear)
+        mock_chat_cls.return_value.invoke.return_value = MagicMock(content="ok")
+        for _ in range(3):
+            call_llm("prompt", "fake-key", use_cache=False)
+        mock_chat_cls.assert_called_once()
+        self.assertEqual(mock_chat_cls.return_value.invoke.call_count, 3)
+        # Retries are left to retry_generate, not layered on top of it.
+        self.assertEqual(mock_chat_cls.call_args.kwargs["max_retries"], 0)
+
+
+class WebSearchTests(TestCase):
+    def setUp(self):
+        web_search_cache.clear()
+        self.addCleanup(web_search_cache.clear)
+
+    def _response(self, snippets):
+        response = MagicMock()
+        response.json.return_value = {"organic_results": [{"snippet": text} for text in snippets]}
+        return response
+
+    @patch("api.generate_microcourse._get_web_search_session")
+    def test_snippets_are_cached_per_query(self, mock_session):
+        mock_session.return_value.get.return_value = self._response(["one", "two"])
+
+        self.assertEqual(perform_web_search("Topic", "serp-key"), "one\ntwo")
+        self.assertEqual(perform_web_search("Topic", "other-key"), "one\ntwo")
+        mock_session.return_value.get.assert_called_once()
+        timeout = mock_session.return_value.get.call_args.kwargs["timeout"]
+        self.assertEqual(timeout, (WEB_SEARCH_CONNECT_TIMEOUT, WEB_SEARCH_READ_TIMEOUT))
+
+        perform_web_search("Another topic", "serp-key")
+        self.assertEqual(mock_session.return_value.get.call_count, 2)
+
+    @patch("api.generate_microcourse._get_web_search_session")
+    def test_failed_search_returns_empty_and_is_not_cached(self, mock_session):
+        mock_session.return_value.get.side_effect = [requests.Timeout("read timed out"), self._response(["ok"])]
+        self.assertEqual(perform_web_search("Topic", "serp-key"), "")
+        self.assertEqual(perform_web_search("Topic", "serp-key"), "ok")
+
+    @patch("api.generate_microcourse_async.httpx.AsyncClient")
+    def test_async_searches_share_one_client_per_loop(self, mock_client_cls):
+        mock_client_cls.return_value.get = AsyncMock(return_value=self._response(["one"]))
+
+        async def search_twice():
+            await aperform_web_search("Topic", "serp-key")
+            await aperform_web_search("Another topic", "serp-key")
+
+        asyncio.run(search_twice())
+        mock_client_cls.assert_called_once()
+        self.assertEqual(mock_client_cls.return_value.get.await_count, 2)
+
+    def test_entries_expire_after_ttl(self):
+        now = [0.0]
+        cache = TTLCache(max_entries=2, ttl=10, clock=lambda: now[0])
+        cache.set("a", "A")
+        cache.set("b", "B")
+        cache.set("c", "C")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), "B")
+        now[0] = 11.0
+        self.assertIsNone(cache.get("c"))
+
+
+class JsonRepairTests(TestCase):
+    def test_repairs_common_llm_damage(self):
+        self.assertEqual(repair_json('Sure! {"a": True, "b": None,} Hope this helps'), {"a": True, "b": None})
+        self.assertEqual(repair_json('```json\n[1, 2,]\n```'), [1, 2])
+        self.assertEqual(repair_json('{"text": "two\nlines"}'), {"text": "two\nlines"})
+        self.assertEqual(repair_json('{"name": "True story"}'), {"name": "True story"})
+
+    def test_truncated_output_keeps_complete_elements(self):
+        truncated = '[{"description": "a", "code": "x"}, {"description": "b", "co'
+        self.assertEqual(repair_json(truncated, expect=list)[0], {"description": "a", "code": "x"})
+        self.assertEqual(repair_json('{"title": "Intro", "content":', expect=dict), {"title": "Intro"})
+
+    def test_unrecoverable_output_raises(self):
+        with self.assertRaises(ValueError):
+            repair_json("no json here")
+        with self.assertRaises(ValueError):
+            repair_json('{"not": "an array"}', expect=list)
+
+
+class StructuredOutputTests(TestCase):
+    def setUp(self):
+        llm_output_stats.reset()
+
+    def test_main_section_fills_defaults_and_coerces_flags(self):
+        output = json.dumps({
+            "section_title": "Intro",
+            "content": "Hi",
+            "quiz": {"question": "Q?"},
+            "generate_code": "true",
+        })
+        data, error = parse_structured_output(output, MAIN_SECTION_SCHEMA)
+        self.assertIsNone(error)
+        self.assertIs(data["generate_code"], True)
+        self.assertIs(data["generate_math"], False)
+        self.assertEqual((data["quiz"], data["vocabulary"], data["recall_notes"]), ({}, {}, []))
+
+    def test_missing_required_field_is_an_error(self):
+        data, error = parse_structured_output('{"section_title": "Intro"}', MAIN_SECTION_SCHEMA)
+        self.assertIsNone(data)
+        self.assertIn('field "content" missing', error)
+        self.assertEqual(llm_output_stats.snapshot(), {"parsed": 1, "invalid": 1})
+
+    def test_list_keeps_valid_items_from_json_mode_object(self):
+        output = json.dumps({"code_examples": [
+            {"description": "ok", "code": "x = 1"},
+            {"description": "no code"},
+            "not an object",
+        ]})
+        data, error = parse_structured_output(output, CODE_EXAMPLES_SCHEMA)
+        self.assertIsNone(error)
+        self.assertEqual(data, [{"description": "ok", "code": "x = 1"}])
+        self.assertEqual(llm_output_stats.snapshot(), {"parsed": 1, "items_dropped": 2})
+
+    def test_list_with_no_valid_items_is_an_error(self):
+        data, error = parse_structured_output('[{"description": "no code"}]', CODE_EXAMPLES_SCHEMA)
+        self.assertIsNone(data)
+        self.assertIn("Error parsing code examples JSON", error)
+
+    def test_prompts_ask_for_json_literals(self):
+        prompt = _main_section_prompt("Topic", "", "", False, None)
+        self.assertIn('"generate_code": true', prompt)
+        self.assertNotIn("True", prompt)
+        self.assertIn('{"code_examples": []}', _code_examples_prompt("Topic"))
+
+    @patch("api.generate_microcourse.ChatOpenAI")
+    def test_structured_calls_use_json_mode(self, mock_chat_cls):
+        llm_response_cache.clear()
+        chat_client_registry.clear()
+        self.addCleanup(chat_client_registry.clear)
+        mock_chat_cls.return_value.invoke.return_value = MagicMock(content='{"code_examples": []}')
+        data, error = _generate_code_examples("prompt", "fake-key")
+        self.assertEqual((data, error), ([], None))
+        self.assertEqual(mock_chat_cls.call_args.kwargs["model_kwargs"], {"response_format": {"type": "json_object"}})
+        self.assertNotEqual(_llm_cache_key("prompt", json_mode=True), _llm_cache_key("prompt"))
+
+
+@patch("api.context_packing._encoding", return_value=None)
+class CourseSummaryTests(TestCase):
+    def _section(self, title, sentences=3):
+        return {
+            "section_title": title,
+            "content": " ".join(f"{title} sentence {i} explains one idea." for i in range(sentences)),
+            "vocabulary": json.dumps({"term": "definition"}),
+        }
+
+    def test_section_line_is_extractive_and_bounded(self, _mock_encoding):
+        line = summarize_section(self._section("Loops", sentences=50), max_tokens=40)
+        self.assertTrue(line.startswith("- Loops — Loops sentence 0 explains one idea."))
+        self.assertTrue(line.endswith("(key terms: term)"))
+        self.assertLessEqual(len(line) / 4, 40)
+
+    def test_summary_stays_under_ceiling_keeping_newest_in_full(self, _mock_encoding):
+        summary = ""
+        for index in range(80):
+            summary = extend_course_summary(summary, self._section(f"Part {index}"), max_tokens=150)
+            self.assertLessEqual(len(summary) / 4, 150)
+        lines = summary.splitlines()
+        self.assertIn("Part 79 sentence 0", lines[-1])
+        self.assertEqual(lines[0].split(" (")[0], lines[0].split(" — ")[0])
+        self.assertNotIn("- Part 0\n", summary)
+
+    def test_next_section_prompt_uses_summary_not_full_section(self, _mock_encoding):
+        previous = {"section_title": "Loops", "content": "secret " * 500, "quiz": {"question": "Q?"}}
+        prompt = _main_section_prompt("Topic", "", "", True, previous, "- Intro — Basics.")
+        self.assertIn("- Intro — Basics.", prompt)
+        self.assertIn('The most recent section is "Loops"', prompt)
+        self.assertNotIn("secret", prompt)
+        prompt = _main_section_prompt("Topic", "", "", True, "Plain text.", "")
+        self.assertIn("- Previous section — Plain text.", prompt)
+        self.assertNotIn("most recent section", prompt)
+
+    def test_sections_extend_the_stored_summary(self, _mock_encoding):
+        microcourse = Microcourse.objects.create(title="C", topic="T", complexity="B", target_audience="L")
+        MicrocourseSection.objects.create(microcourse=microcourse, section_title="Legacy", content="Old text.")
+        self.assertEqual(get_course_summary(microcourse), "- Legacy — Old text.")
+
+        create_section(microcourse, {
+            "section_title": "New",
+            "content": "New text.",
+            "code_examples": "[]",
+            "math_expressions": "[]",
+            "quiz": json.dumps({}),
+        })
+        microcourse.refresh_from_db()
+        self.assertEqual(microcourse.summary, "- Legacy — Old text.\n- New — New text.")
+
+
+class CreateSectionTests(TestCase):
+    def setUp(self):
+        self.microcourse = Microcourse.objects.create(
+            title="C", topic="T", complexity="B", target_audience="L", summary="- Intro — Basics.",
+        )
+        rebuild_course_document(self.microcourse)
+
+    def _section_data(self, size):
+        return {
+            "section_title": "Loops",
+            "content": "Loops repeat work.",
+            "code_examples": "[]",
+            "math_expressions": "[]",
+            "vocabulary": json.dumps({f"term {i}": f"definition {i}" for i in range(size)}),
+            "quiz": json.dumps({"question": "Q?", "options": {"A": "a"}, "correct_answer": "A"}),
+            "recall_notes": json.dumps([f"note {i}" for i in range(size)]),
+        }
+
+    def test_query_count_does_not_grow_with_vocabulary(self):
+        # savepoint, locked summary, section, glossary, quiz, recall notes, savepoint,
+        # locked course row, document + summary, release, release
+        for size in (1, 50):
+            with self.assertNumQueries(11):
+                section = create_section(self.microcourse, self._section_data(size))
+            self.assertEqual(section.glossary_terms.count(), size)
+            self.assertEqual(section.recall_notes.count(), size)
+        self.assertEqual(find_stale_course_documents(), [])
+
+    def test_summary_is_extended_from_the_stored_row(self):
+        # Loaded before another request added its section.
+        stale = Microcourse.objects.get(pk=self.microcourse.pk)
+        create_section(self.microcourse, dict(self._section_data(1), section_title="Loops"))
+        create_section(stale, dict(self._section_data(1), section_title="Functions"))
+
+        stale.refresh_from_db()
+        self.assertEqual([line.split(" — ")[0] for line in stale.summary.splitlines()], ["- Intro", "- Loops", "- Functions"])
+
+    def test_failure_leaves_no_partial_section(self):
+        with patch("api.services.RecallNote.objects.bulk_create", side_effect=RuntimeError("disk full")):
+            with self.assertRaises(RuntimeError):
+                create_section(self.microcourse, self._section_data(3))
+        self.assertFalse(MicrocourseSection.objects.exists())
+        self.assertFalse(GlossaryTerm.objects.exists())
+        self.microcourse.refresh_from_db()
+        self.assertEqual(self.microcourse.summary, "- Intro — Basics.")
+
+    def test_course_is_not_created_without_its_first_section(self):
+        with self.assertRaises(ValueError):
+            create_microcourse({"vocabulary": "not json"}, title="New", topic="T", complexity="B", target_audience="L")
+        self.assertFalse(Microcourse.objects.filter(title="New").exists())
+
+
+class CourseDetailTests(APITestCase):
+    def _course(self, section_count):
+        microcourse = Microcourse.objects.create(title="C", topic="T", complexity="B", target_audience="L")
+        for index in range(section_count):
+            section = MicrocourseSection.objects.create(
+                microcourse=microcourse,
+                section_title=f"Section {index}",
+                content="Long content " * 50,
+                code_examples="[]",
+                math_expressions="[]",
+            )
+            GlossaryTerm.objects.create(section=section, term="term", definition="definition")
+            QuizQuestion.objects.create(section=section, question="Q?", options={"A": "a"}, correct_answer="A")
+            RecallNote.objects.create(section=section, content="note")
+        return microcourse
+
+    def test_query_count_does_not_grow_with_sections(self):
+        for section_count in (1, 30):
+            microcourse = self._course(section_count)
+            # The first read materializes the document; later reads are a single row fetch.
+            self.client.get(f"/api/microcourses/{microcourse.id}/")
+            with self.assertNumQueries(1):
+                response = self.client.get(f"/api/microcourses/{microcourse.id}/")
+            sections = response.json()["sections"]
+            self.assertEqual(len(sections), section_count)
+            self.assertEqual(sections[0]["glossary_terms"], [{"id": sections[0]["glossary_terms"][0]["id"], "term": "term", "definition": "definition"}])
+            self.assertEqual(sections[-1]["quiz_questions"][0]["options"], {"A": "a"})
+            self.assertEqual(set(sections[0]["recall_notes"][0]), {"id", "content", "timestamp"})
+
+    def test_fields_parameter_skips_heavy_columns_and_relations(self):
+        microcourse = self._course(3)
+        rebuild_course_document(microcourse)
+        with self.assertNumQueries(1):
+            response = self.client.get(f"/api/microcourses/{microcourse.id}/", {"fields": "id,section_title"})
+        self.assertEqual(response.json()["sections"][0], {"id": response.json()["sections"][0]["id"], "section_title": "Section 0"})
+
+        response = self.client.get(f"/api/microcourses/{microcourse.id}/", {"fields": "id,secret"})
+        self.assertEqual(response.status_code, 400)
+
+
+class CourseDocumentTests(APITestCase):
+    def setUp(self):
+        self.microcourse, self.section = create_microcourse({
+            "section_title": "Loops",
+            "content": "Loops repeat work.",
+            "code_examples": "[]",
+            "math_expressions": "[]",
+            "vocabulary": json.dumps({"loop": "repetition"}),
+            "quiz": json.dumps({"question": "Q?", "options": {"A": "a"}, "correct_answer": "A"}),
+            "recall_notes": json.dumps(["note"]),
+        }, title="C", topic="T", complexity="B", target_audience="L")
+
+    def _document(self):
+        return Microcourse.objects.get(pk=self.microcourse.pk).document
+
+    def _assert_fresh(self):
+        self.assertEqual(self._document(), render_course_document(self.microcourse))
+
+    def test_created_course_has_a_fresh_document(self):
+        self._assert_fresh()
+        self.assertEqual(self._document()["sections"][0]["glossary_terms"][0]["term"], "loop")
+
+    def test_views_patch_the_document(self):
+        response = self.client.post(
+            "/api/add_glossary_term/",
+            {"termData": {"term": "break", "definition": "exit", "microcourse_id": self.microcourse.id}},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 200)
+        self._assert_fresh()
+        term_id = response.json()["glossary_term"]["id"]
+
+        response = self.client.post(
+            "/api/add_note/", {"noteData": {"content": "second", "section_id": self.section.id}}, format="json"
+        )
+        self.assertEqual(response.status_code, 200)
+        self._assert_fresh()
+        self.assertEqual([note["content"] for note in self._document()["sections"][0]["recall_notes"]], ["note", "second"])
+
+        self.client.delete(f"/api/delete_glossary_term/{term_id}/")
+        self.client.delete(f"/api/delete_note/{response.json()['id']}/")
+        self._assert_fresh()
+        self.assertEqual(len(self._document()["sections"][0]["glossary_terms"]), 1)
+
+    def test_check_rebuilds_documents_changed_behind_its_back(self):
+        GlossaryTerm.objects.filter(section=self.section).update(definition="edited in the admin")
+        self.assertEqual(find_stale_course_documents(), [self.microcourse.pk])
+
+        out = StringIO()
+        call_command("check_course_documents", stdout=out)
+        self.assertIn(f"Rebuilt 1 stale course document(s): {self.microcourse.pk}", out.getvalue())
+        self.assertEqual(find_stale_course_documents(), [])
+        response = self.client.get(f"/api/microcourses/{self.microcourse.id}/")
+        self.assertEqual(response.json()["sections"][0]["glossary_terms"][0]["definition"], "edited in the admin")
+
+
+class CourseETagTests(APITestCase):
+    setUp = CourseDocumentTests.setUp
+
+    def _get(self, etag=None, **params):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get(f"/api/microcourses/{self.microcourse.id}/", params, **headers)
+
+    def test_unchanged_course_returns_304_after_one_lookup(self):
+        response = self._get()
+        etag = response["ETag"]
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            response = self._get(etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(response.content, b"")
+        self.assertEqual(self._get(f"W/{etag}").status_code, 304)
+
+    def test_writes_change_the_etag(self):
+        etag = self._get()["ETag"]
+        self.client.post(
+            "/api/add_note/", {"noteData": {"content": "second", "section_id": self.section.id}}, format="json"
+        )
+        response = self._get(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+        etag = response["ETag"]
+        GlossaryTerm.objects.filter(section=self.section).update(definition="edited in the admin")
+        find_stale_course_documents(rebuild=True)
+        self.assertEqual(self._get(etag).status_code, 200)
+
+    def test_field_subsets_have_their_own_etag(self):
+        full = self._get()["ETag"]
+        subset = self._get(fields="id,section_title")["ETag"]
+        self.assertNotEqual(full, subset)
+        self.assertEqual(self._get(full, fields="id,section_title").status_code, 200)
+        self.assertEqual(self._get(subset, fields="id,section_title").status_code, 304)
+
+
+class ChatContextTests(APITestCase):
+    def setUp(self):
+        CourseDocumentTests.setUp(self)
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def _ask(self):
+        return self.client.post(
+            "/api/agent_response/",
+            {"id": self.microcourse.id, "question": "What is a loop?", "openai_key": "sk-test"},
+            format="json",
+        )
+
+    def test_context_is_built_once_and_cached(self):
+        context = get_chat_context(self.microcourse.id)
+        self.assertEqual(context["summary"], "- Loops — Loops repeat work. (key terms: loop)")
+        self.assertEqual(
+            [passage.text for passage in context["index"].passages],
+            ["Loops repeat work.", "Glossary:\nloop: repetition", "Recall notes:\nnote"],
+        )
+        # Only the course version is read.
+        with self.assertNumQueries(1):
+            self.assertEqual(get_chat_context(self.microcourse.id)["index"].passages, context["index"].passages)
+        self.assertIsNone(get_chat_context(self.microcourse.id + 1))
+        self.assertIsNone(get_chat_context("not-an-id"))
+
+    def test_writes_are_seen_on_the_next_turn(self):
+        # Nothing clears the cache on write, as with a write made by a generation worker
+        # or another web process against a per-process cache.
+        get_chat_context(self.microcourse.id)
+        self.client.post(
+            "/api/add_note/", {"noteData": {"content": "second", "section_id": self.section.id}}, format="json"
+        )
+        passages = get_chat_context(self.microcourse.id)["index"].passages
+        self.assertEqual(passages[-1].text, "Recall notes:\nnote\nsecond")
+
+        create_section(self.microcourse, {
+            "section_title": "Recursion",
+            "content": "Functions call themselves.",
+            "code_examples": "[]",
+            "math_expressions": "[]",
+        })
+        passages = get_chat_context(self.microcourse.id)["index"].passages
+        self.assertEqual(passages[-1].section_title, "Recursion")
+
+    @patch("api.views._chat_chain")
+    def test_chat_turn_reads_only_the_course_version(self, mock_chain):
+        mock_chain.return_value.run.return_value = "A loop repeats."
+        Microcourse.objects.filter(pk=self.microcourse.pk).update(vector_index="course-index")
+        self._ask()
+        with self.assertNumQueries(1):
+            response = self._ask()
+        self.assertEqual(
+            response.json(),
+            {"answer": "A loop repeats.", "sources": [{"section_id": self.section.id, "section_title": "Loops"}]},
+        )
+        inputs = mock_chain.return_value.run.call_args.kwargs
+        self.assertIn("[Loops]\nLoops repeat work.", inputs["course_context"])
+        self.assertEqual(inputs["messages"], [{"role": "user", "content": "What is a loop?"}])
+        self.assertNotIn("source_context", inputs)
+
+
+    @patch("api.context_packing._encoding", return_value=None)
+    def test_prompt_is_bounded_and_every_passage_is_cited(self, _mock_encoding):
+        sizes = []
+        for section_count in (1, 60):
+            microcourse, _ = create_microcourse({
+                "section_title": "Loops 0",
+                "content": "Loops repeat work until a condition fails. " * 30,
+                "code_examples": "[]",
+                "math_expressions": "[]",
+            }, title="C", topic="T", complexity="B", target_audience="L")
+            for index in range(1, section_count):
+                create_section(microcourse, {
+                    "section_title": f"Loops {index}",
+                    "content": "Loops repeat work until a condition fails. " * 30,
+                    "code_examples": "[]",
+                    "math_expressions": "[]",
+                })
+            inputs, sources = _build_chat_inputs(get_chat_context(microcourse.id), "How do loops repeat work?")
+            system_prompt = CHAT_PROMPT_TEMPLATE.format_messages(**inputs)[0].content
+            sizes.append(count_tokens(system_prompt, "gpt-3.5-turbo"))
+            labels = {line[1:-1] for line in inputs["course_context"].splitlines() if line.startswith("[Loops")}
+            self.assertEqual(labels, {source["section_title"] for source in sources})
+        self.assertLessEqual(
+            sizes[1],
+            settings.CHAT_CONTEXT_TOKEN_BUDGET + COURSE_SUMMARY_MAX_TOKENS + 100,
+        )
+
+
+@patch("api.context_packing._encoding", return_value=None)
+class CourseRetrievalTests(TestCase):
+    def _document(self, section_count):
+        sections = [
+            {
+                "id": index,
+                "section_title": f"Topic {index}",
+                "content": f"Topic {index} covers subject{index} in depth.\n\n" + "Filler sentence here. " * 40,
+                "glossary_terms": [{"id": index, "term": f"subject{index}", "definition": "a term"}],
+                "recall_notes": [],
+            }
+            for index in range(section_count)
+        ]
+        sections[-1]["recall_notes"] = [{"id": 1, "content": "Recursion needs a base case."}]
+        return {"sections": sections}
+
+    def test_long_content_is_split_into_bounded_passages(self, _mock_encoding):
+        text = "\n\n".join(f"Paragraph {index}. " + "Words follow here. " * 30 for index in range(5))
+        pieces = split_passages(text, "gpt-3.5-turbo", max_tokens=100)
+        self.assertGreater(len(pieces), 1)
+        self.assertTrue(all(count_tokens(piece, "gpt-3.5-turbo") <= 100 for piece in pieces))
+        self.assertEqual(" ".join(" ".join(pieces).split()), " ".join(text.split()))
+
+    def test_question_retrieves_matching_passages_with_citations(self, _mock_encoding):
+        index = CourseIndex(course_passages(self._document(5), "gpt-3.5-turbo"))
+        self.assertEqual(index.search("What does subject3 mean?", k=1)[0][0].section_title, "Topic 3")
+        self.assertEqual(index.search("unrelated zebra", k=3), [])
+
+        retrieved = retrieve_course_context(index, "Why does recursion need a base case?", 4, 500, "gpt-3.5-turbo")
+        self.assertTrue(retrieved.text.startswith("[Topic 4]\nRecall notes:"))
+        self.assertEqual(retrieved.sources[0], {"section_id": 4, "section_title": "Topic 4"})
+
+    def test_prompt_context_is_bounded_however_many_sections(self, _mock_encoding):
+        for section_count in (3, 300):
+            index = CourseIndex(course_passages(self._document(section_count), "gpt-3.5-turbo"))
+            retrieved = retrieve_course_context(index, "filler sentence subject1", 8, 600, "gpt-3.5-turbo")
+            self.assertLessEqual(retrieved.tokens, 600)
+            self.assertLessEqual(count_tokens(retrieved.text, "gpt-3.5-turbo"), 600)
+            self.assertTrue(retrieved.sources)
+
+
+class CourseListTests(APITestCase):
+    def _create_courses(self, count, sections=2):
+        for index in range(count):
+            microcourse = Microcourse.objects.create(
+                title=f"Course {index}",
+                topic="T",
+                complexity="B",
+                target_audience="L",
+                created_at=timezone.now() + timedelta(seconds=index),
+            )
+            MicrocourseSection.objects.bulk_create(
+                MicrocourseSection(microcourse=microcourse, content="Long content " * 100) for _ in range(sections)
+            )
+
+    def test_summary_page_has_constant_size_and_query_count(self):
+        self._create_courses(3)
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/microcourses/", {"page_size": 2})
+        page = response.json()
+        self.assertEqual([course["title"] for course in page["results"]], ["Course 2", "Course 1"])
+        self.assertEqual(page["results"][0]["section_count"], 2)
+        self.assertEqual(
+            set(page["results"][0]),
+            {"id", "title", "topic", "complexity", "section_count", "created_at", "updated_at"},
+        )
+        size = len(response.content)
+
+        self._create_courses(30)
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/microcourses/", {"page_size": 2})
+        self.assertEqual(len(response.json()["results"]), 2)
+        self.assertAlmostEqual(len(response.content), size, delta=100)
+
+    def test_cursor_walks_every_course_once(self):
+        self._create_courses(5, sections=0)
+        titles, url = [], "/api/microcourses/?page_size=2"
+        while url:
+            page = self.client.get(url).json()
+            titles.extend(course["title"] for course in page["results"])
+            url = page["next"]
+        self.assertEqual(titles, [f"Course {index}" for index in reversed(range(5))])
+        self.assertEqual(self.client.get("/api/microcourses/", {"cursor": "bogus"}).status_code, 404)
+
+    def test_courses_created_together_are_ordered_by_id(self):
+        created_at = timezone.now()
+        ids = [
+            Microcourse.objects.create(title=f"Course {index}", topic="T", complexity="B", target_audience="L", created_at=created_at).id
+            for index in range(5)
+        ]
+        seen, url = [], "/api/microcourses/?page_size=2"
+        while url:
+            page = self.client.get(url).json()
+            seen.extend(course["id"] for course in page["results"])
+            url = page["next"]
+        self.assertEqual(seen, sorted(ids, reverse=True))
+
+
+class RetryGenerateTests(TestCase):
+    def setUp(self):
+        llm_output_stats.reset()
+
+    @staticmethod
+    def _rate_limit_error(retry_after=None):
+        headers = {"retry-after": retry_after} if retry_after else {}
+        response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://api.openai.com"))
+        return openai.RateLimitError("rate limited", response=response, body=None)
+
+    def test_classifies_errors(self):
+        request = httpx.Request("POST", "https://api.openai.com")
+        self.assertEqual(classify_llm_error(self._rate_limit_error()), "rate_limit")
+        self.assertEqual(classify_llm_error(openai.APIConnectionError(request=request)), "transient")
+        self.assertEqual(classify_llm_error(requests.Timeout()), "transient")
+        self.assertEqual(classify_llm_error(ValueError("bad key")), "fatal")
+
+    def test_backoff_grows_and_honours_retry_after(self):
+        error = ValueError("boom")
+        with patch("api.generate_microcourse.random.uniform", return_value=1.0):
+            self.assertEqual(llm_retry_delay(error, 0, base_delay=1), 1)
+            self.assertEqual(llm_retry_delay(error, 3, base_delay=1), 8)
+            self.assertEqual(llm_retry_delay(self._rate_limit_error("12"), 0, base_delay=1), 12)
+
+    @patch("api.generate_microcourse.time.sleep")
+    def test_rate_limit_is_retried_with_backoff(self, mock_sleep):
+        generate = MagicMock(side_effect=[self._rate_limit_error("2"), ({"ok": True}, None)])
+        data, error = retry_generate(generate, "prompt", "fake-key")
+        self.assertEqual(data, {"ok": True})
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 2)
+        self.assertEqual(llm_output_stats.snapshot(), {"rate_limit_retry": 1})
+
+    @patch("api.generate_microcourse.time.sleep")
+    def test_fatal_errors_are_not_retried(self, mock_sleep):
+        generate = MagicMock(side_effect=ValueError("invalid api key"))
+        with self.assertRaises(ValueError):
+            retry_generate(generate, "prompt", "fake-key")
+        generate.assert_called_once()
+        mock_sleep.assert_not_called()
+
+    @patch("api.generate_microcourse.call_llm")
+    def test_repairable_output_needs_no_second_call(self, mock_llm):
+        mock_llm.return_value = 'Here you go: {"section_title": "Intro", "content": "Hi", "generate_code": True,}'
+        data, error = retry_generate(_generate_main_section, "prompt", "fake-key")
+        self.assertIsNone(error)
+        self.assertTrue(data["generate_code"])
+        mock_llm.assert_called_once()
+        self.assertEqual(llm_output_stats.snapshot(), {"repaired": 1})
+
+
 class GenerateMainSectionTests(TestCase):
     """Verify _generate_main_section handles the str return from call_llm."""
 
@@ -137,40 +948,6 @@ class GenerateMathExpressionsTests(TestCase):
         self.assertIn("Error parsing math expressions JSON", error)
 
 
-class GenerateMathExpressionsRefinedTests(TestCase):
-    """Test _generate_math_expressions_refined parsing paths."""
-
-    @patch("api.generate_microcourse.call_llm")
-    def test_valid_json_array(self, mock_llm):
-        expressions = [{"description": "Area", "expression": "$A=\\pi r^2$"}]
-        mock_llm.return_value = json.dumps(expressions)
-        data, error = _generate_math_expressions_refined("prompt", "fake-key")
-        self.assertIsNone(error)
-        self.assertEqual(data, expressions)
-
-    @patch("api.generate_microcourse.call_llm")
-    def test_extracts_array_from_text(self, mock_llm):
-        expressions = [{"description": "Sum", "expression": "$\\sum_{i=1}^n i$"}]
-        mock_llm.return_value = f'Result: {json.dumps(expressions)} end'
-        data, error = _generate_math_expressions_refined("prompt", "fake-key")
-        self.assertIsNone(error)
-        self.assertEqual(data, expressions)
-
-    @patch("api.generate_microcourse.call_llm")
-    def test_empty_array(self, mock_llm):
-        mock_llm.return_value = "[]"
-        data, error = _generate_math_expressions_refined("prompt", "fake-key")
-        self.assertIsNone(error)
-        self.assertEqual(data, [])
-
-    @patch("api.generate_microcourse.call_llm")
-    def test_unparseable(self, mock_llm):
-        mock_llm.return_value = "garbage"
-        data, error = _generate_math_expressions_refined("prompt", "fake-key")
-        self.assertIsNone(data)
-        self.assertIn("Error parsing math expressions JSON", error)
-
-
 class DocumentRelevancyCheckTests(TestCase):
     """Test document_relevancy_check parsing."""
 
@@ -194,6 +971,118 @@ class DocumentRelevancyCheckTests(TestCase):
         self.assertEqual(result["reason"], "Parsing error")
 
 
+class RelevancyScoringModeTests(TestCase):
+    def _docs(self, *texts):
+        from langchain.schema import Document
+
+        return [Document(page_content=text) for text in texts]
+
+    @patch("api.generate_microcourse.call_llm")
+    def test_batch_mode_scores_all_docs_in_one_call(self, mock_llm):
+        mock_llm.return_value = json.dumps([
+            {"index": 1, "relevant": "no", "score": 0.1, "reason": "Off topic"},
+            {"index": 0, "relevant": "yes", "score": 0.9, "reason": "On topic"},
+        ])
+        results = score_documents_relevancy("Python", self._docs("python", "cooking"), "fake-key", mode="batch")
+        self.assertEqual(mock_llm.call_count, 1)
+        self.assertEqual(results, [
+            {"relevant": "yes", "score": 0.9, "reason": "On topic"},
+            {"relevant": "no", "score": 0.1, "reason": "Off topic"},
+        ])
+
+    @patch("api.generate_microcourse.call_llm")
+    def test_batch_mode_falls_back_to_per_doc_checks(self, mock_llm):
+        per_doc = json.dumps({"relevant": "yes", "score": 0.8, "reason": "ok"})
+        mock_llm.side_effect = ["not json", per_doc, per_doc]
+        results = score_documents_relevancy("Python", self._docs("a", "b"), "fake-key", mode="batch")
+        self.assertEqual(mock_llm.call_count, 3)
+        self.assertEqual([r["score"] for r in results], [0.8, 0.8])
+
+    @patch("api.generate_microcourse.call_llm")
+    def test_concurrent_mode_keeps_document_order(self, mock_llm):
+        def respond(prompt, key):
+            score = 0.9 if "python" in prompt else 0.2
+            return json.dumps({"relevant": "yes" if score > 0.5 else "no", "score": score, "reason": ""})
+
+        mock_llm.side_effect = respond
+        docs = self._docs("python", "cooking", "python again")
+        kept = filter_relevant_docs("Topic", docs, "fake-key", mode="concurrent", max_concurrency=2)
+        self.assertEqual(mock_llm.call_count, 3)
+        self.assertEqual([doc.page_content for doc in kept], ["python", "python again"])
+
+    @patch("django.db.close_old_connections")
+    @patch("api.generate_microcourse.call_llm", return_value=json.dumps({"relevant": "yes", "score": 0.9, "reason": ""}))
+    def test_concurrent_checks_close_stale_connections(self, _mock_llm, mock_close):
+        score_documents_relevancy("Topic", self._docs("a", "b", "c"), "fake-key", mode="concurrent", max_concurrency=2)
+        self.assertEqual(mock_close.call_count, 6)
+
+
+class SimilarityPrefilterTests(TestCase):
+    def setUp(self):
+        relevancy_prefilter_stats.reset()
+
+    @staticmethod
+    def _scored(*pairs):
+        from langchain.schema import Document
+
+        # Squared L2 distance for unit vectors with the given cosine similarity.
+        return [(Document(page_content=text), 2 - 2 * similarity) for text, similarity in pairs]
+
+    def test_splits_by_thresholds(self):
+        scored = self._scored(("close", 0.95), ("middle", 0.8), ("far", 0.3))
+        accepted, ambiguous = prefilter_by_similarity(scored, accept_threshold=0.9, reject_threshold=0.7)
+        self.assertEqual([doc.page_content for doc in accepted], ["close"])
+        self.assertEqual([doc.page_content for doc in ambiguous], ["middle"])
+        self.assertEqual(relevancy_prefilter_stats.snapshot(), {
+            "accepted": 1, "rejected": 1, "sent_to_llm": 1, "llm_calls_avoided": 2,
+        })
+
+    @patch("api.generate_microcourse.RELEVANCY_ACCEPT_SIMILARITY", 0.9)
+    @patch("api.generate_microcourse.RELEVANCY_REJECT_SIMILARITY", 0.7)
+    @patch("api.generate_microcourse.call_llm")
+    def test_only_ambiguous_chunks_reach_the_llm(self, mock_llm):
+        mock_llm.return_value = json.dumps([{"index": 0, "relevant": "yes", "score": 0.9, "reason": ""}])
+        vectorstore = MagicMock()
+        vectorstore.similarity_search_with_score.return_value = self._scored(
+            ("close", 0.95), ("middle", 0.8), ("far", 0.3),
+        )
+
+        context = get_finetuning_context("Topic", None, "", "fake-key", vectorstore=vectorstore)
+
+        self.assertEqual(context, "close\n\nmiddle")
+        self.assertEqual(mock_llm.call_count, 1)
+        self.assertIn("middle", mock_llm.call_args[0][0])
+        self.assertNotIn("far", mock_llm.call_args[0][0])
+
+    @patch("api.context_packing._encoding", return_value=None)
+    def test_context_is_packed_into_token_budget(self, _mock_encoding):
+        vectorstore = MagicMock()
+        vectorstore.similarity_search_with_score.return_value = self._scored(("a" * 40, 0.99), ("b" * 400, 0.98))
+        context = get_finetuning_context("Topic", None, "", "fake-key", vectorstore=vectorstore, token_budget=20)
+        self.assertEqual(context, "a" * 40)
+
+
+@patch("api.context_packing._encoding", return_value=None)
+class ContextPackingTests(TestCase):
+    def setUp(self):
+        context_packing_stats.reset()
+
+    def test_whole_chunks_are_packed_in_rank_order_within_budget(self, _mock_encoding):
+        chunks = ["first " * 10, "too long " * 100, "third " * 10]
+        packed = pack_context(chunks, token_budget=40, model="gpt-3.5-turbo")
+        self.assertEqual(packed.text, ("first " * 10).strip() + "\n\n" + ("third " * 10).strip())
+        self.assertEqual((packed.chunks, packed.skipped), (2, 1))
+        self.assertLessEqual(packed.tokens, 40)
+
+    def test_duplicates_and_splitter_overlap_are_removed(self, _mock_encoding):
+        shared = "This sentence is shared by two neighbouring chunks of the source."
+        chunks = ["Opening text. " + shared, shared + " Closing text.", "Opening text.  " + shared]
+        packed = pack_context(chunks, token_budget=1000, model="gpt-3.5-turbo")
+        self.assertEqual(packed.text, "Opening text. " + shared + "\n\nClosing text.")
+        self.assertEqual(packed.duplicates, 1)
+        self.assertEqual(context_packing_stats.snapshot()["chunks_deduplicated"], 1)
+
+
 class HallucinationDetectionTests(TestCase):
     """Test hallucination_detection parsing."""
 
@@ -224,6 +1113,711 @@ class HallucinationDetectionTests(TestCase):
         self.assertEqual(result["details"], "Parsing error")
 
 
+class CountingEmbeddings(Embeddings):
+    """Deterministic embedder that records which texts were sent to it."""
+
+    def __init__(self):
+        self.embedded = []
+
+    def embed_documents(self, texts):
+        self.embedded.extend(texts)
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class EmbeddingCacheTests(TestCase):
+    def test_only_unseen_chunks_are_embedded(self):
+        stats = CacheStats("test")
+        underlying = CountingEmbeddings()
+        embeddings = CacheBackedEmbeddings.from_bytes_store(
+            underlying, DatabaseByteStore(stats=stats), namespace="test-model",
+        )
+
+        first = embeddings.embed_documents(["alpha", "beta"])
+        second = embeddings.embed_documents(["alpha", "beta", "gamma"])
+
+        self.assertEqual(underlying.embedded, ["alpha", "beta", "gamma"])
+        self.assertEqual(second[:2], first)
+        self.assertEqual(stats.snapshot()["hits"], 2)
+        self.assertEqual(stats.snapshot()["misses"], 3)
+
+    def test_keys_are_scoped_by_model(self):
+        underlying = CountingEmbeddings()
+        store = DatabaseByteStore(stats=CacheStats("test"))
+        CacheBackedEmbeddings.from_bytes_store(underlying, store, namespace="model-a").embed_documents(["alpha"])
+        CacheBackedEmbeddings.from_bytes_store(underlying, store, namespace="model-b").embed_documents(["alpha"])
+        self.assertEqual(underlying.embedded, ["alpha", "alpha"])
+
+    def test_least_recently_used_entries_are_evicted(self):
+        store = DatabaseByteStore(max_entries=2, stats=CacheStats("test"))
+        store.mset([("a", b"1"), ("b", b"2")])
+        EmbeddingCacheEntry.objects.filter(key="a").update(last_used="2000-01-01T00:00:00Z")
+        store.mset([("c", b"3")])
+        self.assertEqual(sorted(store.yield_keys()), ["b", "c"])
+
+
+class LoadFinetuningSourcesTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        os.makedirs(os.path.join(self.tmpdir.name, "pdfs"))
+        for name in ("a.pdf", "b.pdf"):
+            open(os.path.join(self.tmpdir.name, "pdfs", name), "wb").close()
+        self.settings_override = override_settings(MEDIA_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    @staticmethod
+    def _fake_fetch(url):
+        if "slow" in url:
+            time.sleep(0.2)
+        if "broken" in url:
+            raise ConnectionError("unreachable")
+        return url
+
+    @patch("api.generate_microcourse.fetch_url_text")
+    def test_keeps_input_order_and_isolates_errors(self, mock_fetch):
+        mock_fetch.side_effect = lambda url: f"text of {self._fake_fetch(url)}"
+        urls = json.dumps(["http://slow.test", "http://broken.test", "http://fast.test"])
+
+        results = load_finetuning_sources(None, urls)
+
+        self.assertEqual([r["source"] for r in results], ["http://slow.test", "http://broken.test", "http://fast.test"])
+        self.assertEqual(results[0]["docs"][0].page_content, "text of http://slow.test")
+        self.assertIn("unreachable", results[1]["error"])
+        self.assertEqual(results[1]["docs"], [])
+        self.assertEqual(len(results[2]["docs"]), 1)
+        self.assertGreaterEqual(results[0]["elapsed"], 0.2)
+
+    @patch("api.generate_microcourse.fetch_url_text")
+    def test_slow_source_times_out_alone(self, mock_fetch):
+        mock_fetch.side_effect = self._fake_fetch
+
+        results = load_finetuning_sources(None, ["http://slow.test", "http://fast.test"], timeout=0.05)
+
+        self.assertIn("Timed out", results[0]["error"])
+        self.assertIsNone(results[1]["error"])
+
+    @patch("api.generate_microcourse.INGEST_URL_WORKERS", 2)
+    @patch("api.generate_microcourse._load_url_source")
+    def test_only_a_pool_of_sources_is_loaded_ahead(self, mock_load):
+        started = []
+        mock_load.side_effect = lambda url: started.append(url) or [url]
+        urls = [f"http://site{number}.test" for number in range(10)]
+
+        sources = iter_finetuning_sources(None, urls)
+        self.assertEqual(next(sources)["docs"], [urls[0]])
+        time.sleep(0.1)
+        # Two loaded ahead, plus the one started when the first was handed over.
+        self.assertEqual(len(started), 3)
+        self.assertEqual([result["source"] for result in sources], urls[1:])
+        self.assertEqual(len(started), 10)
+
+    @patch("api.generate_microcourse._run_in_process", lambda loader, source, timeout: loader(source))
+    @patch("api.generate_microcourse.fetch_url_text", side_effect=lambda url: url)
+    @patch("api.generate_microcourse.PyPDFLoader")
+    def test_pdfs_come_before_urls(self, mock_loader, _mock_fetch):
+        from langchain.schema import Document
+
+        mock_loader.side_effect = lambda path: MagicMock(lazy_load=lambda: iter([Document(page_content=os.path.basename(path))]))
+
+        results = load_finetuning_sources(["a.pdf", "missing.pdf", "b.pdf"], "http://site.test")
+
+        self.assertEqual([r["type"] for r in results], ["pdf", "pdf", "url"])
+        self.assertEqual([r["docs"][0].page_content for r in results], ["a.pdf", "b.pdf", "http://site.test"])
+
+
+
+class DbConnectionWrapperTests(TestCase):
+    @patch("django.db.close_old_connections")
+    def test_stale_connections_are_closed_around_each_call(self, mock_close):
+        calls = []
+        wrapped = with_db_connections(lambda value: calls.append(mock_close.call_count) or value * 2)
+        self.assertEqual(wrapped(3), 6)
+        self.assertEqual(calls, [1])
+        self.assertEqual(mock_close.call_count, 2)
+
+
+class PdfProcessTests(TestCase):
+    def test_result_comes_back_from_the_child(self):
+        self.assertEqual(_run_in_process(len, "abc", 20), 3)
+
+    def test_child_errors_are_reported(self):
+        with self.assertRaisesRegex(RuntimeError, "ValueError"):
+            _run_in_process(int, "not a number", 20)
+
+    def test_overrunning_child_is_killed_without_affecting_others(self):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            hung = pool.submit(_run_in_process, time.sleep, 30, 1)
+            time.sleep(0.2)
+            healthy = pool.submit(_run_in_process, len, "abcd", 20)
+            started = time.perf_counter()
+            with self.assertRaises(TimeoutError):
+                hung.result(timeout=20)
+            self.assertLess(time.perf_counter() - started, 20)
+            self.assertEqual(healthy.result(timeout=20), 4)
+        # The slots are released again.
+        self.assertEqual(_run_in_process(len, "ab", 20), 2)
+
+
+class UrlTextCacheTests(TestCase):
+    """Exercise fetch_url_text against a local HTTP server that honours validators."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        pages = cls.pages = {}
+        requests_seen = cls.requests_seen = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body, etag = pages[self.path]
+                requests_seen.append((self.path, self.headers.get("If-None-Match")))
+                if etag and self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                if etag:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.pages.clear()
+        self.requests_seen.clear()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.cache = UrlTextCache(root=self.tmpdir.name, max_bytes=10_000)
+        cache_patch = patch("api.caches.url_text_cache", self.cache)
+        cache_patch.start()
+        self.addCleanup(cache_patch.stop)
+        extract_patch = patch(
+            "api.generate_microcourse.trafilatura.extract",
+            side_effect=lambda content: f"extracted {content.decode()}",
+        )
+        self.mock_extract = extract_patch.start()
+        self.addCleanup(extract_patch.stop)
+
+    def test_revalidates_with_etag_and_reuses_text_on_304(self):
+        self.pages["/page"] = (b"v1", '"etag-1"')
+        url = self.base_url + "/page"
+
+        self.assertEqual(fetch_url_text(url), "extracted v1")
+        self.assertEqual(fetch_url_text(url), "extracted v1")
+        self.assertEqual(self.requests_seen, [("/page", None), ("/page", '"etag-1"')])
+        self.assertEqual(self.mock_extract.call_count, 1)
+
+        self.pages["/page"] = (b"v2", '"etag-2"')
+        self.assertEqual(fetch_url_text(url), "extracted v2")
+        self.assertEqual(self.mock_extract.call_count, 2)
+
+    def test_unchanged_bytes_skip_extraction_without_validators(self):
+        self.pages["/plain"] = (b"same", None)
+        url = self.base_url + "/plain"
+        fetch_url_text(url)
+        fetch_url_text(url)
+        self.assertEqual(len(self.requests_seen), 2)
+        self.assertEqual(self.mock_extract.call_count, 1)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = UrlTextCache(root=self.tmpdir.name, max_bytes=10_000)
+        for number in range(3):
+            cache.set(f"http://site.test/{number}", "x" * 100, "hash")
+            os.utime(cache._path(f"http://site.test/{number}"), (number, number))
+        # Room for three entries, so storing a fourth evicts one.
+        cache.max_bytes = os.path.getsize(cache._path("http://site.test/0")) * 3 + 10
+        cache.touch("http://site.test/0")
+        cache.set("http://site.test/3", "x" * 100, "hash")
+
+        self.assertIsNotNone(cache.get("http://site.test/0"))
+        self.assertIsNone(cache.get("http://site.test/1"))
+        self.assertIsNotNone(cache.get("http://site.test/3"))
+
+
+class StreamingIngestionTests(TestCase):
+    @staticmethod
+    def _pages(count, size=10):
+        from langchain.schema import Document
+
+        for number in range(count):
+            yield Document(page_content="x" * size, metadata={"page": number})
+
+    @patch("api.generate_microcourse.PyPDFLoader")
+    def test_page_cap(self, mock_loader):
+        mock_loader.return_value.lazy_load.return_value = self._pages(100)
+        pages = list(iter_pdf_pages("book.pdf", max_pages=3, max_bytes=10_000))
+        self.assertEqual([page.metadata["page"] for page in pages], [0, 1, 2])
+
+    @patch("api.generate_microcourse.PyPDFLoader")
+    def test_byte_cap(self, mock_loader):
+        mock_loader.return_value.lazy_load.return_value = self._pages(100, size=40)
+        pages = list(iter_pdf_pages("book.pdf", max_pages=100, max_bytes=100))
+        self.assertEqual(len(pages), 2)
+
+    @patch("api.generate_microcourse.iter_finetuning_sources")
+    def test_stops_once_enough_text_is_collected(self, mock_sources):
+        sources_closed = []
+
+        def sources(*args, **kwargs):
+            try:
+                for number in range(5):
+                    yield {"source": f"s{number}", "docs": list(self._pages(2, size=30))}
+            finally:
+                sources_closed.append(True)
+
+        mock_sources.side_effect = sources
+        docs = list(iter_finetuning_docs(["a.pdf"], "", max_total_bytes=100))
+        self.assertEqual(len(docs), 4)
+        self.assertEqual(sources_closed, [True])
+
+    @patch("api.generate_microcourse.EMBEDDING_BATCH_SIZE", 2)
+    @patch("api.generate_microcourse.Chroma")
+    @patch("api.generate_microcourse.get_embeddings")
+    def test_chunks_are_embedded_in_batches(self, _mock_embeddings, mock_chroma):
+        vectorstore, chunk_count = _index_documents(self._pages(5), "test", "fake-key")
+        self.assertEqual(chunk_count, 5)
+        batch_sizes = [len(call.args[0]) for call in mock_chroma.return_value.add_documents.call_args_list]
+        self.assertEqual(batch_sizes, [2, 2, 1])
+
+
+class CourseVectorstoreTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.settings_override = override_settings(VECTOR_STORE_ROOT=self.tmpdir.name)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    @patch("api.generate_microcourse.get_embeddings")
+    @patch("api.generate_microcourse.iter_finetuning_docs")
+    def test_index_is_built_once_and_reopened(self, mock_load, mock_embeddings):
+        from langchain.schema import Document
+
+        mock_load.return_value = iter([Document(page_content="Photosynthesis converts light.")])
+        mock_embeddings.return_value = CountingEmbeddings()
+
+        built = build_course_vectorstore("abc123", ["book.pdf"], "", "fake-key")
+        self.assertIsNotNone(built)
+        self.assertTrue(os.path.isdir(os.path.join(self.tmpdir.name, "abc123")))
+
+        reopened = load_course_vectorstore("abc123", "fake-key")
+        results = reopened.similarity_search("light", k=1)
+        self.assertEqual(results[0].page_content, "Photosynthesis converts light.")
+        self.assertEqual(mock_load.call_count, 1)
+
+        delete_course_vectorstore("abc123")
+        self.assertIsNone(load_course_vectorstore("abc123", "fake-key"))
+
+    @patch("api.generate_microcourse.iter_finetuning_docs")
+    def test_no_sources_builds_no_index(self, mock_load):
+        mock_load.return_value = iter([])
+        self.assertIsNone(build_course_vectorstore("empty", [], "", "fake-key"))
+        self.assertIsNone(load_course_vectorstore("", "fake-key"))
+
+
+class EnrichmentStageTests(TestCase):
+    main_section = {"content": "Body", "generate_code": True, "generate_math": True}
+
+    @patch("api.generate_microcourse.hallucination_detection")
+    @patch("api.generate_microcourse.generate_math_expressions_section")
+    @patch("api.generate_microcourse.generate_code_examples_section")
+    def test_stages_run_concurrently(self, mock_code, mock_math, mock_hallucination):
+        def slow(result):
+            def run(*args):
+                time.sleep(0.2)
+                return result
+            return run
+
+        mock_code.side_effect = slow([{"description": "c", "code": "x"}])
+        mock_math.side_effect = slow([{"description": "m", "expression": "$x$"}])
+        mock_hallucination.side_effect = slow({"hallucination_detected": "no"})
+
+        started = time.monotonic()
+        code, math, hallucination = run_enrichment_stages("Topic", self.main_section, "ctx", "fake-key")
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(code[0]["description"], "c")
+        self.assertEqual(math[0]["description"], "m")
+        self.assertEqual(hallucination["hallucination_detected"], "no")
+        mock_math.assert_called_once_with("Topic", "Body", "fake-key")
+
+    @patch("api.generate_microcourse.hallucination_detection")
+    @patch("api.generate_microcourse.generate_math_expressions_section")
+    @patch("api.generate_microcourse.generate_code_examples_section")
+    def test_slow_stage_falls_back_to_empty_result(self, mock_code, mock_math, mock_hallucination):
+        def stuck(*args):
+            time.sleep(0.3)
+            return [{"description": "late", "code": ""}]
+
+        mock_code.side_effect = stuck
+        mock_math.return_value = [{"description": "m", "expression": "$x$"}]
+        mock_hallucination.return_value = {"hallucination_detected": "no"}
+
+        section_stage_stats.reset()
+        code, math, _ = run_enrichment_stages("Topic", self.main_section, "ctx", "fake-key", timeout=0.05)
+        self.assertEqual(code, [])
+        self.assertEqual(math[0]["description"], "m")
+        self.assertEqual(section_stage_stats.snapshot(), {"code_examples_timeout": 1})
+
+    @patch("api.generate_microcourse._section_stage_executor", ThreadPoolExecutor(max_workers=1))
+    @patch("api.generate_microcourse.hallucination_detection", return_value={"hallucination_detected": "no"})
+    @patch("api.generate_microcourse.generate_math_expressions_section")
+    @patch("api.generate_microcourse.generate_code_examples_section")
+    def test_each_stage_has_its_own_timeout(self, mock_code, mock_math, _mock_hallucination):
+        def slow(result):
+            def run(*args):
+                time.sleep(0.2)
+                return result
+            return run
+
+        mock_code.side_effect = slow([{"description": "c", "code": "x"}])
+        mock_math.side_effect = slow([{"description": "m", "expression": "$x$"}])
+
+        events = list(iter_enrichment_stages("Topic", self.main_section, "ctx", "fake-key", timeout=0.3))
+        # Math only starts once code is done, and still gets its full timeout; the
+        # hallucination check is still queued when its time to start runs out.
+        self.assertEqual(
+            [name for name, _ in events],
+            ["code_examples", "stage_timeout", "math_expressions"],
+        )
+        self.assertEqual(events[1][1], {"stage": "hallucination", "timeout": 0.3})
+
+    @patch("django.db.close_old_connections")
+    @patch("api.generate_microcourse.hallucination_detection", return_value={"hallucination_detected": "no"})
+    @patch("api.generate_microcourse.generate_math_expressions_section", return_value=[])
+    @patch("api.generate_microcourse.generate_code_examples_section", return_value=[])
+    def test_stages_close_stale_connections(self, _mock_code, _mock_math, _mock_hallucination, mock_close):
+        run_enrichment_stages("Topic", self.main_section, "ctx", "fake-key")
+        self.assertEqual(mock_close.call_count, 6)
+
+    @patch("api.generate_microcourse.hallucination_detection", return_value={})
+    @patch("api.generate_microcourse.generate_math_expressions_section")
+    @patch("api.generate_microcourse.generate_code_examples_section")
+    def test_disabled_stages_are_skipped(self, mock_code, mock_math, _mock_hallucination):
+        code, math, _ = run_enrichment_stages("Topic", {"content": "Body"}, "ctx", "fake-key")
+        self.assertEqual((code, math), ([], []))
+        mock_code.assert_not_called()
+        mock_math.assert_not_called()
+
+
+class SectionEventStreamTests(TestCase):
+    main_output = json.dumps({
+        "section_title": "Intro",
+        "content": "Body",
+        "vocabulary": {"term": "definition"},
+        "quiz": {"question": "Q?", "options": {"A": "a"}, "correct_answer": "A"},
+        "recall_notes": ["note"],
+        "generate_code": True,
+        "generate_math": False,
+    })
+
+    @patch("api.generate_microcourse.hallucination_detection", return_value={"hallucination_detected": "no"})
+    @patch("api.generate_microcourse.generate_code_examples_section", return_value=[{"description": "c", "code": "x"}])
+    @patch("api.generate_microcourse.perform_web_search", return_value="")
+    @patch("api.generate_microcourse.get_finetuning_context", return_value="context")
+    @patch("api.generate_microcourse.stream_llm")
+    def test_events_stream_tokens_then_stages(self, mock_stream, *_mocks):
+        half = len(self.main_output) // 2
+        mock_stream.side_effect = [
+            iter(["not json"]),
+            iter([self.main_output[:half], self.main_output[half:]]),
+        ]
+
+        events = list(iter_microcourse_section_events("Topic", openai_api_key="fake-key"))
+        names = [name for name, _ in events]
+        self.assertEqual(names[:5], ["retrieval", "token", "retry", "token", "token"])
+        self.assertEqual(names[5], "main_section")
+        self.assertEqual(set(names[6:8]), {"code_examples", "hallucination"})
+        self.assertEqual(names[-1], "section")
+        section = events[-1][1]
+        self.assertEqual(json.loads(section["code_examples"])[0]["description"], "c")
+        self.assertEqual(json.loads(section["math_expressions"]), [])
+
+
+    @patch("api.generate_microcourse.time.sleep")
+    @patch("api.generate_microcourse.hallucination_detection", return_value={})
+    @patch("api.generate_microcourse.generate_code_examples_section", return_value=[])
+    @patch("api.generate_microcourse.perform_web_search", return_value="")
+    @patch("api.generate_microcourse.get_finetuning_context", return_value="context")
+    @patch("api.generate_microcourse.stream_llm")
+    def test_rate_limited_stream_backs_off_like_retry_generate(self, mock_stream, *mocks):
+        mock_sleep = mocks[-1]
+
+        def rate_limited(*args, **kwargs):
+            raise RetryGenerateTests._rate_limit_error("3")
+            yield  # pragma: no cover
+
+        mock_stream.side_effect = [rate_limited(), iter([self.main_output])]
+        events = list(iter_microcourse_section_events("Topic", openai_api_key="fake-key"))
+        retry = next(data for name, data in events if name == "retry")
+        self.assertEqual(retry["reason"], "rate_limit")
+        self.assertGreaterEqual(mock_sleep.call_args[0][0], 3)
+        self.assertEqual(events[-1][0], "section")
+
+    @patch("api.generate_microcourse.time.sleep")
+    @patch("api.generate_microcourse.perform_web_search", return_value="")
+    @patch("api.generate_microcourse.get_finetuning_context", return_value="context")
+    @patch("api.generate_microcourse.stream_llm", side_effect=ValueError("invalid api key"))
+    def test_fatal_stream_errors_are_not_retried(self, mock_stream, _mock_context, _mock_search, mock_sleep):
+        with self.assertRaises(ValueError):
+            list(iter_microcourse_section_events("Topic", openai_api_key="fake-key"))
+        mock_stream.assert_called_once()
+        mock_sleep.assert_not_called()
+
+
+class AsyncPipelineTests(TestCase):
+    def _fake_llm(self, prompt, key):
+        if "hallucination_detected" in prompt:
+            return json.dumps({"hallucination_detected": "no", "details": ""})
+        return json.dumps({
+            "section_title": "Intro",
+            "content": "Body",
+            "vocabulary": {"term": "definition"},
+            "quiz": {"question": "Q?", "options": {"A": "a"}, "correct_answer": "A"},
+            "recall_notes": ["note"],
+            "generate_code": False,
+            "generate_math": False,
+        })
+
+    @patch("api.generate_microcourse_async.aperform_web_search")
+    @patch("api.generate_microcourse_async.acall_llm")
+    def test_generates_combined_section(self, mock_llm, mock_search):
+        async def fake_llm(prompt, key, **kwargs):
+            return self._fake_llm(prompt, key)
+
+        async def fake_search(query, key):
+            return "web context"
+
+        mock_llm.side_effect = fake_llm
+        mock_search.side_effect = fake_search
+        vectorstore = MagicMock()
+        vectorstore.similarity_search_with_score.return_value = []
+
+        section = asyncio.run(agenerate_microcourse_section("Topic", openai_api_key="fake-key", vectorstore=vectorstore))
+        self.assertEqual(section["section_title"], "Intro")
+        self.assertEqual(json.loads(section["vocabulary"]), {"term": "definition"})
+        self.assertEqual(json.loads(section["code_examples"]), [])
+        self.assertIn("web context", mock_llm.call_args_list[0][0][0])
+
+    @patch("api.generate_microcourse_async.ahallucination_detection")
+    @patch("api.generate_microcourse_async.agenerate_math_expressions_section")
+    @patch("api.generate_microcourse_async.agenerate_code_examples_section")
+    def test_enrichment_stages_overlap(self, mock_code, mock_math, mock_hallucination):
+        def slow(result):
+            async def run(*args):
+                await asyncio.sleep(0.2)
+                return result
+            return run
+
+        mock_code.side_effect = slow([{"description": "c", "code": "x"}])
+        mock_math.side_effect = slow([{"description": "m", "expression": "$x$"}])
+        mock_hallucination.side_effect = slow({"hallucination_detected": "no"})
+
+        started = time.monotonic()
+        code, math, _ = asyncio.run(arun_enrichment_stages(
+            "Topic", {"content": "Body", "generate_code": True, "generate_math": True}, "ctx", "fake-key",
+        ))
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(code[0]["description"], "c")
+        self.assertEqual(math[0]["description"], "m")
+
+    @patch("api.generate_microcourse_async.ahallucination_detection")
+    @patch("api.generate_microcourse_async.agenerate_math_expressions_section")
+    @patch("api.generate_microcourse_async.agenerate_code_examples_section")
+    def test_timed_out_stage_is_counted(self, mock_code, mock_math, mock_hallucination):
+        async def stuck(*args):
+            await asyncio.sleep(1)
+
+        async def done(*args):
+            return {"hallucination_detected": "no"}
+
+        mock_code.side_effect = stuck
+        mock_hallucination.side_effect = done
+        section_stage_stats.reset()
+        code, math, hallucination = asyncio.run(arun_enrichment_stages(
+            "Topic", {"content": "Body", "generate_code": True}, "ctx", "fake-key", timeout=0.05,
+        ))
+        self.assertEqual((code, math), ([], []))
+        self.assertEqual(hallucination, {"hallucination_detected": "no"})
+        self.assertEqual(section_stage_stats.snapshot(), {"code_examples_timeout": 1})
+        mock_math.assert_not_called()
+
+
+class GenerationJobTests(APITestCase):
+    section_data = {
+        "section_title": "Introduction",
+        "content": "Queued content",
+        "code_examples": "[]",
+        "math_expressions": "[]",
+        "vocabulary": json.dumps({"term": "definition"}),
+        "quiz": json.dumps({"question": "Q?", "options": {"A": "A"}, "correct_answer": "A"}),
+        "recall_notes": json.dumps(["note"]),
+    }
+
+    def _enqueue_course(self):
+        payload = {
+            "title": "Queued Course",
+            "topic": "Testing",
+            "complexity": "Beginner",
+            "target_audience": "Students",
+            "openai_key": "test-key",
+        }
+        return self.client.post("/api/jobs/add_microcourse/", data=payload, format="multipart")
+
+    def test_enqueue_returns_202_without_generating(self):
+        with patch("api.jobs.generate_microcourse_section") as mock_generate:
+            response = self._enqueue_course()
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.json()["status"], GenerationJob.STATUS_QUEUED)
+        mock_generate.assert_not_called()
+        job = GenerationJob.objects.get(pk=response.json()["id"])
+        self.assertNotIn("test-key", json.dumps(job.payload))
+        self.assertEqual(Microcourse.objects.count(), 0)
+
+    @patch("api.jobs.build_course_vectorstore", return_value=None)
+    @patch("api.jobs.generate_microcourse_section")
+    def test_worker_runs_job_and_reports_result(self, mock_generate, _mock_build):
+        stages = []
+
+        def generate(*args, **kwargs):
+            self.assertEqual(kwargs["openai_api_key"], "test-key")
+            kwargs["on_stage"]("main_section")
+            stages.append(GenerationJob.objects.get().stage)
+            return self.section_data
+
+        mock_generate.side_effect = generate
+        job_id = self._enqueue_course().json()["id"]
+
+        self.assertEqual(run_worker(stop_when_idle=True), 1)
+        self.assertEqual(stages, ["main_section"])
+        data = self.client.get(f"/api/jobs/{job_id}/").json()
+        self.assertEqual(data["status"], GenerationJob.STATUS_SUCCEEDED)
+        self.assertEqual(data["stage"], "done")
+        self.assertEqual(data["result"]["title"], "Queued Course")
+        self.assertEqual(data["result"]["sections"][0]["content"], "Queued content")
+        self.assertNotIn("keys", GenerationJob.objects.get().payload)
+
+    @override_settings(GENERATION_JOB_RETRY_DELAY=0)
+    @patch("api.jobs.delete_course_vectorstore")
+    @patch("api.jobs.build_course_vectorstore", side_effect=RuntimeError("embedding failed"))
+    @patch("api.jobs.generate_microcourse_section")
+    def test_failed_indexing_removes_the_partial_index(self, mock_generate, mock_build, mock_delete):
+        self._enqueue_course()
+        run_worker(stop_when_idle=True)
+
+        job = GenerationJob.objects.get()
+        self.assertEqual((job.status, job.error), (GenerationJob.STATUS_FAILED, "embedding failed"))
+        mock_generate.assert_not_called()
+        built = [call.args[0] for call in mock_build.call_args_list]
+        self.assertEqual([call.args[0] for call in mock_delete.call_args_list], built)
+
+    @override_settings(GENERATION_JOB_RETRY_DELAY=0)
+    @patch("api.jobs.load_course_vectorstore", return_value=None)
+    @patch("api.jobs.generate_microcourse_section")
+    def test_failed_job_is_retried_then_marked_failed(self, mock_generate, _mock_load):
+        mock_generate.side_effect = [Exception("boom"), self.section_data]
+        microcourse = Microcourse.objects.create(
+            title="Course", topic="Topic", complexity="Beginner", target_audience="Learners",
+        )
+        response = self.client.post(
+            "/api/jobs/generate_next_section/",
+            data={"microcourseId": microcourse.id, "previousSection": "Prev", "openai_key": "test-key"},
+            format="json",
+        )
+        self.assertEqual(response.status_code, 202)
+
+        self.assertEqual(run_worker(stop_when_idle=True), 2)
+        job = GenerationJob.objects.get()
+        self.assertEqual((job.status, job.attempts), (GenerationJob.STATUS_SUCCEEDED, 2))
+        self.assertEqual(microcourse.sections.count(), 1)
+
+        mock_generate.side_effect = Exception("still broken")
+        failing = enqueue_job(GenerationJob.KIND_SECTION, {}, {"openai": "test-key"}, microcourse=microcourse)
+        run_worker(stop_when_idle=True)
+        failing.refresh_from_db()
+        self.assertEqual(failing.status, GenerationJob.STATUS_FAILED)
+        self.assertEqual(failing.attempts, failing.max_attempts)
+        self.assertEqual(failing.error, "still broken")
+
+    def test_stale_job_is_requeued_until_its_attempts_run_out(self):
+        stale_at = timezone.now() - timedelta(seconds=settings.GENERATION_JOB_STALE_AFTER + 1)
+        job = enqueue_job(GenerationJob.KIND_COURSE, {}, {"openai": "test-key"})
+        for attempt in range(1, job.max_attempts + 1):
+            self.assertEqual(claim_job("worker-a").id, job.id)
+            # The worker dies mid-job and stops reporting progress.
+            GenerationJob.objects.filter(id=job.id).update(updated_at=stale_at)
+            requeue_stale_jobs()
+            job.refresh_from_db()
+            self.assertEqual(job.attempts, attempt)
+
+        self.assertEqual((job.status, job.stage), (GenerationJob.STATUS_FAILED, "failed"))
+        self.assertNotIn("keys", job.payload)
+        self.assertIsNone(claim_job("worker-a"))
+
+    @patch("api.jobs.delete_course_vectorstore")
+    @patch("api.jobs.build_course_vectorstore", return_value=None)
+    @patch("api.jobs.generate_microcourse_section")
+    def test_job_taken_over_by_another_worker_is_not_persisted_twice(self, mock_generate, _mock_build, mock_delete):
+        def generate(*args, **kwargs):
+            # The job went stale mid-generation and another worker claimed it.
+            GenerationJob.objects.update(worker="worker-b", attempts=F("attempts") + 1)
+            return self.section_data
+
+        mock_generate.side_effect = generate
+        self._enqueue_course()
+        job = claim_job("worker-a")
+
+        run_job(job)
+        self.assertEqual(Microcourse.objects.count(), 0)
+        mock_delete.assert_called_once()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker), (GenerationJob.STATUS_RUNNING, "worker-b"))
+        self.assertIn("keys", job.payload)
+
+    def test_exhausted_job_is_not_claimed(self):
+        job = enqueue_job(GenerationJob.KIND_COURSE, {}, {})
+        GenerationJob.objects.filter(id=job.id).update(attempts=job.max_attempts)
+        self.assertIsNone(claim_job("worker-a"))
+
+    def test_job_is_claimed_once(self):
+        enqueue_job(GenerationJob.KIND_COURSE, {}, {})
+        self.assertIsNotNone(claim_job("worker-a"))
+        self.assertIsNone(claim_job("worker-b"))
+
+    def test_unknown_job_returns_404(self):
+        self.assertEqual(self.client.get("/api/jobs/999/").status_code, 404)
+
+
+class JobHeartbeatTests(TransactionTestCase):
+    @override_settings(GENERATION_JOB_HEARTBEAT=0.05)
+    def test_running_job_is_kept_fresh_during_a_long_stage(self):
+        enqueue_job(GenerationJob.KIND_COURSE, {}, {})
+        job = claim_job("worker-a")
+        stale_at = timezone.now() - timedelta(seconds=settings.GENERATION_JOB_STALE_AFTER + 1)
+        GenerationJob.objects.filter(id=job.id).update(updated_at=stale_at)
+
+        with _heartbeat(job):
+            time.sleep(0.3)
+        self.assertEqual(requeue_stale_jobs(), 0)
+        self.assertGreater(GenerationJob.objects.get(id=job.id).updated_at, stale_at)
+
+
 class ApiLlmFlowTests(APITestCase):
     def _mock_section_data(self, generate_code=False, generate_math=False):
         code = json.dumps([{"description": "Ex", "code": "x=1"}]) if generate_code else "[]"
@@ -263,6 +1857,67 @@ class ApiLlmFlowTests(APITestCase):
         self.assertEqual(QuizQuestion.objects.count(), 1)
         self.assertEqual(RecallNote.objects.count(), 2)
 
+    @patch("api.views.build_course_vectorstore")
+    @patch("api.views.generate_microcourse_section")
+    def test_add_microcourse_builds_course_index(self, mock_generate, mock_build):
+        mock_generate.return_value = self._mock_section_data()
+        vectorstore = MagicMock()
+        mock_build.return_value = vectorstore
+
+        payload = {
+            "title": "Indexed Course",
+            "topic": "Testing",
+            "complexity": "Beginner",
+            "target_audience": "Students",
+            "openai_key": "test-key",
+        }
+
+        response = self.client.post("/api/add_microcourse/", data=payload, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        microcourse = Microcourse.objects.get()
+        self.assertEqual(microcourse.vector_index, mock_build.call_args[0][0])
+        self.assertIs(mock_generate.call_args.kwargs["vectorstore"], vectorstore)
+
+    @patch("api.views.delete_course_vectorstore")
+    @patch("api.views.create_microcourse", side_effect=Exception("db down"))
+    @patch("api.views.build_course_vectorstore", return_value=MagicMock())
+    @patch("api.views.generate_microcourse_section")
+    def test_add_microcourse_removes_the_index_when_saving_fails(self, mock_generate, mock_build, _mock_create, mock_delete):
+        mock_generate.return_value = self._mock_section_data()
+        payload = {"title": "T", "topic": "Topic", "complexity": "Beginner", "target_audience": "All", "openai_key": "k"}
+
+        response = self.client.post("/api/add_microcourse/", data=payload, format="multipart")
+        self.assertEqual(response.status_code, 500)
+        mock_delete.assert_called_once_with(mock_build.call_args[0][0])
+
+    @patch("api.views.load_course_vectorstore")
+    @patch("api.views.generate_microcourse_section")
+    def test_go_in_depth_reuses_course_index(self, mock_generate, mock_load):
+        mock_generate.return_value = self._mock_section_data()
+        vectorstore = MagicMock()
+        mock_load.return_value = vectorstore
+        microcourse = Microcourse.objects.create(
+            title="Course",
+            topic="Topic",
+            complexity="Beginner",
+            target_audience="Learners",
+            vector_index="abc123",
+        )
+
+        payload = {
+            "microcourseId": microcourse.id,
+            "previousSection": "Previous content",
+            "openai_key": "test-key",
+        }
+
+        response = self.client.post("/api/generate_next_section/", data=payload, format="json")
+        self.assertEqual(response.status_code, 200)
+        mock_load.assert_called_once_with("abc123", "test-key")
+        self.assertIs(mock_generate.call_args.kwargs["vectorstore"], vectorstore)
+        self.assertEqual(mock_generate.call_args.kwargs["course_summary"], "")
+        microcourse.refresh_from_db()
+        self.assertEqual(microcourse.summary, "- Introduction — Test content (key terms: term)")
+
     @patch("api.views.generate_microcourse_section")
     def test_add_microcourse_with_code_generation(self, mock_generate):
         mock_generate.return_value = self._mock_section_data(generate_code=True)
@@ -416,6 +2071,170 @@ class ApiLlmFlowTests(APITestCase):
         self.assertTrue(len(json.loads(section.code_examples)) > 0)
         self.assertTrue(len(json.loads(section.math_expressions)) > 0)
 
+    @patch("api.views.agenerate_microcourse_section")
+    def test_async_add_microcourse_creates_section_and_related(self, mock_generate):
+        mock_generate.return_value = self._mock_section_data()
+
+        payload = {
+            "title": "Async Course",
+            "topic": "Testing",
+            "complexity": "Beginner",
+            "target_audience": "Students",
+            "openai_key": "test-key",
+        }
+
+        response = self.client.post("/api/async/add_microcourse/", data=payload, format="multipart")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["title"], "Async Course")
+        self.assertEqual(MicrocourseSection.objects.count(), 1)
+        self.assertEqual(RecallNote.objects.count(), 2)
+
+    @patch("api.views.delete_course_vectorstore")
+    @patch("api.views.create_microcourse", side_effect=Exception("db down"))
+    @patch("api.views.build_course_vectorstore", return_value=MagicMock())
+    @patch("api.views.agenerate_microcourse_section")
+    def test_async_add_microcourse_removes_the_index_when_saving_fails(self, mock_generate, mock_build, _mock_create, mock_delete):
+        mock_generate.return_value = self._mock_section_data()
+        payload = {"title": "T", "topic": "Topic", "complexity": "Beginner", "target_audience": "All", "openai_key": "k"}
+
+        response = self.client.post("/api/async/add_microcourse/", data=payload, format="multipart")
+        self.assertEqual(response.status_code, 500)
+        mock_delete.assert_called_once_with(mock_build.call_args[0][0])
+
+    @patch("api.views.agenerate_microcourse_section")
+    def test_async_go_in_depth_creates_next_section(self, mock_generate):
+        mock_generate.return_value = self._mock_section_data()
+        microcourse = Microcourse.objects.create(
+            title="Course",
+            topic="Topic",
+            complexity="Beginner",
+            target_audience="Learners",
+        )
+
+        payload = {"microcourseId": microcourse.id, "previousSection": "Previous", "openai_key": "test-key"}
+        response = self.client.post("/api/async/generate_next_section/", data=payload, format="json")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(microcourse.sections.count(), 1)
+        self.assertTrue(mock_generate.call_args.kwargs["is_next_section"])
+
+    def test_async_views_reject_other_methods(self):
+        response = self.client.get("/api/async/agent_response/")
+        self.assertEqual(response.status_code, 405)
+
+    async def _post_stream(self, path, microcourse):
+        return await self.async_client.post(
+            path,
+            json.dumps({"microcourseId": microcourse.id, "openai_key": "test-key"}),
+            content_type="application/json",
+            HTTP_ACCEPT="text/event-stream",
+        )
+
+    async def _create_course(self):
+        return await Microcourse.objects.acreate(
+            title="Course",
+            topic="Topic",
+            complexity="Beginner",
+            target_audience="Learners",
+        )
+
+    @patch("api.views.load_course_vectorstore", return_value=None)
+    @patch("api.views.iter_microcourse_section_events")
+    async def test_stream_next_section_emits_events_and_persists(self, mock_events, _mock_load):
+        mock_events.return_value = iter([
+            ("retrieval", {"context_length": 0}),
+            ("token", {"text": "{"}),
+            ("section", self._mock_section_data()),
+        ])
+        microcourse = await self._create_course()
+
+        response = await self._post_stream("/api/stream/generate_next_section/", microcourse)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        names = [line[len("event: "):] for line in body.splitlines() if line.startswith("event: ")]
+        self.assertEqual(names, ["ingestion", "retrieval", "token", "done"])
+        section = await microcourse.sections.aget()
+        self.assertIn(f'"section_id": {section.id}', body)
+        self.assertEqual(await section.recall_notes.acount(), 2)
+
+    @patch("api.views.load_course_vectorstore", return_value=None)
+    @patch("api.views.iter_microcourse_section_events")
+    async def test_stream_sends_events_before_generation_finishes(self, mock_events, _mock_load):
+        release = threading.Event()
+
+        def events(*args, **kwargs):
+            yield "retrieval", {"context_length": 0}
+            release.wait(5)
+            yield "section", self._mock_section_data()
+
+        mock_events.side_effect = events
+        microcourse = await self._create_course()
+
+        response = await self._post_stream("/api/stream/generate_next_section/", microcourse)
+        # Iterate the way ASGIHandler does, so a buffered response would time out here.
+        chunks = response.__aiter__()
+        self.assertIn(b"event: ingestion", await asyncio.wait_for(chunks.__anext__(), 2))
+        # The pipeline is still blocked, yet the retrieval event has been sent.
+        self.assertIn(b"event: retrieval", await asyncio.wait_for(chunks.__anext__(), 2))
+        release.set()
+        rest = b"".join([chunk async for chunk in chunks])
+        self.assertIn(b"event: done", rest)
+
+    @patch("api.views.load_course_vectorstore", return_value=None)
+    @patch("api.views.iter_microcourse_section_events")
+    def test_wsgi_stream_sends_events_before_generation_finishes(self, mock_events, _mock_load):
+        release = threading.Event()
+
+        def events(*args, **kwargs):
+            yield "retrieval", {"context_length": 0}
+            release.wait(5)
+            yield "section", self._mock_section_data()
+
+        mock_events.side_effect = events
+        microcourse = Microcourse.objects.create(
+            title="Course", topic="Topic", complexity="Beginner", target_audience="Learners",
+        )
+
+        response = self.client.post(
+            "/api/stream/generate_next_section/",
+            json.dumps({"microcourseId": microcourse.id, "openai_key": "test-key"}),
+            content_type="application/json",
+            HTTP_ACCEPT="text/event-stream",
+        )
+        started = time.monotonic()
+        # Iterate the way a WSGI server does; a buffered response would block until release times out.
+        chunks = iter(response)
+        self.assertIn(b"event: ingestion", next(chunks))
+        self.assertIn(b"event: retrieval", next(chunks))
+        self.assertLess(time.monotonic() - started, 2)
+        release.set()
+        self.assertIn(b"event: done", b"".join(chunks))
+
+    @patch("api.views.delete_course_vectorstore")
+    @patch("api.views.build_course_vectorstore", return_value=None)
+    @patch("api.views.iter_microcourse_section_events")
+    async def test_stream_add_microcourse_reports_errors(self, mock_events, _mock_build, mock_delete):
+        mock_events.side_effect = Exception("boom")
+        payload = {"title": "T", "topic": "Topic", "complexity": "Beginner", "target_audience": "All", "openai_key": "k"}
+
+        response = await self.async_client.post("/api/stream/add_microcourse/", payload)
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertIn("event: error", body)
+        self.assertEqual(await Microcourse.objects.acount(), 0)
+        mock_delete.assert_called_once()
+
+    @patch("api.views.delete_course_vectorstore")
+    @patch("api.views.create_microcourse", side_effect=Exception("db down"))
+    @patch("api.views.build_course_vectorstore", return_value=MagicMock())
+    @patch("api.views.iter_microcourse_section_events", return_value=iter([("section", {})]))
+    def test_stream_add_microcourse_removes_the_index_when_saving_fails(self, _mock_events, mock_build, _mock_create, mock_delete):
+        payload = {"title": "T", "topic": "Topic", "complexity": "Beginner", "target_audience": "All", "openai_key": "k"}
+
+        response = self.client.post("/api/stream/add_microcourse/", data=payload, format="multipart")
+        body = b"".join(response).decode()
+        self.assertIn("Failed to create microcourse.", body)
+        mock_delete.assert_called_once_with(mock_build.call_args[0][0])
+
     @patch("api.views.LLMChain")
     def test_get_agent_response_returns_answer(self, mock_chain_cls):
         mock_chain = mock_chain_cls.return_value
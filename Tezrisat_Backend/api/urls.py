@@ -13,6 +13,14 @@ urlpatterns = [
     path("delete_microcourse/<int:microcourse_id>/", views.delete_microcourse, name="delete_microcourse"),
     re_path(r'^generate_next_section/$', views.go_in_depth, name='go_in_depth'),
     path("agent_response/", views.get_agent_response, name="get_agent_response"),
+    path("stream/add_microcourse/", views.stream_add_microcourse, name="stream_add_microcourse"),
+    path("stream/generate_next_section/", views.stream_next_section, name="stream_next_section"),
+    path("jobs/add_microcourse/", views.enqueue_microcourse, name="enqueue_microcourse"),
+    path("jobs/generate_next_section/", views.enqueue_next_section, name="enqueue_next_section"),
+    path("jobs/<int:job_id>/", views.get_generation_job, name="get_generation_job"),
+    path("async/add_microcourse/", views.add_microcourse_async, name="add_microcourse_async"),
+    path("async/generate_next_section/", views.go_in_depth_async, name="go_in_depth_async"),
+    path("async/agent_response/", views.get_agent_response_async, name="get_agent_response_async"),
 
     path("add_glossary_term/", views.add_glossary_term, name="add_glossary_term"),
     path("delete_glossary_term/<int:term_id>/", views.delete_glossary_term, name="delete_glossary_term"),
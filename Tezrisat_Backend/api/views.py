@@ -1,33 +1,71 @@
+import asyncio
 import json
 import logging
 import os
-from typing import Optional
+from functools import wraps
+from typing import Optional, Tuple
+from uuid import uuid4
+
+from asgiref.sync import sync_to_async
 from django.core.files.storage import FileSystemStorage
+from django.core.handlers.asgi import ASGIRequest
 from django.conf import settings
-from django.http import JsonResponse
+from django.db import transaction
+from django.db.models import Count
+from django.http import HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+from django.utils.http import parse_etags
 
 from rest_framework.decorators import (
     api_view,
     parser_classes,
+    renderer_classes,
 )
+from rest_framework.exceptions import NotFound
 from rest_framework.parsers import MultiPartParser, FormParser
+from rest_framework.renderers import BaseRenderer, JSONRenderer
 from langchain.chains.llm import LLMChain
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 # from serpapi import GoogleSearch
 from langchain_openai import ChatOpenAI
 
 # Local project imports
-from .generate_microcourse import generate_microcourse_section
+from .chat_context import get_chat_context
+from .course_retrieval import retrieve_course_context
+from .documents import (
+    SECTION_DETAIL_FIELDS,
+    add_related_row,
+    course_etag,
+    get_course_document,
+    project_document,
+    remove_related_row,
+)
+from .generate_microcourse import (
+    LLM_MODEL,
+    build_course_vectorstore,
+    delete_course_vectorstore,
+    generate_microcourse_section,
+    iter_microcourse_section_events,
+    load_course_vectorstore,
+    with_db_connections,
+)
+from .generate_microcourse_async import agenerate_microcourse_section
+from .jobs import enqueue_job
+from .llm_clients import get_chat_client
 from .models import (
+    GenerationJob,
     Microcourse,
     MicrocourseSection,
     GlossaryTerm,
     QuizQuestion,
     RecallNote,
 )
+from .services import create_microcourse, create_section, get_course_summary
+from .pagination import MicrocourseCursorPagination
 from .serializers import (
+    GenerationJobSerializer,
     MicrocourseSerializer,
     MicrocourseSectionSerializer,
+    MicrocourseSummarySerializer,
 )
 
 logger = logging.getLogger(__name__)
@@ -48,6 +86,82 @@ def _get_env_or_request_key(request, env_key: str, header_name: str, data_key: s
     return env_value or _get_request_key(request, header_name, data_key)
 
 
+def _save_uploaded_pdfs(pdf_files) -> list:
+    """Store uploaded PDFs under MEDIA_ROOT/pdfs and return their filenames."""
+    saved_pdf_filenames = []
+    if pdf_files:
+        fs = FileSystemStorage(location=os.path.join(settings.MEDIA_ROOT, "pdfs"))
+        for pdf in pdf_files:
+            try:
+                filename = fs.save(pdf.name, pdf)
+                saved_pdf_filenames.append(filename)  # Just store filename, not full path
+                logger.info("PDF file saved successfully: %s", filename)
+            except Exception as e:
+                logger.error("Error saving PDF file: %s", e)
+    else:
+        logger.info("No PDF file provided")
+    return saved_pdf_filenames
+
+
+# The only course text in the prompt is the rolling summary (at most COURSE_SUMMARY_MAX_TOKENS)
+# and the retrieved passages (at most CHAT_CONTEXT_TOKEN_BUDGET), all of them cited in "sources".
+CHAT_PROMPT_TEMPLATE = ChatPromptTemplate.from_messages([
+    (
+        "system",
+        (
+            "You are an expert instructor in {topic} aimed at {target_audience}. "
+            "The microcourse covers the following sections:\n{summary}\n"
+            "Passages from the course relevant to the question, each labelled with its section:\n{course_context}\n"
+            "Use this information to answer any questions as clearly and helpfully as possible, "
+            "and name the sections your answer draws on."
+        ),
+    ),
+    MessagesPlaceholder(variable_name="messages"),
+])
+
+
+CHAT_TEMPERATURE = 0.7
+
+
+def _chat_chain(openai_key: str, loop=None) -> LLMChain:
+    """Return the shared chat chain for this key; like its client, it holds no per-request state."""
+    llm = get_chat_client(
+        ("chat", openai_key, CHAT_TEMPERATURE),
+        lambda: ChatOpenAI(temperature=CHAT_TEMPERATURE, openai_api_key=openai_key),
+        loop=loop,
+    )
+    return get_chat_client(
+        ("chat-chain", openai_key, CHAT_TEMPERATURE),
+        lambda: LLMChain(llm=llm, prompt=CHAT_PROMPT_TEMPLATE),
+        loop=loop,
+    )
+
+
+def _build_chat_inputs(context: dict, question: str) -> Tuple[dict, list]:
+    """Assemble the prompt variables for a chat question and the course sections they cite.
+
+    Retrieval runs against the cached passage index only (no vector store or
+    database access), so a chat turn costs the context cache lookup plus the
+    LLM call.
+    """
+    retrieved = retrieve_course_context(
+        context["index"],
+        question,
+        settings.CHAT_RETRIEVAL_K,
+        settings.CHAT_CONTEXT_TOKEN_BUDGET,
+        LLM_MODEL,
+    )
+    inputs = {
+        "messages": [{"role": "user", "content": question}],
+        "title": context["title"],
+        "topic": context["topic"],
+        "target_audience": context["target_audience"],
+        "summary": context["summary"],
+        "course_context": retrieved.text,
+    }
+    return inputs, retrieved.sources
+
+
 @api_view(["GET"])
 def get_keys_status(request):
     def is_set(value: Optional[str]) -> bool:
@@ -68,54 +182,84 @@ def get_keys_status(request):
 @api_view(['GET'])
 def get_microcourses(request):
     """
-    Retrieve all microcourses.
+    Retrieve a page of microcourses, newest first, in their summary representation.
+    Follow "next" (or pass ?cursor=) for further pages; ?page_size= sets the page size.
     """
-    logger.info("Retrieving all microcourses")
+    logger.info("Retrieving microcourses")
     try:
-        microcourses = Microcourse.objects.all()
-        serializer = MicrocourseSerializer(microcourses, many=True)
+        microcourses = Microcourse.objects.only(
+            "id", "title", "topic", "complexity", "created_at", "updated_at",
+        ).annotate(section_count=Count("sections"))
+        paginator = MicrocourseCursorPagination()
+        page = paginator.paginate_queryset(microcourses, request)
+        serializer = MicrocourseSummarySerializer(page, many=True)
         logger.info("Successfully retrieved microcourses")
-        return JsonResponse(serializer.data, safe=False)
+        return JsonResponse({
+            "next": paginator.get_next_link(),
+            "previous": paginator.get_previous_link(),
+            "results": serializer.data,
+        })
+    except NotFound:
+        return JsonResponse({"error": "Invalid cursor"}, status=404)
     except Exception as e:
         logger.error("Error retrieving microcourses: %s", e)
         return JsonResponse({"error": "Failed to retrieve microcourses"}, status=500)
 
 
+# Browsers may keep the payload but must revalidate it, which sends If-None-Match on every refetch.
+COURSE_DETAIL_CACHE_CONTROL = "private, no-cache"
+
+
+def _etag_matches(etag: str, if_none_match: str) -> bool:
+    """If-None-Match uses weak comparison, so W/"x" (added by some proxies) matches "x"."""
+    for candidate in parse_etags(if_none_match):
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
 @api_view(['GET'])
 def get_microcourse(request, pk):
     """
     Retrieve detailed information for a specific microcourse.
+    Served from the course's stored document (see documents.py) in one query.
+    Pass ?fields=id,section_title,... to return only those section fields,
+    e.g. to skip large blobs such as content and code_examples.
+    Responses carry a strong ETag; a matching If-None-Match gets 304 after
+    looking up only the course version.
     """
+    requested = request.GET.get("fields")
+    if requested:
+        fields = [field.strip() for field in requested.split(",") if field.strip()]
+        unknown = sorted(set(fields) - set(SECTION_DETAIL_FIELDS))
+        if unknown:
+            return JsonResponse(
+                {"error": f"Unknown section fields: {', '.join(unknown)}", "allowed": list(SECTION_DETAIL_FIELDS)},
+                status=400,
+            )
+    else:
+        fields = list(SECTION_DETAIL_FIELDS)
+
     try:
-        microcourse = Microcourse.objects.get(id=pk)
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match:
+            version = Microcourse.objects.filter(id=pk).values_list("version", flat=True).first()
+            if version is None:
+                raise Microcourse.DoesNotExist
+            etag = course_etag(pk, version, fields)
+            if _etag_matches(etag, if_none_match):
+                response = HttpResponseNotModified()
+                response["ETag"] = etag
+                response["Cache-Control"] = COURSE_DETAIL_CACHE_CONTROL
+                return response
+
+        microcourse = Microcourse.objects.defer("summary").get(id=pk)
         logger.info("Microcourse retrieved successfully")
-        sections_data = []
-        for section in microcourse.sections.all().order_by("id"):
-            glossary_terms = list(section.glossary_terms.all().values("id", "term", "definition"))
-            quiz_questions = list(section.quiz_questions.all().values("id", "question", "options", "correct_answer"))
-            recall_notes = list(section.recall_notes.all().values("id", "content", "timestamp"))
-            sections_data.append({
-                "id": section.id,
-                "section_title": section.section_title,
-                "content": section.content,
-                "glossary_terms": glossary_terms,
-                "quiz_questions": quiz_questions,
-                "recall_notes": recall_notes,
-                "code_examples": section.code_examples,
-                "math_expressions": section.math_expressions,
-            })
-
-        data = {
-            "id": microcourse.id,
-            "title": microcourse.title,
-            "topic": microcourse.topic,
-            "complexity": microcourse.complexity,
-            "target_audience": microcourse.target_audience,
-            "url": microcourse.url,
-            "pdf": microcourse.pdf.url if microcourse.pdf else None,
-            "sections": sections_data,
-        }
-        return JsonResponse(data, safe=False)
+        data = project_document(get_course_document(microcourse), fields)
+        response = JsonResponse(data, safe=False)
+        response["ETag"] = course_etag(microcourse.id, microcourse.version, fields)
+        response["Cache-Control"] = COURSE_DETAIL_CACHE_CONTROL
+        return response
     except Microcourse.DoesNotExist:
         return JsonResponse({"error": "Microcourse not found"}, status=404)
     except Exception as e:
@@ -160,6 +304,7 @@ def go_in_depth(request):
     )
 
     try:
+        vectorstore = load_course_vectorstore(microcourse.vector_index, openai_key)
         microcourse_section_data = generate_microcourse_section(
             topic,
             is_next_section=True,
@@ -167,41 +312,15 @@ def go_in_depth(request):
             openai_api_key=openai_key,
             serpapi_api_key=serpapi_key or "",
             wolfram_alpha_appid=wolfram_key or "",
+            vectorstore=vectorstore,
+            course_summary=get_course_summary(microcourse),
         )
     except Exception as e:
         logger.error("Error generating microcourse section: %s", e)
         return JsonResponse({"error": "Failed to generate microcourse section."}, status=500)
 
     try:
-        new_section = MicrocourseSection.objects.create(
-            microcourse=microcourse,
-            section_title=microcourse_section_data.get("section_title"),
-            content=microcourse_section_data.get("content"),
-            code_examples=microcourse_section_data.get("code_examples"),
-            math_expressions=microcourse_section_data.get("math_expressions"),
-        )
-        # Process vocabulary/glossary.
-        glossary_json = microcourse_section_data.get("vocabulary")
-        if glossary_json:
-            glossary = json.loads(glossary_json)
-            for term, definition in glossary.items():
-                GlossaryTerm.objects.create(section=new_section, term=term, definition=definition)
-        # Process quiz.
-        quiz_json = microcourse_section_data.get("quiz")
-        if quiz_json:
-            quiz = json.loads(quiz_json)
-            QuizQuestion.objects.create(
-                section=new_section,
-                question=quiz.get("question"),
-                options=quiz.get("options"),
-                correct_answer=quiz.get("correct_answer"),
-            )
-        # Process recall notes.
-        recall_json = microcourse_section_data.get("recall_notes")
-        if recall_json:
-            recall_notes = json.loads(recall_json)
-            for note_content in recall_notes:
-                RecallNote.objects.create(section=new_section, content=note_content)
+        new_section = create_section(microcourse, microcourse_section_data)
     except Exception as e:
         logger.error("Error creating new MicrocourseSection and related items: %s", e)
         return JsonResponse({"error": "Failed to create new microcourse section."}, status=500)
@@ -248,21 +367,12 @@ def add_microcourse(request):
     target_audience = request.data.get("target_audience")
     urls = request.data.getlist("url")
     urls_json = json.dumps(urls) if urls else None
-    pdf_files = request.FILES.getlist("pdf")
-    saved_pdf_filenames = []
-    if pdf_files:
-        fs = FileSystemStorage(location=os.path.join(settings.MEDIA_ROOT, "pdfs"))
-        for pdf in pdf_files:
-            try:
-                filename = fs.save(pdf.name, pdf)
-                saved_pdf_filenames.append(filename)  # Just store filename, not full path
-                logger.info("PDF file saved successfully: %s", filename)
-            except Exception as e:
-                logger.error("Error saving PDF file: %s", e)
-    else:
-        logger.info("No PDF file provided")
+    saved_pdf_filenames = _save_uploaded_pdfs(request.FILES.getlist("pdf"))
 
+    # Sources are ingested and embedded once here; later sections and chat reuse the index.
+    vector_index = uuid4().hex
     try:
+        vectorstore = build_course_vectorstore(vector_index, saved_pdf_filenames, urls_json, openai_api_key)
         microcourse_section_data = generate_microcourse_section(
             topic,
             pdf_path=saved_pdf_filenames,
@@ -271,15 +381,18 @@ def add_microcourse(request):
             openai_api_key=openai_api_key,
             serpapi_api_key=serpapi_key or "",
             wolfram_alpha_appid=wolfram_key or "",
+            vectorstore=vectorstore,
         )
         logger.info("Generated section: %s", json.dumps(microcourse_section_data, indent=2))
     except Exception as e:
         logger.error("Error generating microcourse section: %s", e)
+        delete_course_vectorstore(vector_index)
         return JsonResponse({"error": "Failed to generate microcourse section."}, status=500)
 
     try:
         pdf_field = saved_pdf_filenames[0] if saved_pdf_filenames else None
-        microcourse = Microcourse.objects.create(
+        microcourse, _ = create_microcourse(
+            microcourse_section_data,
             title=title,
             topic=topic,
             complexity=complexity,
@@ -287,43 +400,13 @@ def add_microcourse(request):
             url=urls_json,
             pdf=pdf_field,
             user=user,
+            vector_index=vector_index if vectorstore is not None else "",
         )
     except Exception as e:
-        logger.error("Error creating Microcourse: %s", e)
+        logger.error("Error creating Microcourse and its first section: %s", e)
+        delete_course_vectorstore(vector_index)
         return JsonResponse({"error": "Failed to create microcourse."}, status=500)
 
-    try:
-        section = MicrocourseSection.objects.create(
-            microcourse=microcourse,
-            section_title=microcourse_section_data.get("section_title"),
-            content=microcourse_section_data.get("content"),
-            code_examples=microcourse_section_data.get("code_examples"),
-            math_expressions=microcourse_section_data.get("math_expressions"),
-        )
-        glossary_json = microcourse_section_data.get("vocabulary")
-        if glossary_json:
-            glossary = json.loads(glossary_json)
-            for term, definition in glossary.items():
-                GlossaryTerm.objects.create(section=section, term=term, definition=definition)
-        quiz_json = microcourse_section_data.get("quiz")
-        if quiz_json:
-            quiz = json.loads(quiz_json)
-            QuizQuestion.objects.create(
-                section=section,
-                question=quiz.get("question"),
-                options=quiz.get("options"),
-                correct_answer=quiz.get("correct_answer"),
-            )
-        recall_json = microcourse_section_data.get("recall_notes")
-        if recall_json:
-            recall_notes = json.loads(recall_json)
-            for note_content in recall_notes:
-                RecallNote.objects.create(section=section, content=note_content)
-    except Exception as e:
-        logger.error("Error creating MicrocourseSection and related items: %s", e)
-        return JsonResponse({"error": "Failed to create microcourse section and related items."}, status=500)
-
-
     serializer = MicrocourseSerializer(microcourse)
     if serializer.is_valid:
         logger.info("Microcourse added successfully")
@@ -336,20 +419,9 @@ def add_microcourse(request):
 @api_view(['POST'])
 def get_agent_response(request):
     """
-    Process a question using the AI agent and return its answer.
+    Process a question using the AI agent and return its answer, with the
+    course sections it was grounded in as "sources".
     """
-    prompt_template = ChatPromptTemplate.from_messages([
-        (
-            "system",
-            (
-                "You are an expert instructor in {topic} aimed at {target_audience}. "
-                "The microcourse covers the following topics: {contents}. "
-                "Use this information to answer any questions as clearly and helpfully as possible."
-            ),
-        ),
-        MessagesPlaceholder(variable_name="messages"),
-    ])
-
     try:
         payload = json.loads(request.body.decode("utf-8"))
     except json.JSONDecodeError:
@@ -366,52 +438,14 @@ def get_agent_response(request):
     if not openai_key:
         return JsonResponse({"error": "OpenAI API key is required."}, status=400)
 
-    llm = ChatOpenAI(temperature=0.7, openai_api_key=openai_key)
-    chain = LLMChain(llm=llm, prompt=prompt_template)
-
     question = payload.get("question")
-    data_id = payload.get("id")
-    try:
-        microcourse = Microcourse.objects.get(id=data_id)
-    except Microcourse.DoesNotExist:
+    context = get_chat_context(payload.get("id"))
+    if context is None:
         return JsonResponse({"error": "Microcourse not found"}, status=404)
 
-    contents = "\n\n".join(microcourse.sections.all().values_list("content", flat=True))
-    recall_notes = []
-    glossary = []
-    quiz = []
-    code_examples = []
-    math_expressions = []
-
-    for section in microcourse.sections.all():
-        recall_notes.extend(list(section.recall_notes.all().values_list("content", flat=True)))
-        glossary.extend([f"{gt.term}: {gt.definition}" for gt in section.glossary_terms.all()])
-        quiz.extend(list(section.quiz_questions.all().values_list("question", flat=True)))
-        code_examples.append(section.code_examples)
-        math_expressions.append(section.math_expressions)
-
-    def answer_question(question, conversation_history=None):
-        if conversation_history is None:
-            conversation_history = []
-        conversation_history.append({"role": "user", "content": question})
-        inputs = {
-            "messages": conversation_history,
-            "title": microcourse.title,
-            "topic": microcourse.topic,
-            "target_audience": microcourse.target_audience,
-            "contents": contents,
-            "recall_notes": "\n".join(recall_notes),
-            "vocabulary": "\n".join(glossary),
-            "quiz": "\n".join(quiz),
-            "code_examples": "\n".join(code_examples),
-            "math_expressions": "\n".join(math_expressions),
-        }
-        answer = chain.run(**inputs)
-        conversation_history.append({"role": "assistant", "content": answer})
-        return answer, conversation_history
-
-    answer, _ = answer_question(question)
-    return JsonResponse({"answer": answer})
+    inputs, sources = _build_chat_inputs(context, question)
+    answer = _chat_chain(openai_key).run(**inputs)
+    return JsonResponse({"answer": answer, "sources": sources})
 
 
 @api_view(['POST'])
@@ -438,11 +472,13 @@ def add_glossary_term(request):
         return JsonResponse({"detail": "No section found for the current microcourse."}, status=404)
 
     section = sections.latest("id")
-    glossary_term = GlossaryTerm.objects.create(
-        section=section,
-        term=new_term,
-        definition=new_definition,
-    )
+    with transaction.atomic():
+        glossary_term = GlossaryTerm.objects.create(
+            section=section,
+            term=new_term,
+            definition=new_definition,
+        )
+        add_related_row(section, "glossary_terms", glossary_term)
     return JsonResponse({
         "detail": "Glossary term added successfully.",
         "glossary_term": {
@@ -459,10 +495,12 @@ def delete_glossary_term(request, term_id):
     Delete a glossary term by its ID.
     """
     try:
-        glossary_term = GlossaryTerm.objects.get(pk=term_id)
+        glossary_term = GlossaryTerm.objects.select_related("section").get(pk=term_id)
     except GlossaryTerm.DoesNotExist:
         return JsonResponse({"detail": "Glossary term not found."}, status=404)
-    glossary_term.delete()
+    with transaction.atomic():
+        glossary_term.delete()
+        remove_related_row(glossary_term.section.microcourse_id, "glossary_terms", term_id)
     return JsonResponse({"detail": "Glossary term deleted successfully."}, status=200)
 
 
@@ -484,7 +522,9 @@ def add_note(request):
         section = MicrocourseSection.objects.get(pk=section_id)
     except MicrocourseSection.DoesNotExist:
         return JsonResponse({"detail": "Section not found."}, status=404)
-    new_note = RecallNote.objects.create(section=section, content=content)
+    with transaction.atomic():
+        new_note = RecallNote.objects.create(section=section, content=content)
+        add_related_row(section, "recall_notes", new_note)
     return JsonResponse({
         "id": new_note.id,
         "content": new_note.content,
@@ -498,10 +538,12 @@ def delete_note(request, note_id):
     Delete a recall note identified by its ID.
     """
     try:
-        note = RecallNote.objects.get(pk=note_id)
+        note = RecallNote.objects.select_related("section").get(pk=note_id)
     except RecallNote.DoesNotExist:
         return JsonResponse({"detail": "Recall note not found."}, status=404)
-    note.delete()
+    with transaction.atomic():
+        note.delete()
+        remove_related_row(note.section.microcourse_id, "recall_notes", note_id)
     return JsonResponse({"detail": "Recall note deleted successfully."}, status=200)
 
 
@@ -514,5 +556,426 @@ def delete_microcourse(request, microcourse_id):
         microcourse = Microcourse.objects.get(pk=microcourse_id)
     except Microcourse.DoesNotExist:
         return JsonResponse({"detail": "Microcourse not found."}, status=404)
+    delete_course_vectorstore(microcourse.vector_index)
     microcourse.delete()
     return JsonResponse({"detail": "Microcourse deleted successfully."}, status=200)
+
+
+class EventStreamRenderer(BaseRenderer):
+    """Lets streaming views pass DRF content negotiation for Accept: text/event-stream."""
+    media_type = "text/event-stream"
+    format = "sse"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+
+def _sse_event(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+_END_OF_EVENTS = object()
+
+
+def _iter_events(events):
+    for event, data in events:
+        yield _sse_event(event, data)
+
+
+async def _aiter_events(events):
+    """Drive a blocking event generator one event per sync_to_async hop.
+
+    Under ASGI, StreamingHttpResponse reads a synchronous iterator to the end
+    before sending anything; handing it an async iterator lets each event be
+    flushed as soon as the pipeline produces it. Calls stay thread-sensitive
+    because the generators write to the database.
+    """
+    iterator = iter(events)
+    step = sync_to_async(lambda: next(iterator, _END_OF_EVENTS))
+    try:
+        while True:
+            item = await step()
+            if item is _END_OF_EVENTS:
+                return
+            event, data = item
+            yield _sse_event(event, data)
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await sync_to_async(close)()
+
+
+def _sse_response(request, events) -> StreamingHttpResponse:
+    """Wrap an iterator of (event, data) pairs in a text/event-stream response.
+
+    Each server flushes events as they come only from the iterator type it
+    consumes natively: WSGI collects an async iterator into a list, and ASGI
+    does the same with a sync one.
+    """
+    if isinstance(getattr(request, "_request", request), ASGIRequest):
+        content = _aiter_events(events)
+    else:
+        content = _iter_events(events)
+    response = StreamingHttpResponse(content, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx and similar proxies from buffering the stream.
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+@api_view(['POST'])
+@parser_classes([MultiPartParser, FormParser])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def stream_add_microcourse(request):
+    """
+    Create a new microcourse, streaming generation progress as server-sent events.
+    The final "done" event carries the ids of the persisted microcourse and section.
+    """
+    openai_api_key = _get_env_or_request_key(request, "OPENAI_API_KEY", "X-OpenAI-Key", "openai_key")
+    if not openai_api_key:
+        return JsonResponse({"error": "OpenAI API key is required."}, status=400)
+    serpapi_key = _get_env_or_request_key(request, "SERPAPI_API_KEY", "X-SerpAPI-Key", "serpapi_key")
+    wolfram_key = _get_env_or_request_key(request, "WOLFRAM_ALPHA_APPID", "X-Wolfram-Key", "wolfram_key")
+
+    title = request.data.get("title")
+    topic = request.data.get("topic")
+    complexity = request.data.get("complexity")
+    target_audience = request.data.get("target_audience")
+    urls = request.data.getlist("url")
+    urls_json = json.dumps(urls) if urls else None
+    saved_pdf_filenames = _save_uploaded_pdfs(request.FILES.getlist("pdf"))
+
+    def events():
+        vector_index = uuid4().hex
+        try:
+            vectorstore = build_course_vectorstore(vector_index, saved_pdf_filenames, urls_json, openai_api_key)
+            yield "ingestion", {"indexed": vectorstore is not None}
+            section_data = None
+            for event, data in iter_microcourse_section_events(
+                topic,
+                pdf_path=saved_pdf_filenames,
+                website_url=urls_json,
+                is_next_section=False,
+                openai_api_key=openai_api_key,
+                serpapi_api_key=serpapi_key or "",
+                wolfram_alpha_appid=wolfram_key or "",
+                vectorstore=vectorstore,
+            ):
+                if event == "section":
+                    section_data = data
+                else:
+                    yield event, data
+        except Exception as e:
+            logger.error("Error generating microcourse section: %s", e)
+            delete_course_vectorstore(vector_index)
+            yield "error", {"error": "Failed to generate microcourse section."}
+            return
+
+        try:
+            microcourse, section = create_microcourse(
+                section_data,
+                title=title,
+                topic=topic,
+                complexity=complexity,
+                target_audience=target_audience,
+                url=urls_json,
+                pdf=saved_pdf_filenames[0] if saved_pdf_filenames else None,
+                user=None,
+                vector_index=vector_index if vectorstore is not None else "",
+            )
+        except Exception as e:
+            logger.error("Error creating Microcourse: %s", e)
+            delete_course_vectorstore(vector_index)
+            yield "error", {"error": "Failed to create microcourse."}
+            return
+        yield "done", {"microcourse_id": microcourse.id, "section_id": section.id}
+
+    return _sse_response(request, events())
+
+
+@api_view(['POST'])
+@renderer_classes([JSONRenderer, EventStreamRenderer])
+def stream_next_section(request):
+    """
+    Generate the next section of a microcourse, streaming progress as server-sent events.
+    The final "done" event carries the id of the persisted section.
+    """
+    try:
+        microcourse = Microcourse.objects.get(id=request.data.get("microcourseId"))
+    except Microcourse.DoesNotExist:
+        return JsonResponse({"error": "Microcourse not found"}, status=404)
+
+    openai_key = _get_env_or_request_key(request, "OPENAI_API_KEY", "X-OpenAI-Key", "openai_key")
+    if not openai_key:
+        return JsonResponse({"error": "OpenAI API key is required."}, status=400)
+    serpapi_key = _get_env_or_request_key(request, "SERPAPI_API_KEY", "X-SerpAPI-Key", "serpapi_key")
+    wolfram_key = _get_env_or_request_key(request, "WOLFRAM_ALPHA_APPID", "X-Wolfram-Key", "wolfram_key")
+    previous_section = request.data.get("previousSection")
+
+    def events():
+        try:
+            vectorstore = load_course_vectorstore(microcourse.vector_index, openai_key)
+            yield "ingestion", {"indexed": vectorstore is not None}
+            section_data = None
+            for event, data in iter_microcourse_section_events(
+                microcourse.topic,
+                is_next_section=True,
+                previous_section=previous_section,
+                openai_api_key=openai_key,
+                serpapi_api_key=serpapi_key or "",
+                wolfram_alpha_appid=wolfram_key or "",
+                vectorstore=vectorstore,
+                course_summary=get_course_summary(microcourse),
+            ):
+                if event == "section":
+                    section_data = data
+                else:
+                    yield event, data
+        except Exception as e:
+            logger.error("Error generating microcourse section: %s", e)
+            yield "error", {"error": "Failed to generate microcourse section."}
+            return
+
+        try:
+            section = create_section(microcourse, section_data)
+        except Exception as e:
+            logger.error("Error creating new MicrocourseSection and related items: %s", e)
+            yield "error", {"error": "Failed to create new microcourse section."}
+            return
+        yield "done", {"microcourse_id": microcourse.id, "section_id": section.id}
+
+    return _sse_response(request, events())
+
+
+@api_view(['POST'])
+@parser_classes([MultiPartParser, FormParser])
+def enqueue_microcourse(request):
+    """
+    Queue generation of a new microcourse and return the job for status polling.
+    """
+    openai_api_key = _get_env_or_request_key(request, "OPENAI_API_KEY", "X-OpenAI-Key", "openai_key")
+    if not openai_api_key:
+        return JsonResponse({"error": "OpenAI API key is required."}, status=400)
+    keys = {
+        "openai": openai_api_key,
+        "serpapi": _get_env_or_request_key(request, "SERPAPI_API_KEY", "X-SerpAPI-Key", "serpapi_key"),
+        "wolfram": _get_env_or_request_key(request, "WOLFRAM_ALPHA_APPID", "X-Wolfram-Key", "wolfram_key"),
+    }
+    urls = request.data.getlist("url")
+    payload = {
+        "title": request.data.get("title"),
+        "topic": request.data.get("topic"),
+        "complexity": request.data.get("complexity"),
+        "target_audience": request.data.get("target_audience"),
+        "urls": json.dumps(urls) if urls else None,
+        "pdf_paths": _save_uploaded_pdfs(request.FILES.getlist("pdf")),
+    }
+    job = enqueue_job(GenerationJob.KIND_COURSE, payload, keys)
+    logger.info("Queued course generation job %s", job.id)
+    return JsonResponse(GenerationJobSerializer(job).data, status=202)
+
+
+@api_view(['POST'])
+def enqueue_next_section(request):
+    """
+    Queue generation of the next section of an existing microcourse.
+    """
+    try:
+        microcourse = Microcourse.objects.get(id=request.data.get("microcourseId"))
+    except Microcourse.DoesNotExist:
+        return JsonResponse({"error": "Microcourse not found"}, status=404)
+
+    openai_key = _get_env_or_request_key(request, "OPENAI_API_KEY", "X-OpenAI-Key", "openai_key")
+    if not openai_key:
+        return JsonResponse({"error": "OpenAI API key is required."}, status=400)
+    keys = {
+        "openai": openai_key,
+        "serpapi": _get_env_or_request_key(request, "SERPAPI_API_KEY", "X-SerpAPI-Key", "serpapi_key"),
+        "wolfram": _get_env_or_request_key(request, "WOLFRAM_ALPHA_APPID", "X-Wolfram-Key", "wolfram_key"),
+    }
+    payload = {"previous_section": request.data.get("previousSection")}
+    job = enqueue_job(GenerationJob.KIND_SECTION, payload, keys, microcourse=microcourse)
+    logger.info("Queued section generation job %s for microcourse %s", job.id, microcourse.id)
+    return JsonResponse(GenerationJobSerializer(job).data, status=202)
+
+
+@api_view(['GET'])
+def get_generation_job(request, job_id):
+    """
+    Report a generation job's status and stage, with the generated result once it has succeeded.
+    """
+    try:
+        job = GenerationJob.objects.select_related("microcourse", "section").get(pk=job_id)
+    except GenerationJob.DoesNotExist:
+        return JsonResponse({"error": "Job not found"}, status=404)
+
+    data = GenerationJobSerializer(job).data
+    if job.status == GenerationJob.STATUS_SUCCEEDED:
+        if job.kind == GenerationJob.KIND_COURSE and job.microcourse is not None:
+            data["result"] = MicrocourseSerializer(job.microcourse).data
+        elif job.section is not None:
+            data["result"] = MicrocourseSectionSerializer(job.section).data
+    return JsonResponse(data)
+
+
+# ------------------------------
+# Async variants
+# ------------------------------
+# DRF's @api_view only dispatches synchronous handlers, so the asyncio-native
+# endpoints below are plain Django async views. They take the same inputs and
+# return the same payloads as their synchronous counterparts.
+def async_api_view(http_method_names):
+    """Restrict an async view to the given methods and exempt it from CSRF like @api_view does."""
+    def decorator(view_func):
+        @wraps(view_func)
+        async def wrapper(request, *args, **kwargs):
+            if request.method not in http_method_names:
+                return JsonResponse({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+            return await view_func(request, *args, **kwargs)
+        wrapper.csrf_exempt = True
+        return wrapper
+    return decorator
+
+
+def _get_env_or_payload_key(request, payload, env_key: str, header_name: str, data_key: str) -> Optional[str]:
+    return os.getenv(env_key) or request.headers.get(header_name) or payload.get(data_key)
+
+
+def _json_payload(request) -> dict:
+    try:
+        payload = json.loads(request.body.decode("utf-8") or "{}")
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+
+@async_api_view(["POST"])
+async def add_microcourse_async(request):
+    """
+    Async counterpart of add_microcourse, backed by the asyncio generation pipeline.
+    """
+    payload = request.POST
+    openai_api_key = _get_env_or_payload_key(request, payload, "OPENAI_API_KEY", "X-OpenAI-Key", "openai_key")
+    if not openai_api_key:
+        return JsonResponse({"error": "OpenAI API key is required."}, status=400)
+    serpapi_key = _get_env_or_payload_key(request, payload, "SERPAPI_API_KEY", "X-SerpAPI-Key", "serpapi_key")
+    wolfram_key = _get_env_or_payload_key(request, payload, "WOLFRAM_ALPHA_APPID", "X-Wolfram-Key", "wolfram_key")
+
+    topic = payload.get("topic")
+    urls = payload.getlist("url")
+    urls_json = json.dumps(urls) if urls else None
+    saved_pdf_filenames = await sync_to_async(_save_uploaded_pdfs)(request.FILES.getlist("pdf"))
+
+    vector_index = uuid4().hex
+    try:
+        vectorstore = await sync_to_async(with_db_connections(build_course_vectorstore), thread_sensitive=False)(
+            vector_index, saved_pdf_filenames, urls_json, openai_api_key
+        )
+        microcourse_section_data = await agenerate_microcourse_section(
+            topic,
+            pdf_path=saved_pdf_filenames,
+            website_url=urls_json,
+            is_next_section=False,
+            openai_api_key=openai_api_key,
+            serpapi_api_key=serpapi_key or "",
+            wolfram_alpha_appid=wolfram_key or "",
+            vectorstore=vectorstore,
+        )
+    except Exception as e:
+        logger.error("Error generating microcourse section: %s", e)
+        await sync_to_async(delete_course_vectorstore, thread_sensitive=False)(vector_index)
+        return JsonResponse({"error": "Failed to generate microcourse section."}, status=500)
+
+    def persist():
+        microcourse, _ = create_microcourse(
+            microcourse_section_data,
+            title=payload.get("title"),
+            topic=topic,
+            complexity=payload.get("complexity"),
+            target_audience=payload.get("target_audience"),
+            url=urls_json,
+            pdf=saved_pdf_filenames[0] if saved_pdf_filenames else None,
+            user=None,
+            vector_index=vector_index if vectorstore is not None else "",
+        )
+        return MicrocourseSerializer(microcourse).data
+
+    try:
+        data = await sync_to_async(persist)()
+    except Exception as e:
+        logger.error("Error creating Microcourse: %s", e)
+        await sync_to_async(delete_course_vectorstore, thread_sensitive=False)(vector_index)
+        return JsonResponse({"error": "Failed to create microcourse."}, status=500)
+    logger.info("Microcourse added successfully")
+    return JsonResponse(data)
+
+
+@async_api_view(["POST"])
+async def go_in_depth_async(request):
+    """
+    Async counterpart of go_in_depth.
+    """
+    payload = _json_payload(request)
+    try:
+        microcourse = await Microcourse.objects.aget(id=payload.get("microcourseId"))
+    except (Microcourse.DoesNotExist, ValueError, TypeError):
+        return JsonResponse({"error": "Microcourse not found"}, status=404)
+
+    openai_key = _get_env_or_payload_key(request, payload, "OPENAI_API_KEY", "X-OpenAI-Key", "openai_key")
+    if not openai_key:
+        return JsonResponse({"error": "OpenAI API key is required."}, status=400)
+    serpapi_key = _get_env_or_payload_key(request, payload, "SERPAPI_API_KEY", "X-SerpAPI-Key", "serpapi_key")
+    wolfram_key = _get_env_or_payload_key(request, payload, "WOLFRAM_ALPHA_APPID", "X-Wolfram-Key", "wolfram_key")
+
+    try:
+        vectorstore = await sync_to_async(load_course_vectorstore, thread_sensitive=False)(
+            microcourse.vector_index, openai_key
+        )
+        microcourse_section_data = await agenerate_microcourse_section(
+            microcourse.topic,
+            is_next_section=True,
+            previous_section=payload.get("previousSection"),
+            openai_api_key=openai_key,
+            serpapi_api_key=serpapi_key or "",
+            wolfram_alpha_appid=wolfram_key or "",
+            vectorstore=vectorstore,
+            course_summary=await sync_to_async(get_course_summary)(microcourse),
+        )
+    except Exception as e:
+        logger.error("Error generating microcourse section: %s", e)
+        return JsonResponse({"error": "Failed to generate microcourse section."}, status=500)
+
+    def persist():
+        return MicrocourseSectionSerializer(create_section(microcourse, microcourse_section_data)).data
+
+    try:
+        data = await sync_to_async(persist)()
+    except Exception as e:
+        logger.error("Error creating new MicrocourseSection and related items: %s", e)
+        return JsonResponse({"error": "Failed to create new microcourse section."}, status=500)
+    return JsonResponse(data)
+
+
+@async_api_view(["POST"])
+async def get_agent_response_async(request):
+    """
+    Async counterpart of get_agent_response.
+    """
+    try:
+        payload = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        return JsonResponse({"error": "Invalid JSON payload."}, status=400)
+
+    openai_key = payload.get("openai_key") or _get_env_or_payload_key(
+        request, payload, "OPENAI_API_KEY", "X-OpenAI-Key", "openai_key"
+    )
+    if not openai_key:
+        return JsonResponse({"error": "OpenAI API key is required."}, status=400)
+
+    context = await sync_to_async(get_chat_context)(payload.get("id"))
+    if context is None:
+        return JsonResponse({"error": "Microcourse not found"}, status=404)
+
+    inputs, sources = _build_chat_inputs(context, payload.get("question"))
+    answer = await _chat_chain(openai_key, loop=asyncio.get_running_loop()).arun(**inputs)
+    return JsonResponse({"answer": answer, "sources": sources})
@@ -16,7 +16,18 @@ import Background from '../components/Background';
 interface Course {
   id: number;
   title: string;
-  content: string;
+  topic: string;
+  complexity: string;
+  section_count: number;
+  created_at: string;
+  updated_at: string;
+}
+
+/** One page of the cursor-paginated course list */
+interface CoursePage {
+  next: string | null;
+  previous: string | null;
+  results: Course[];
 }
 
 interface Card {
@@ -84,6 +95,9 @@ const CardDeck: FC<CardDeckProps> = ({
   );
 };
 
+// First page of the course list.
+const COURSES_URL = '/api/microcourses/';
+
 /**
  * Dashboard Component
  *
@@ -93,6 +107,7 @@ const CardDeck: FC<CardDeckProps> = ({
 const Dashboard: FC = () => {
   const [isSidebarOpen, setIsSidebarOpen] = useState<boolean>(true);
   const [decks, setDecks] = useState<Deck[]>([]);
+  const [nextPage, setNextPage] = useState<string | null>(null);
   const navigate = useNavigate();
 
   /**
@@ -104,22 +119,36 @@ const Dashboard: FC = () => {
   const transformData = (data: Course[]): Deck[] => {
     return data.map((course) => ({
       title: course.title,
-      cards: [{ id: course.id, title: course.title, content: course.content }],
+      cards: [{ id: course.id, title: course.title, content: course.topic }],
     }));
   };
 
-  // Fetch courses once when the component mounts.
+  /**
+   * Fetches one page of courses. The first page replaces the decks; later
+   * pages are appended to them.
+   *
+   * @param url The list endpoint, or the "next" link of the previous page.
+   * @param signal Aborts the request; an aborted fetch leaves the decks as they are.
+   */
+  const fetchCourses = async (url: string, signal?: AbortSignal) => {
+    try {
+      const response = await api.get(url, { signal });
+      const page: CoursePage = response.data;
+      const loaded = transformData(page.results);
+      setDecks((prevDecks) => (url === COURSES_URL ? loaded : [...prevDecks, ...loaded]));
+      setNextPage(page.next);
+    } catch (error) {
+      if (signal?.aborted) return;
+      console.error('Error fetching data:', error);
+    }
+  };
+
+  // Fetch the first page of courses when the component mounts; the cleanup
+  // aborts it if the component unmounts (or StrictMode re-runs the effect).
   useEffect(() => {
-    const fetchCourses = async () => {
-      try {
-        const response = await api.get('/api/microcourses/');
-        const transformedDecks = transformData(response.data);
-        setDecks(transformedDecks);
-      } catch (error) {
-        console.error('Error fetching data:', error);
-      }
-    };
-    fetchCourses();
+    const controller = new AbortController();
+    fetchCourses(COURSES_URL, controller.signal);
+    return () => controller.abort();
   }, []);
 
 
@@ -187,6 +216,19 @@ const Dashboard: FC = () => {
             ))}
           </div>
 
+          {/* Further pages of the course list */}
+          {nextPage && (
+            <div className="flex justify-center mb-8">
+              <button
+                type="button"
+                onClick={() => fetchCourses(nextPage)}
+                className="bg-teal-600 dark:bg-gray-600 dark:hover:bg-gray-700 hover:bg-teal-700 text-white font-bold py-2 px-4 rounded-md transition duration-300 ease-in-out"
+              >
+                Load more
+              </button>
+            </div>
+          )}
+
           {/* "Add New Microcourse" Button */}
           <motion.div
             initial={{ opacity: 0, y: 20 }}
@@ -96,6 +96,12 @@ export interface MicrocourseData {
   sections: RawMicrocourseSection[];
 }
 
+// Course section a chat answer was grounded in.
+interface ChatSource {
+  section_id: number;
+  section_title: string;
+}
+
 export interface ChatMessage {
   sender: "bot" | "user";
   text: string;
@@ -342,7 +348,10 @@ const Microcourse: FC = () => {
     setMessages((prev) => [...prev, { sender: "user", text: currentQuestion }]);
     try {
       const response = await api.post("/api/agent_response/", { question: currentQuestion, id: microcourseId });
-      const botResponse = response.data.answer;
+      const sources: ChatSource[] = response.data.sources ?? [];
+      const botResponse = sources.length
+        ? `${response.data.answer} (Sources: ${sources.map((source) => source.section_title).join(", ")})`
+        : response.data.answer;
       setMessages((prev) => [...prev, { sender: "bot", text: botResponse }]);
     } catch (error) {
       console.error("Error creating microcourse:", error);